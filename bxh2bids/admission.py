@@ -0,0 +1,124 @@
+import os
+import threading
+import contextlib
+import logging
+
+
+#Memory-aware admission control for concurrent conversions.
+#
+#copy_image() reads a whole image into memory before writing it out. For a
+#.nii.gz source, gzip's read() collects the decompressed chunks and then
+#joins them, so for a moment about twice the uncompressed size is held; for a
+#.nii source the file is read once into a buffer of its own size. Parsing the
+#.bxh file and reading a NIfTI header with nibabel add a few MiB on top of a
+#fixed per-job overhead.
+#
+#A job (a scan, or a session running scan_jobs scans at once) is only
+#started while the estimated peak memory of all running jobs stays under a
+#budget. By default the budget is DEFAULT_MEMORY_FRACTION of the memory the
+#system reports as available when the batch starts. Jobs that do not fit
+#wait for running jobs to finish, except that a job is always started when
+#nothing else is running, so a single image larger than the budget still
+#converts (alone).
+
+
+#Fraction of available memory used by default
+DEFAULT_MEMORY_FRACTION = 0.5
+
+#Memory a job needs besides the image itself (xml, headers, buffers)
+JOB_OVERHEAD_BYTES = 32*1024*1024
+
+#Used if the available memory cannot be read
+FALLBACK_BUDGET_BYTES = 4*1024**3
+
+
+def scan_peak_memory(uncompressed_bytes, compressed):
+
+    #Estimated peak memory of converting one scan
+    if compressed:
+        return 2*uncompressed_bytes + JOB_OVERHEAD_BYTES
+
+    return uncompressed_bytes + JOB_OVERHEAD_BYTES
+
+
+def session_peak_memory(scan_sizes, scan_jobs=1):
+
+    #scan_sizes is an estimate.size_session() result. With scan_jobs threads
+    #at most the scan_jobs largest scans are held in memory at once.
+    peaks = sorted([scan_peak_memory(scan['uncompressed_bytes'], scan['compressed']) for scan in scan_sizes.values()],
+                   reverse=True)
+    if not peaks:
+        return JOB_OVERHEAD_BYTES
+
+    return sum(peaks[:max(1, scan_jobs)])
+
+
+def available_memory():
+
+    #MemAvailable from /proc/meminfo, or free physical memory, or None
+    try:
+        with open('/proc/meminfo') as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_budget(fraction=DEFAULT_MEMORY_FRACTION):
+
+    available = available_memory()
+    if available is None:
+        logging.warning('Available memory unknown; using a memory budget of {} bytes.'.format(FALLBACK_BUDGET_BYTES))
+        return FALLBACK_BUDGET_BYTES
+
+    return int(available*fraction)
+
+
+class MemoryBudget(object):
+
+    #Bytes of memory shared by the jobs of one process. acquire() blocks until
+    #the job fits; try_acquire() returns False instead.
+
+    def __init__(self, total_bytes):
+        self.total_bytes = int(total_bytes)
+        self.used_bytes = 0
+        self.condition = threading.Condition()
+
+    def fits(self, nbytes):
+        #Anything fits when nothing is running
+        return self.used_bytes == 0 or self.used_bytes+nbytes <= self.total_bytes
+
+    def try_acquire(self, nbytes):
+        with self.condition:
+            if not self.fits(nbytes):
+                return False
+            if nbytes > self.total_bytes:
+                logging.warning('Job needs {} bytes, more than the whole memory budget of {}; running it alone.'.format(
+                                nbytes, self.total_bytes))
+            self.used_bytes = self.used_bytes+nbytes
+            return True
+
+    def acquire(self, nbytes):
+        with self.condition:
+            if not self.fits(nbytes):
+                logging.info('Waiting for {} bytes of memory ({} of {} in use).'.format(nbytes, self.used_bytes, self.total_bytes))
+            while not self.try_acquire(nbytes):
+                self.condition.wait()
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used_bytes = max(0, self.used_bytes-nbytes)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
@@ -0,0 +1,121 @@
+import time
+import asyncio
+import threading
+
+import bxh2bids.bxh2bids as b2b
+import bxh2bids.run_bxh2bids as rb2b
+
+
+#asyncio interface, for services that drive conversions from an event loop.
+#
+#A session is converted in a thread (asyncio.to_thread), so the event loop
+#is never blocked by file I/O or compression, and the conversion reports its
+#progress to the loop as events:
+#   {'event': 'session_started', 'dataid': ...}
+#   {'event': 'session_planned', 'dataid': ..., 'scans': [bxh files]}
+#   {'event': 'scan_started', 'bxh_file': ..., 'output': ...}
+#   {'event': 'scan_finished', 'bxh_file': ..., 'seconds': ..., 'attempts': ...}
+#   {'event': 'scan_failed', 'bxh_file': ..., 'seconds': ..., 'error': ...}
+#   {'event': 'session_published', 'dataid': ..., 'failed': [bxh files left out]}
+#   {'event': 'session_finished' or 'session_failed', 'dataid': ..., 'result': {...}}
+#Every event also has 'dataid' and 'time'. The result is the same dictionary
+#run_bxh2bids.run_sessions() returns for a session.
+#
+#Cancelling the task that awaits a conversion stops it before its next scan
+#(a scan that has started is finished first); nothing of the session is
+#published and the CancelledError is raised once its thread has rolled back.
+#
+#    async for event in aio.session_events(proj_dir, '20200101_12345'):
+#        print(event['event'])
+#
+#    results = await aio.convert_sessions(proj_dir, biac_dirs, max_concurrent=4)
+
+
+#Marks the end of a session's events
+_FINISHED = object()
+
+
+class _Observer(object):
+
+    #Passes events from the conversion thread to the event loop
+
+    def __init__(self, loop, queue, dataid):
+        self.loop = loop
+        self.queue = queue
+        self.dataid = dataid
+        self.cancelled = threading.Event()
+
+    def notify(self, event):
+        event.setdefault('dataid', self.dataid)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def finish(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, _FINISHED)
+
+
+def _convert_in_thread(proj_dir, dataid, incremental, scan_filter, scan_jobs, observer):
+
+    token = b2b.session_observer.set(observer)
+    try:
+        return rb2b._bidsify_session(proj_dir, dataid, incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs)
+    finally:
+        b2b.session_observer.reset(token)
+        observer.finish()
+
+
+async def session_events(proj_dir, dataid, incremental=False, scan_filter=None, scan_jobs=1, limit=None):
+
+    #Convert one session, yielding its events as they happen. limit is an
+    #optional asyncio.Semaphore shared by sessions that should not all run at once.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    observer = _Observer(loop, queue, dataid)
+
+    if limit is not None:
+        await limit.acquire()
+    try:
+        observer.notify({'event': 'session_started', 'time': time.time()})
+        task = asyncio.ensure_future(asyncio.to_thread(_convert_in_thread, proj_dir, dataid, incremental, scan_filter, scan_jobs,
+                                                       observer))
+        try:
+            while True:
+                event = await queue.get()
+                if event is _FINISHED:
+                    break
+                yield event
+            result = await task
+        except (asyncio.CancelledError, GeneratorExit):
+            #Stop before the next scan and wait for the rollback
+            observer.cancelled.set()
+            await asyncio.shield(task)
+            raise
+        yield {'event': 'session_finished' if result['ok'] else 'session_failed', 'dataid': dataid, 'result': result,
+               'time': time.time()}
+    finally:
+        if limit is not None:
+            limit.release()
+
+
+async def convert_session(proj_dir, dataid, incremental=False, scan_filter=None, scan_jobs=1, limit=None, on_event=None):
+
+    #Convert one session and return its result. on_event, if given, is
+    #called with every event (it runs on the event loop, so must not block).
+    result = None
+    async for event in session_events(proj_dir, dataid, incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs,
+                                      limit=limit):
+        if on_event is not None:
+            on_event(event)
+        if 'result' in event:
+            result = event['result']
+
+    return result
+
+
+async def convert_sessions(proj_dir, biac_dirs, max_concurrent=1, incremental=False, scan_filter=None, scan_jobs=1, on_event=None):
+
+    #Convert sessions, at most max_concurrent at once; returns their results in biac_dirs order
+    limit = asyncio.Semaphore(max_concurrent)
+
+    return await asyncio.gather(*[convert_session(proj_dir, dataid, incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs,
+                                                  limit=limit, on_event=on_event)
+                                  for dataid in biac_dirs])
@@ -42,11 +42,102 @@ import json
 import xmltodict
 import os, re, shutil, sys
 import logging, time
-import bxh2bids.utils.bxh_pick_fields
+import contextlib
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bxh2bids.utils import bxh_pick_fields
+from bxh2bids.scan_entry import ScanEntry
+import bxh2bids.manifest as manifest
+import bxh2bids.scan_filter as scan_filters
+import bxh2bids.scheduler as scheduler
+import bxh2bids.admission as admission
+import bxh2bids.retry as retry
+from bxh2bids.session_log import current_scan
+import bxh2bids.session_log as session_log
+import bxh2bids.trace as trace
+import bxh2bids.profiling as profiling
 import string
 import gzip
-import nibabel as nb
-import tkinter as tk
+#nibabel is imported where it is needed; it takes longer to import than the rest together
+try:
+    import fcntl
+except ImportError:
+    #No file locking on Windows
+    fcntl = None
+
+
+#Template files linking bxh descriptions and header fields to BIDS
+INFO_FIELD_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'info_field_files')
+PSD_TYPES_FILE = os.path.join(INFO_FIELD_DIR, 'psd_types.json')
+FUNC_FIELDS_FILE = os.path.join(INFO_FIELD_DIR, 'func_info_fields.json')
+ANAT_FIELDS_FILE = os.path.join(INFO_FIELD_DIR, 'anat_info_fields.json')
+DWI_FIELDS_FILE = os.path.join(INFO_FIELD_DIR, 'dwi_info_fields.json')
+FMAP_FIELDS_FILE = os.path.join(INFO_FIELD_DIR, 'fmap_info_fields.json')
+TEMPLATE_FILES = [PSD_TYPES_FILE, FUNC_FIELDS_FILE, ANAT_FIELDS_FILE, DWI_FIELDS_FILE, FMAP_FIELDS_FILE]
+
+#Parsed template files, {path: [(mtime, size), contents]}
+__template_cache = {}
+
+#Optional observer of the current conversion (see aio.py). It is told about
+#every scan with observer.notify(event) and can stop the session between
+#scans by setting observer.cancelled (a threading.Event).
+session_observer = contextvars.ContextVar('session_observer', default=None)
+
+#Optional list that every scan of the current session that is converted, or
+#fails, is appended to as {'bxh_file', 'modality', 'ok', 'seconds', 'attempts',
+#'bytes_read', 'bytes_written'} (see run_bxh2bids._bidsify_session()).
+scan_statistics = contextvars.ContextVar('scan_statistics', default=None)
+
+
+class ConversionCancelled(RuntimeError):
+
+    #Raised when the observer cancels a session; the whole session is rolled back
+    pass
+
+
+class ScanConversionError(RuntimeError):
+
+    #Raised after a session was published without some of its scans.
+    #failures is {bxh file: {'error', 'transient', 'attempts'}}.
+    def __init__(self, dataid, failures):
+        self.dataid = dataid
+        self.failures = failures
+        RuntimeError.__init__(self, '{} scan(s) of {} failed: {}'.format(
+            len(failures), dataid, '; '.join(['{}: {}'.format(os.path.split(bxh_file)[-1], failure['error'])
+                                               for bxh_file, failure in sorted(failures.items())])))
+
+
+def __notify(event, **fields):
+
+    observer = session_observer.get()
+    if observer is not None:
+        fields['event'] = event
+        fields['time'] = time.time()
+        observer.notify(fields)
+
+
+def __check_cancelled():
+
+    observer = session_observer.get()
+    if observer is not None and observer.cancelled.is_set():
+        raise ConversionCancelled('Conversion cancelled.')
+
+
+def load_template(template_file):
+
+    #Contents of a JSON template file, read again only if the file changed
+    #(a long-running process must see edits to psd_types.json)
+    stat = os.stat(template_file)
+    signature = (stat.st_mtime, stat.st_size)
+    cached = __template_cache.get(template_file)
+    if cached is None or cached[0] != signature:
+        with open(template_file) as fd:
+            cached = [signature, json.loads(fd.read())]
+        __template_cache[template_file] = cached
+
+    return cached[1]
 
 
 def copy_image(image_to_copy, full_output):
@@ -59,22 +150,27 @@ def copy_image(image_to_copy, full_output):
     #original file name is not maintained.
 
     #Read in the input file contents
+    #(the trace spans include decompressing and compressing)
     logging.info('Reading file to copy: {}'.format(image_to_copy))
-    if image_to_copy[-3:] == '.gz':
-        with gzip.open(image_to_copy, 'rb') as fi:
-            input_contents = fi.read()
-    else:
-        with open(image_to_copy, 'rb') as fi:
-            input_contents = fi.read()
+    with trace.span('copy_image.read', input_file=image_to_copy) as read_span:
+        if image_to_copy[-3:] == '.gz':
+            with gzip.open(image_to_copy, 'rb') as fi:
+                input_contents = fi.read()
+        else:
+            with open(image_to_copy, 'rb') as fi:
+                input_contents = fi.read()
+        read_span['bytes_out'] = len(input_contents)
 
     #Write the contents to the output destination
     logging.info('Writing file: {}'.format(full_output))
-    if full_output[-3:] == '.gz':
-        with gzip.open(full_output, 'wb') as fo:
-            fo.write(input_contents)
-    else:
-        with open(full_output, 'wb') as fo:
-            fo.write(input_contents)
+    with trace.span('copy_image.write', output_file=full_output) as write_span:
+        write_span['bytes_in'] = len(input_contents)
+        if full_output[-3:] == '.gz':
+            with gzip.open(full_output, 'wb') as fo:
+                fo.write(input_contents)
+        else:
+            with open(full_output, 'wb') as fo:
+                fo.write(input_contents)
 
     logging.info('--FINISHED: copy_image--')
 
@@ -97,21 +193,45 @@ def create_dataset_description(target_study_dir, study_name=None):
         if study_name == '': #(The path was passed ending with a '/')
             study_name = os.path.split(os.path.split(target_study_dir)[0])[-1]
 
-    #If it doesn't exist, write it.
+    #If it doesn't exist, write it. Sessions converted at the same time may
+    #all get here, so the file is written under a temporary name and linked
+    #into place; only one link can succeed and nobody sees half a file.
+    #File systems without hard links get the file created exclusively instead.
     if not os.path.exists(full_output):
         output_dict = {'BIDSVersion': '1.0.2',
                        'Name': str(study_name)
                        }
         logging.info('Writing dataset json: '+str(full_output))
         output = json.dumps(output_dict, indent=4)
-        with open(full_output, 'w') as fd:
+        temp_output = '{}.{}.{}.tmp'.format(full_output, os.getpid(), threading.get_ident())
+        with open(temp_output, 'w') as fd:
             fd.write(output)
+        try:
+            os.link(temp_output, full_output)
+        except FileExistsError:
+            logging.warning('Dataset description file already exists!')
+        except OSError:
+            __write_exclusive(full_output, output)
+        finally:
+            os.remove(temp_output)
     else:
         logging.warning('Dataset description file already exists!')
 
     logging.info('--FINISHED: create_dataset_description--')
 
 
+def __write_exclusive(full_output, output):
+
+    #Create a file only if it does not exist yet
+    try:
+        fd = os.open(full_output, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        logging.warning('Dataset description file already exists!')
+        return
+    with os.fdopen(fd, 'w') as output_fd:
+        output_fd.write(output)
+
+
 def match_func(image_to_copy, ses_dict):
 
     logging.info('--START: match_func--')
@@ -292,14 +412,13 @@ def create_bold_json(bxh_file, full_output):
 
     #Put together dictionary of things to write to the sidecar .json file
     #Make sure the func field template file is where it should be
-    here = os.path.dirname(os.path.realpath(__file__))
-    func_field_file = os.path.join(here, 'info_field_files', 'func_info_fields.json')
+    func_field_file = FUNC_FIELDS_FILE
     if not os.path.exists(func_field_file):
         logging.error('Functional image sidecar template file cannot be found!')
         logging.error('It should be here: '+str(func_field_file))
         raise RuntimeError('Missing functional sidecar template file!')
 
-    out_dict = bxh_pick_fields.bxh_pick(func_field_file, bxh_as_dict=bxh_contents)
+    out_dict = bxh_pick_fields.bxh_pick(func_field_file, bxh_as_dict=bxh_contents, template=load_template(func_field_file))
 
     #Make sure the tr is in seconds
     tr = out_dict['RepetitionTime']
@@ -374,14 +493,13 @@ def create_fmap_json(bxh_file, bxh_info_dict, full_output):
 
     #Put together dictionary of things to write to the sidecar .json file
     #Make sure the fmap field template file is where it should be
-    here = os.path.dirname(os.path.realpath(__file__))
-    fmap_field_file = os.path.join(here, 'info_field_files', 'fmap_info_fields.json')
+    fmap_field_file = FMAP_FIELDS_FILE
     if not os.path.exists(fmap_field_file):
         logging.error('Fmap image sidecar template file cannot be found!')
         logging.error('It should be here: '+str(fmap_field_file))
         raise RuntimeError('Missing functional sidecar template file!')
 
-    out_dict = bxh_pick_fields.bxh_pick(fmap_field_file, bxh_as_dict=bxh_contents)
+    out_dict = bxh_pick_fields.bxh_pick(fmap_field_file, bxh_as_dict=bxh_contents, template=load_template(fmap_field_file))
 
     #Make sure the tr is in seconds
     tr = float(out_dict['RepetitionTime'])
@@ -419,14 +537,13 @@ def create_anat_json(bxh_file, full_output):
 
     #Put together dictionary of things to write to the sidecar .json file
     #Make sure the anat field template file is where it should be
-    here = os.path.dirname(os.path.realpath(__file__))
-    anat_field_file = os.path.join(here, 'info_field_files', 'anat_info_fields.json')
+    anat_field_file = ANAT_FIELDS_FILE
     if not os.path.exists(anat_field_file):
         logging.error('Anatomical image sidecar template file cannot be found!')
         logging.error('It should be here: '+str(anat_field_file))
         raise RuntimeError('Missing anatomical sidecar template file!')
 
-    out_dict = bxh_pick_fields.bxh_pick(anat_field_file, bxh_as_dict=bxh_contents)
+    out_dict = bxh_pick_fields.bxh_pick(anat_field_file, bxh_as_dict=bxh_contents, template=load_template(anat_field_file))
 
     #Make sure echo time is in seconds
     et = out_dict['EchoTime']
@@ -460,14 +577,13 @@ def create_dwi_json(bxh_file, full_output):
 
     #Put together dictionary of things to write to the sidecar .json file
     #Make sure the func field template file is where it should be
-    here = os.path.dirname(os.path.realpath(__file__))
-    dwi_field_file = os.path.join(here, 'info_field_files', 'dwi_info_fields.json')
+    dwi_field_file = DWI_FIELDS_FILE
     if not os.path.exists(dwi_field_file):
         logging.error('DWI image sidecar template file cannot be found!')
         logging.error('It should be here: '+str(dwi_field_file))
         raise RuntimeError('Missing functional sidecar template file!')
 
-    out_dict = bxh_pick_fields.bxh_pick(dwi_field_file, bxh_as_dict=bxh_contents)
+    out_dict = bxh_pick_fields.bxh_pick(dwi_field_file, bxh_as_dict=bxh_contents, template=load_template(dwi_field_file))
 
     #If this is a DTI fmap, there may be an IntendedFor image
     ##TODO: expose the bxh_info_dict to this function so it can handle
@@ -505,14 +621,13 @@ def create_ncanda_json(bxh_file, full_output):
 
     #Put together dictionary of things to write to the sidecar .json file
     #Make sure the fmap field template file is where it should be
-    here = os.path.dirname(os.path.realpath(__file__))
-    fmap_field_file = os.path.join(here, 'info_field_files', 'fmap_info_fields.json')
+    fmap_field_file = FMAP_FIELDS_FILE
     if not os.path.exists(fmap_field_file):
         logging.error('Fmap image sidecar template file cannot be found!')
         logging.error('It should be here: '+str(fmap_field_file))
         raise RuntimeError('Missing fmap sidecar template file!')
 
-    out_dict = bxh_pick_fields.bxh_pick(fmap_field_file, bxh_as_dict=bxh_contents)
+    out_dict = bxh_pick_fields.bxh_pick(fmap_field_file, bxh_as_dict=bxh_contents, template=load_template(fmap_field_file))
 
     #Pull apart the two echo times and make sure they are in seconds
     et = out_dict['EchoTime']
@@ -607,6 +722,120 @@ output_dir_func = lambda target_study_dir, bxh_info_dict, scan_type: \
     else os.path.join(target_study_dir, 'sub-'+bxh_info_dict['sub'], scan_type) 
 
 
+#bxh descriptions of B0 field maps bxh2bids knows how to handle
+FMAP_DESCRIPTIONS = ["field map","field map reverse","field map reverse polarity","field map regular","fMRI fieldmap","fMRI fieldmap Reverse","fieldmap_revpol","field map_revpol"]
+
+
+def copy_events_tsv(bxh_info_dict, output_dir, overwrite=False):
+
+    #Copy the events .tsv file of a functional run into the output directory
+    if not os.path.exists(bxh_info_dict['tsv_file']):
+        raise RuntimeError('tsv_file cannot be found: '+str(bxh_info_dict['tsv_file']))
+    tsv_output_name = bxh_info_dict['output_prefix']+'_events.tsv'
+    tsv_full_output = os.path.join(output_dir, tsv_output_name)
+    #Check to see if the output exists already
+    if os.path.exists(tsv_full_output) and not overwrite:
+        raise RuntimeError('Output file already exists: '+str(tsv_full_output))
+    tsv_to_copy = bxh_info_dict['tsv_file']
+    logging.info('Copying file: '+str(tsv_to_copy))
+    logging.info('Target location: '+str(tsv_full_output))
+    shutil.copy2(tsv_to_copy, tsv_full_output)
+
+
+def write_json_sidecar(bxh_file, bxh_info_dict, output_dir):
+
+    #Write the sidecar .json file for one image, either from a BIAC-provided
+    #json file or from the information in the .bxh header.
+
+    json_output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
+    full_json_output = os.path.join(output_dir, json_output_name)
+    biac_json = bxh_info_dict.get('biac_json')
+
+    if bxh_info_dict['scan_type'] == 'func':
+        #Check to see if we have a BIAC-provided json file.
+        #If not, create one here.
+        if biac_json is not None:
+            logging.info('BIAC-provided json found: {}'.format(biac_json))
+            #The only thing missing from the BIAC-provided json files is the task name.
+            #Find the task name and add it to the json file.
+            taskname = os.path.split(full_json_output)[-1].split('task-')[-1].split('_')[0]
+            with open(biac_json, 'r') as fd:
+                json_dict = json.loads(fd.read())
+            json_dict['TaskName'] = taskname
+            json_out = json.dumps(json_dict, indent=4)
+            logging.info('Writing json file: {}'.format(full_json_output))
+            with open(full_json_output, 'w') as fo:
+                fo.write(json_out)
+        else:
+            with trace.span('create_bold_json', input_file=bxh_file, output_file=full_json_output):
+                create_bold_json(bxh_file, full_json_output)
+
+    elif bxh_info_dict['scan_type'] == 'fmap':
+        if bxh_info_dict['bxh_desc'] == 'ncanda-grefieldmap-v1':
+            with trace.span('create_ncanda_json', input_file=bxh_file, output_file=full_json_output):
+                create_ncanda_json(bxh_file, full_json_output)
+
+        #Check to see if we have a BIAC-provided json file.
+        #If not, create one here.
+        elif biac_json is not None:
+            logging.info('BIAC-provided json found: {}'.format(biac_json))
+            with open(biac_json, 'r') as fd:
+                json_dict = json.loads(fd.read())
+            if 'IntendedFor' in bxh_info_dict.keys():
+                json_dict['IntendedFor'] = bxh_info_dict['IntendedFor']
+            json_out = json.dumps(json_dict, indent=4)
+            logging.info('Writing json file: {}'.format(full_json_output))
+            with open(full_json_output, 'w') as fo:
+                fo.write(json_out)
+
+        else:
+            #Convert the phase-encode direction to a data matrix dimension
+            #First get the participant-based PE direction ['AP','PA','IS','SI','LR','RL']
+            pe_dir = bxh_info_dict['dir']
+            #Determine how the data are stored in the data file (e.g. 'LPI')
+            with trace.span('read_image_orientation'):
+                import nibabel as nb
+                img = nb.load(bxh_info_dict['orig_image'])
+                data_orientation = nb.orientations.aff2axcodes(img.affine)
+
+            #The second character of pe_dir should be the end of the PE direction.
+            #The first character of pe_dir should be the beginning of the PE direction.
+            pos_dims = ['i', 'j', 'k']
+            neg_dims = ['i-', 'j-', 'k-']
+            found_pe = 0
+            for count in range(3):
+                if data_orientation[count] == pe_dir[1]:
+                    pe_code = pos_dims[count]
+                    found_pe = 1
+                if data_orientation[count] == pe_dir[0]:
+                    pe_code = neg_dims[count]
+                    found_pe = 1
+            if not found_pe:
+                logging.error('Phase-encode direction code not determined!')
+                logging.error('Phase-encode direction supplied: {}'.format(pe_dir))
+                logging.error('Data storage directions: {}'.format(data_orientation))
+                raise RuntimeError
+            #Store the determined PE direction code in the bxh dictionary
+            bxh_info_dict['pe_code'] = pe_code
+
+            with trace.span('create_fmap_json', input_file=bxh_file, output_file=full_json_output):
+                create_fmap_json(bxh_file, bxh_info_dict, full_json_output)
+
+    elif bxh_info_dict['scan_type'] in ['anat', 'dwi']:
+        #Check to see if we have a BIAC-provided json file.
+        #If not, create one here.
+        if biac_json is not None:
+            logging.info('BIAC-provided json found: {}'.format(biac_json))
+            logging.info('Writing json file: {}'.format(full_json_output))
+            shutil.copy2(biac_json, full_json_output)
+        elif bxh_info_dict['scan_type'] == 'anat':
+            with trace.span('create_anat_json', input_file=bxh_file, output_file=full_json_output):
+                create_anat_json(bxh_file, full_json_output)
+        else:
+            with trace.span('create_dwi_json', input_file=bxh_file, output_file=full_json_output):
+                create_dwi_json(bxh_file, full_json_output)
+
+
 def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
     #Read in the bxh_file using xmltodict
     #Pull out:
@@ -619,9 +848,6 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
     #Make sure bxh_file is there
     if not os.path.exists(bxh_file):
         raise RuntimeError('Passed file cannot be found: '+str(bxh_file))
-    
-    #Directory of the bxh file
-    bxh_dir = os.path.split(bxh_info_dict['orig_image'])[0]
 
     if bxh_info_dict['scan_type'] == 'func':
 
@@ -630,7 +856,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
 
         if not os.path.exists(output_dir):
             logging.info('Creating directory: '+str(output_dir))
-            os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
         #Copy and rename the functional data
         logging.info('Running copy_func on this .bxh.')
@@ -645,42 +871,10 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
 
         #Copy a .tsv file if it exists
         if 'tsv_file' in bxh_info_dict.keys():
-            #Put together the output prefix
-            if bxh_info_dict['output_name'][-3:] == '.gz':
-                image_ext = '.nii.gz'
-            else:
-                image_ext = '.nii'
-            if not os.path.exists(bxh_info_dict['tsv_file']):
-                raise RuntimeError('tsv_file cannot be found: '+str(bxh_info_dict['tsv_file']))
-            tsv_output_name = bxh_info_dict['output_prefix']+'_events.tsv'
-            tsv_full_output = os.path.join(output_dir, tsv_output_name)
-            #Check to see if the output exists already
-            if os.path.exists(tsv_full_output):
-                raise RuntimeError('Output file already exists: '+str(tsv_full_output))
-            tsv_to_copy = bxh_info_dict['tsv_file']
-            logging.info('Copying file: '+str(tsv_to_copy))
-            logging.info('Target location: '+str(tsv_full_output))
-            shutil.copy2(tsv_to_copy, tsv_full_output)
-
-        json_output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
-        full_json_output = os.path.join(output_dir, json_output_name)
-        #Check to see if we have a BIAC-provided json file.
-        #If not, create one here.
-        if bxh_info_dict['biac_json'] is not None:
-            biac_json = bxh_info_dict['biac_json']
-            logging.info('BIAC-provided json found: {}'.format(biac_json))
-            #The only thing missing from the BIAC-provided json files is the task name.
-            #Find the task name and add it to the json file.
-            taskname = os.path.split(full_json_output)[-1].split('task-')[-1].split('_')[0]
-            with open(biac_json, 'r') as fd:
-                json_dict = json.loads(fd.read())
-            json_dict['TaskName'] = taskname
-            json_out = json.dumps(json_dict, indent=4)
-            logging.info('Writing json file: {}'.format(full_json_output))
-            with open(full_json_output, 'w') as fo:
-                fo.write(json_out)
-        else:
-            create_bold_json(bxh_file, full_json_output)
+            with trace.span('copy_events_tsv', input_file=bxh_info_dict['tsv_file']):
+                copy_events_tsv(bxh_info_dict, output_dir)
+
+        write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
 
     elif bxh_info_dict['scan_type'] == 'fmap':
 
@@ -691,7 +885,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
         #all upper directories.
         if not os.path.exists(output_dir):
             logging.info('Creating directory: '+str(output_dir))
-            os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
         bxh_desc = bxh_info_dict['bxh_desc']
 
@@ -729,7 +923,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
 
             #Copy the fmap file
             image_to_copy = bxh_info_dict['orig_image']
-            full_output = bxh_info_dict['output_prefix']+b_label+file_type
+            full_output = os.path.join(output_dir, bxh_info_dict['output_prefix']+'_'+b_label+file_type)
             #Check to see if the output file already exists
             if os.path.exists(full_output):
                 raise RuntimeError('Output file already exists: '+str(full_output))
@@ -740,9 +934,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
             copy_image(image_to_copy, full_output)
 
             #Put together the sidecar .json file
-            output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
-            full_output = os.path.join(output_dir, output_name)
-            create_ncanda_json(bxh_file, full_output)
+            write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
 
         # elif bxh_desc == 'HCP DTI reverse polarity':
         #     #Data in the same 3D shape as a DTI acquisition, but with only a few volumes
@@ -774,11 +966,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
         #     logging.info('Creating bvec and bval files for DTI fmap...')
         #     create_bvecs_bvals(bxh_file, bxh_info_dict, output_dir)
 
-        elif bxh_desc in ["field map","field map reverse","field map reverse polarity","field map regular","fMRI fieldmap","fMRI fieldmap Reverse","fieldmap_revpol","field map_revpol"]:
-            #Create output name for json file
-            json_output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
-            full_json_output = os.path.join(output_dir, json_output_name)
-
+        elif bxh_desc in FMAP_DESCRIPTIONS:
             #Copy the image data
             image_to_copy = bxh_info_dict['orig_image']
             output_name = bxh_info_dict['output_name']
@@ -787,55 +975,7 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
             logging.info('Target location: '+str(full_output))
             copy_image(image_to_copy, full_output)
 
-            #Check to see if we have a BIAC-provided json file.
-            #If not, create one here.
-            if bxh_info_dict['biac_json'] is not None:
-                biac_json = bxh_info_dict['biac_json']
-                logging.info('BIAC-provided json found: {}'.format(biac_json))
-                logging.info('Writing json file: {}'.format(full_json_output))
-                shutil.copy2(biac_json, full_json_output)
-
-                with open(biac_json, 'r') as fd:
-                    json_dict = json.loads(fd.read())
-                if 'IntendedFor' in bxh_info_dict.keys():
-                    json_dict['IntendedFor'] = bxh_info_dict['IntendedFor']
-                json_out = json.dumps(json_dict, indent=4)
-                logging.info('Writing json file: {}'.format(full_json_output))
-                with open(full_json_output, 'w') as fo:
-                    fo.write(json_out)
-
-            else:
-                #Convert the phase-encode direction to a data matrix dimension
-                #First get the participant-based PE direction ['AP','PA','IS','SI','LR','RL']
-                pe_dir = bxh_info_dict['dir']
-                #Determine how the data are stored in the data file (e.g. 'LPI')
-                img = nb.load(bxh_info_dict['orig_image'])
-                data_orientation = nb.orientations.aff2axcodes(img.affine)
-
-                #The second character of pe_dir should be the end of the PE direction.
-                #The first character of pe_dir should be the beginning of the PE direction.
-                pos_dims = ['i', 'j', 'k']
-                neg_dims = ['i-', 'j-', 'k-']
-                found_pe = 0
-                for count in range(3):
-                    if data_orientation[count] == pe_dir[1]:
-                        pe_code = pos_dims[count]
-                        found_pe = 1
-                    if data_orientation[count] == pe_dir[0]:
-                        pe_code = neg_dims[count]
-                        found_pe = 1
-                if not found_pe:
-                    logging.error('Phase-encode direction code not determined!')
-                    logging.error('Phase-encode direction supplied: {}'.format(pe_dir))
-                    logging.error('Data storage directions: {}'.format(data_orientation))
-                    raise RuntimeError
-                #Store the determined PE direction code in the bxh dictionary
-                bxh_info_dict['pe_code'] = pe_code
-
-                #Copy and rename the functional data
-                logging.info('Copying image file.')
-
-                create_fmap_json(bxh_file, bxh_info_dict, full_json_output)
+            write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
 
         else:
             logging.error('B0 fieldmap description not recognized: '+str(bxh_desc))
@@ -847,15 +987,11 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
         #Put together the output directory
         output_dir = output_dir_func(target_study_dir, bxh_info_dict, "anat")
 
-        #Create the sidecare .json file based on the .bxh
-        json_output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
-        full_json_output = os.path.join(output_dir, json_output_name)
-
         #If the output directory does not exist, create it and
         #all upper directories.
         if not os.path.exists(output_dir):
             logging.info('Creating directory: '+str(output_dir))
-            os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
         #Copy and rename the anatomical data
         logging.info('Processing anat data...')
@@ -873,30 +1009,19 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
         logging.info('Target location: '+str(full_output))
         copy_image(image_to_copy, full_output)
 
-        #Check to see if we have a BIAC-provided json file.
-        #If not, create one here.
-        if bxh_info_dict['biac_json'] is not None:
-            biac_json = bxh_info_dict['biac_json']
-            logging.info('BIAC-provided json found: {}'.format(biac_json))
-            logging.info('Writing json file: {}'.format(full_json_output))
-            shutil.copy2(biac_json, full_json_output)
-        else:
-            create_anat_json(bxh_file, full_json_output)
+        #Create the sidecar .json file based on the .bxh
+        write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
 
     elif bxh_info_dict['scan_type'] == 'dwi':
 
         #Put together the output directory
         output_dir = output_dir_func(target_study_dir, bxh_info_dict, "dwi")
 
-        #Create the sidecar .json file based on the .bxh
-        json_output_name = bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json'
-        full_json_output = os.path.join(output_dir, json_output_name)
-
         #If the output directory does not exist, create it and
         #all upper directories.
         if not os.path.exists(output_dir):
             logging.info('Creating directory: '+str(output_dir))
-            os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
         #Copy and rename the DWI data
         logging.info('Running copy_dwi on this .bxh.')
@@ -914,41 +1039,110 @@ def convert_bxh(bxh_file, bxh_info_dict, target_study_dir=None):
         logging.info('Target location: '+str(full_output))
         copy_image(image_to_copy, full_output)
 
-        #Check to see if we have a BIAC-provided json file.
-        #If not, create one here.
-        if bxh_info_dict['biac_json'] is not None:
-            biac_json = bxh_info_dict['biac_json']
-            logging.info('BIAC-provided json found: {}'.format(biac_json))
-            logging.info('Writing json file: {}'.format(full_json_output))
-            shutil.copy2(biac_json, full_json_output)
-        else:
-            create_dwi_json(bxh_file, full_json_output)
+        #Create the sidecar .json file based on the .bxh
+        write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
 
         #Create the bvecs and bvals files based on the .bxh
         logging.info('Running create_bvecs_bvals on this .bxh.')
-        create_bvecs_bvals(bxh_file, bxh_info_dict, output_dir)
+        with trace.span('create_bvecs_bvals', input_file=bxh_file):
+            create_bvecs_bvals(bxh_file, bxh_info_dict, output_dir)
         
     elif bxh_info_dict['scan_type'] == 'notsupported':
         logging.info('Scan type not supported for: '+str(bxh_file))
     else:
-        logging.error('Scan type not recognized; should be [bold,anat,dwi]: '+str(scan_type))
+        logging.error('Scan type not recognized; should be [bold,anat,dwi]: '+str(bxh_info_dict['scan_type']))
         raise RuntimeError('Scan type not recognized!')
         
     logging.info('----FINISH: convert_bxh----')
 
 
-def auto_create_internal_info(bxh_file, events_files_dir, data_info, multi_bxh_info_dict):
+def convert_sidecars(bxh_file, bxh_info_dict, target_study_dir=None, events=False, stage_dir=None):
+
+    #Write again the sidecar .json (and, for DWI, .bvec/.bval) files of an
+    #image that has already been converted. Image files are not touched.
+    #If events is True, func events .tsv files are copied again too.
+    #With a stage_dir, the files are written there, in the same layout as in
+    #target_study_dir, to be published with publish_staged_session().
+    #Returns True if the sidecars were written, False if the image has not
+    #been converted yet.
+
+    logging.info('----START: convert_sidecars----')
+
+    #Make sure bxh_file is there
+    if not os.path.exists(bxh_file):
+        raise RuntimeError('Passed file cannot be found: '+str(bxh_file))
+
+    scan_type = bxh_info_dict['scan_type']
+    if scan_type not in ['anat', 'func', 'dwi', 'fmap']:
+        logging.info('Scan type not supported for: '+str(bxh_file))
+        return False
+    if scan_type == 'fmap' and bxh_info_dict['bxh_desc'] not in FMAP_DESCRIPTIONS+['ncanda-grefieldmap-v1']:
+        logging.error('B0 fieldmap description not recognized: '+str(bxh_info_dict['bxh_desc']))
+        raise RuntimeError('B0 fieldmap description not recognized!')
+
+    #Only regenerate sidecars for images that are already there
+    image_output = expected_outputs(bxh_file, bxh_info_dict, target_study_dir)[0][0]
+    if not os.path.exists(image_output):
+        logging.warning('Converted image not found, skipping sidecars: '+str(image_output))
+        return False
+
+    if stage_dir is None:
+        output_dir = output_dir_func(target_study_dir, bxh_info_dict, scan_type)
+    else:
+        output_dir = output_dir_func(stage_dir, bxh_info_dict, scan_type)
+        os.makedirs(output_dir, exist_ok=True)
+
+    write_json_sidecar(bxh_file, bxh_info_dict, output_dir)
+
+    if scan_type == 'dwi':
+        logging.info('Running create_bvecs_bvals on this .bxh.')
+        create_bvecs_bvals(bxh_file, bxh_info_dict, output_dir)
+
+    if events and scan_type == 'func' and 'tsv_file' in bxh_info_dict.keys():
+        copy_events_tsv(bxh_info_dict, output_dir, overwrite=True)
+
+    logging.info('----FINISH: convert_sidecars----')
+
+    return True
+
+
+#BIDS file name labels that can be given in a bxh description
+DESCRIPTION_LABELS = ['task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo']
+
+
+@functools.lru_cache(maxsize=4096)
+def split_description(bxh_desc):
+
+    #Split a description of the form "type_label-value_..._suffix" once per
+    #distinct description; the many sessions of a study share a few dozen.
+    #Returns (scan type, scan label, ((BIDS label, value), ...)), or None if
+    #the description is not in that form.
+    desc_parts = bxh_desc.split('_')
+    if len(desc_parts) == 1:
+        return None
+
+    bids_labels = {}
+    for bids_label in DESCRIPTION_LABELS:
+        for element in desc_parts[1:-1]:
+            if element.split('-')[0] == bids_label:
+                bids_labels[bids_label] = element.split('-')[-1]
+
+    return desc_parts[0], desc_parts[-1], tuple(bids_labels.items())
+
+
+def auto_create_internal_info(bxh_file, events_files_dir, data_info, multi_bxh_info_dict, scan_filter=None):
 
     #Same as below, except pull all the info. from the file description
     #Directory and name of the bxh file
     bxh_dir, bxh_name = os.path.split(bxh_file)
     
-    #Create dictionary entry for this bxh file
-    this_entry_dict = {}
+    #Create the entry for this bxh file
+    this_entry_dict = ScanEntry()
 
     #Load the contents of the bxh file into a dictionary
-    with open(bxh_file) as fd:
-        bxh_dict = xmltodict.parse(fd.read())
+    with trace.span('create_internal_info.parse_bxh', input_file=bxh_file):
+        with open(bxh_file) as fd:
+            bxh_dict = xmltodict.parse(fd.read())
     
     #Get the image file associated with the bxh
     image_to_copy = os.path.join(bxh_dir, bxh_dict['bxh']['datarec']['filename'])
@@ -966,30 +1160,35 @@ def auto_create_internal_info(bxh_file, events_files_dir, data_info, multi_bxh_i
     bxh_desc = bxh_dict['bxh']['acquisitiondata']['description']
 
     #Split the description to get scan type and various characteristics
-    desc_parts = bxh_desc.split('_')
+    desc_tokens = split_description(bxh_desc)
 
     #If the description is in the correct form, the parts should have
     #more than one entry.
-    if len(desc_parts) == 1:
+    if desc_tokens is None:
         logging.warning('bxh file description not in expected format!')
         logging.warning('bxh file: '+str(bxh_file))
         logging.warning('bxh description: '+str(bxh_desc))
         logging.warning('This bxh file will not be processed!')
         return multi_bxh_info_dict
 
-    this_entry_dict['scan_type'] = desc_parts[0]
-    this_entry_dict['scan_label'] = desc_parts[-1]
+    scan_type, scan_label, bids_labels = desc_tokens
+    this_entry_dict['scan_type'] = scan_type
+    this_entry_dict['scan_label'] = scan_label
+
+    #Stop here if the scan is not one of those selected
+    if not scan_filters.description_selected(scan_filter, scan_type, scan_label, bxh_desc):
+        logging.info('Excluded by scan filter: '+str(bxh_file))
+        return multi_bxh_info_dict
+
     this_entry_dict['sub'] = data_info['sub']
     this_entry_dict['ses'] = data_info['ses']
     this_entry_dict['bxh_desc'] = bxh_desc
     if 'IntendedFor' in data_info.keys():
         this_entry_dict['IntendedFor'] = data_info['IntendedFor']
 
-    #Look for potential BIDS file name labels and add them to the entry dictionary if they are there
-    for bids_label in ['task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo']:
-        for element in desc_parts[1:-1]:
-            if element.split('-')[0] == bids_label:
-                this_entry_dict[bids_label] = element.split('-')[-1]
+    #Add the BIDS file name labels found in the description to the entry dictionary
+    for bids_label, value in bids_labels:
+        this_entry_dict[bids_label] = value
 
     #Construct the output image file name
     naming_output = create_output_name(this_entry_dict)
@@ -1010,24 +1209,27 @@ def auto_create_internal_info(bxh_file, events_files_dir, data_info, multi_bxh_i
     this_entry_dict['output_prefix'] = "_".join(output_file_name.split('_')[:-1])
 
     #Add this bxh file's dictionary to the growing list.
-    #Unless it's not supported.
-    if this_entry_dict['scan_type'] in ['anat', 'func', 'dwi', 'fmap']:
+    #Unless it's not supported, or not selected.
+    if not scan_filters.entry_selected(scan_filter, bxh_file, this_entry_dict):
+        logging.info('Excluded by scan filter: '+str(bxh_file))
+    elif this_entry_dict['scan_type'] in ['anat', 'func', 'dwi', 'fmap']:
         multi_bxh_info_dict[bxh_name] = this_entry_dict
     
     return multi_bxh_info_dict
 
 
-def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
+def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict, scan_filter=None):
 
     #Directory and name of the bxh file
     bxh_dir, bxh_name = os.path.split(bxh_file)
     
-    #Create dictionary entry for this bxh file
-    this_entry_dict = {}
+    #Create the entry for this bxh file
+    this_entry_dict = ScanEntry()
 
     #Load the contents of the bxh file into a dictionary
-    with open(bxh_file) as fd:
-        bxh_dict = xmltodict.parse(fd.read())
+    with trace.span('create_internal_info.parse_bxh', input_file=bxh_file):
+        with open(bxh_file) as fd:
+            bxh_dict = xmltodict.parse(fd.read())
     
     #Get the image file associated with the bxh
     image_to_copy = os.path.join(bxh_dir, bxh_dict['bxh']['datarec']['filename'])
@@ -1053,16 +1255,13 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
     bxh_desc = bxh_dict['bxh']['acquisitiondata']['description']
     
     #Compare the description to those in the template file to determine type of scan
-    here = os.path.dirname(os.path.realpath(__file__))  #returns the dir in which THIS file is
-    template_file = os.path.join(here, 'info_field_files', 'psd_types.json')
-    with open(template_file) as fd:
-        template = json.loads(fd.read())
+    template = load_template(PSD_TYPES_FILE)
     #Make sure the scan description is in the template
     if bxh_desc not in template.keys():
         logging.error('Scan description not found in template file!')
         logging.error('Description: '+str(bxh_desc))
-        logging.error('Template File: '+str(template_file))
-        #add_to_psd_file.add_info(template_file, bxh_file, bxh_desc)
+        logging.error('Template File: '+str(PSD_TYPES_FILE))
+        #add_to_psd_file.add_info(PSD_TYPES_FILE, bxh_file, bxh_desc)
         raise RuntimeError('Scan description not found in template file!')
     
     #Store the BIDS scan type (func, anat, dwi, fmap),
@@ -1074,13 +1273,19 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
     this_entry_dict['ses'] = ses_dict['ses']
     this_entry_dict['bxh_desc'] = bxh_desc
 
+    #Stop here if the scan is not one of those selected
+    if not scan_filters.description_selected(scan_filter, this_entry_dict['scan_type'], scan_label, bxh_desc):
+        logging.info('Excluded by scan filter: '+str(bxh_file))
+        return multi_bxh_info_dict
+
     ##TODO: This section can probably be rewritten as a single function. The
     ##different "match" functions can also probably be combined into one.
 
     #If it is a functional image, match the acquisition number with
     #an entry in the session info. file/dictionary.
     if this_entry_dict['scan_type'] == 'func':
-        id_string = match_func(image_to_copy, ses_dict)
+        with trace.span('create_internal_info.match', modality='func'):
+            id_string = match_func(image_to_copy, ses_dict)
         for bids_label in ['task', 'acq', 'dir', 'rec', 'run', 'echo', 'tsv_file', 'ignore']:
             if bids_label in ses_dict['funcs'][id_string].keys():
                 this_entry_dict[bids_label] = ses_dict['funcs'][id_string][bids_label]
@@ -1089,7 +1294,8 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
     #with an entry in the session info. file/dictionary. NOTE: this is
     #not required for anatomical scans.
     elif this_entry_dict['scan_type'] == 'anat':
-        id_string = match_anat(image_to_copy, ses_dict)
+        with trace.span('create_internal_info.match', modality='anat'):
+            id_string = match_anat(image_to_copy, ses_dict)
         if id_string is not None:
             for bids_label in ['acq', 'ce', 'rec', 'run', 'mod', 'ignore']:
                 if bids_label in ses_dict['anats'][id_string].keys():
@@ -1102,7 +1308,8 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
                 this_entry_dict['rec'] = 'SC'
 
     elif this_entry_dict['scan_type'] == 'fmap':
-        id_string = match_fmap(image_to_copy, ses_dict)
+        with trace.span('create_internal_info.match', modality='fmap'):
+            id_string = match_fmap(image_to_copy, ses_dict)
         if id_string is not None:
             for bids_label in ['acq', 'ce', 'rec', 'dir', 'run', 'mod', 'IntendedFor', 'ignore']:
                 if bids_label in ses_dict['fmaps'][id_string].keys():
@@ -1111,7 +1318,8 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
                     ##.json file! It needs to be handled in create_dwi_json()!!!
 
     elif this_entry_dict['scan_type'] == 'dwi':
-        id_string = match_dwi(image_to_copy, ses_dict)
+        with trace.span('create_internal_info.match', modality='dwi'):
+            id_string = match_dwi(image_to_copy, ses_dict)
         if id_string is not None:
             for bids_label in ['acq', 'ce', 'rec', 'run', 'mod', 'ignore']:
                 if bids_label in ses_dict['dwis'][id_string].keys():
@@ -1141,6 +1349,9 @@ def create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict):
     if 'ignore' in this_entry_dict.keys():
         if this_entry_dict['ignore'] == 'yes':
             skip = 1
+    if not scan_filters.entry_selected(scan_filter, bxh_file, this_entry_dict):
+        logging.info('Excluded by scan filter: '+str(bxh_file))
+        skip = 1
 
     if skip == 0:
         multi_bxh_info_dict[bxh_name] = this_entry_dict
@@ -1185,16 +1396,18 @@ def compare_output_names(multi_bxh_info_dict):
     #output file name, try to fix this by including run numbers
     #in the name creation.
     logging.info('Making sure each output name is unique...')
+    #Index the entries by output name once, instead of comparing every pair;
+    #entries are read in place (no key lists or copies of the entries)
+    bxh_order = {}
+    name_index = {}
+    for bxh in multi_bxh_info_dict:
+        bxh_order[bxh] = len(bxh_order)
+        name_index.setdefault(multi_bxh_info_dict[bxh]['output_name'], []).append(bxh)
     for bxh in multi_bxh_info_dict:
-        #Entries for other files
-        other_list = []
-        for entry in multi_bxh_info_dict:
-            if entry != bxh:
-                other_list.append(entry)
         #Look for a repeated output name
         matching_list = [bxh]
-        for other_bxh in other_list:
-            if multi_bxh_info_dict[other_bxh]['output_name'] == multi_bxh_info_dict[bxh]['output_name']:
+        for other_bxh in name_index[multi_bxh_info_dict[bxh]['output_name']]:
+            if other_bxh != bxh:
                 matching_list.append(other_bxh)
                 logging.info('Found identical output file names!')
                 logging.info('First .bxh: '+str(bxh))
@@ -1203,12 +1416,13 @@ def compare_output_names(multi_bxh_info_dict):
         if len(matching_list) > 1:
             #Make sure run labels aren't already there
             for matching_bxh in matching_list:
-                if 'run' in multi_bxh_info_dict[matching_bxh].keys():
+                if 'run' in multi_bxh_info_dict[matching_bxh]:
                     logging.error('bxh files with conflicting output names have run labels in the bxh2bids session info file!')
                     logging.error('Check session info file to make sure there are not two acquisition numbers with identical entries!')
                     logging.error('Subject: '+str(multi_bxh_info_dict[bxh]['sub']))
                     logging.error('Session: '+str(multi_bxh_info_dict[bxh]['ses']))
-                    raise RuntimeError('Duplicate info in session file? Sub: '+str(bidsid)+'; Ses: '+str(sesid))
+                    raise RuntimeError('Duplicate info in session file? Sub: '+str(multi_bxh_info_dict[bxh]['sub'])+'; Ses: '+
+                                       str(multi_bxh_info_dict[bxh]['ses']))
             #Extract acquisition numbers from bxh file names
             logging.info('Extracting acquisition numbers from bxh file names...')
             num_list = []
@@ -1227,9 +1441,13 @@ def compare_output_names(multi_bxh_info_dict):
             #and save the new output name into the dictionary.
             for [bxh, run_label] in zip(matching_list, new_run_labels):
                 logging.info('Adding run number label to bxh: '+str(bxh))
+                name_index[multi_bxh_info_dict[bxh]['output_name']].remove(bxh)
                 multi_bxh_info_dict[bxh]['run'] = run_label
                 name_output = create_output_name(multi_bxh_info_dict[bxh])
                 multi_bxh_info_dict[bxh]['output_name'] = name_output[0]
+                renamed = name_index.setdefault(name_output[0], [])
+                renamed.append(bxh)
+                renamed.sort(key=bxh_order.get)
                 multi_bxh_info_dict[bxh]['output_prefix'] = name_output[1]
                 logging.info('Changing output file name for '+str(bxh)+' to '+str(multi_bxh_info_dict[bxh]['output_name']))
         else:
@@ -1238,39 +1456,6 @@ def compare_output_names(multi_bxh_info_dict):
     return multi_bxh_info_dict
 
 
-def __set_logging(dataid, log_dir):
-
-    logging.info('-----START: set_logging-----')
-    
-    #Make sure the passed log directory exists.
-    #If not, create it.
-    if not os.path.exists(log_dir):
-        print('Log file directory cannot be found!')
-        print('Creating it: '+str(log_dir))
-        os.makedirs(log_dir)
-
-    #Create log file
-    time_stamp = str(time.localtime()[1])+str(time.localtime()[2])+str(time.localtime()[0])+str(time.localtime()[3])+str(time.localtime()[4])
-
-    log_file = os.path.join(log_dir, 'bxh2bids_ses-'+str(dataid)+'_log_'+str(time_stamp)+'.txt')
-
-    if os.path.isfile(log_file):
-        raise RuntimeError('Log file already exists!?  They should be time-stamped down to the minute!')
-
-    logFormatter = logging.Formatter('%(levelname)s:%(asctime)s:%(message)s')
-    shortFormatter = logging.Formatter('%(levelname)s:%(message)s')
-    rootLogger = logging.getLogger()
-
-    rootLogger.setLevel(logging.INFO)
-
-    fileHandler = logging.FileHandler(log_file)
-    fileHandler.setFormatter(logFormatter)
-    fileHandler.setLevel(logging.INFO)
-    rootLogger.addHandler(fileHandler)
-    
-    logging.info('Created this log file.')
-
-
 def __find_bxh_files(input_dir):
 
     bxh_list = []
@@ -1286,12 +1471,12 @@ def __find_bxh_files(input_dir):
     return bxh_list
 
 
-def multi_autobxhtobids(dataid, data_info, source_study_dir, target_study_dir, events_files_dir, log_dir):
+def plan_auto_session(dataid, data_info, source_study_dir, events_files_dir, scan_filter=None):
 
-    __set_logging(dataid, log_dir)
+    #Find the bxh files for this session and build the conversion entry
+    #for each of them. Nothing is written by this function.
+    #Only the scans selected by scan_filter (see scan_filter.py) are planned.
 
-    logging.info('-----START: multi_bxhtobids-----')
-    
     #Make sure the passed study directory exists
     if not os.path.exists(source_study_dir):
         raise RuntimeError('Study directory cannot be found: ' + str(source_study_dir))
@@ -1305,72 +1490,30 @@ def multi_autobxhtobids(dataid, data_info, source_study_dir, target_study_dir, e
     if not os.path.exists(events_files_dir):
         raise RuntimeError('Events Files directory cannot be found: ' + str(events_files_dir))
 
-    #Record input arguments
-    bidsid = data_info['sub']
-    sesid = data_info['ses']
-
-    #Record input arguments
-    logging.info('--------------------------')
-    logging.info('dataid: '+str(dataid))
-    logging.info('bidsid: '+str(bidsid))
-    logging.info('sesid: '+str(sesid))
-    logging.info('source_study_dir: '+str(source_study_dir))
-    logging.info('events_files_dir: '+str(events_files_dir))
-    logging.info('target_study_dir: '+str(target_study_dir))
-    logging.info('log_dir: '+str(log_dir))
-
-    #Make sure dataid is in the format of a subject data directory
-    r = re.compile('^\d\d\d\d\d\d\d\d_\d\d\d\d\d$')
-    if r.match(dataid) is None:
-        raise RuntimeError('dataid does not look like a data directory: '+str(dataid))
-    
-    #Look for the data directories in the Anat and Func directories
-    anat_dir = os.path.join(source_study_dir, 'Data', 'Anat', dataid)
-    func_dir = os.path.join(source_study_dir, 'Data', 'Func', dataid)
-    if not os.path.exists(anat_dir):
-        logging.info('No anatomy data directory found for id: '+str(dataid))
-        anat_bxh_list = ['']
-    else:
-        anat_bxh_list = __find_bxh_files(anat_dir)
-
-    if not os.path.exists(func_dir):
-        logging.info('No functional data directory found for id: '+str(dataid))
-        func_bxh_list = ['']
-    else:
-        func_bxh_list = __find_bxh_files(func_dir)
-
-    bxh_list = anat_bxh_list + func_bxh_list
+    bxh_list = scan_filters.filter_bxh_list(scan_filter, find_session_bxh_files(dataid, source_study_dir))
 
     #Construct dictionaries with information about all the bxh files
     multi_bxh_info_dict = {}
     for file_item in bxh_list:
-        multi_bxh_info_dict = auto_create_internal_info(file_item['bxhfile'], events_files_dir, data_info, multi_bxh_info_dict)
+        with trace.span('create_internal_info', scan=os.path.split(file_item['bxhfile'])[-1], input_file=file_item['bxhfile']):
+            multi_bxh_info_dict = auto_create_internal_info(file_item['bxhfile'], events_files_dir, data_info, multi_bxh_info_dict,
+                                                            scan_filter=scan_filter)
 
     #Make sure the output file names are unique. If not, try to fix them.
     multi_bxh_info_dict = compare_output_names(multi_bxh_info_dict)
 
-    #Process bxh files
-    for file_item in bxh_list:
-        bxh_file_name = os.path.split(file_item['bxhfile'])[-1]
-        if bxh_file_name in multi_bxh_info_dict.keys():
-            logging.info('Running convert_bxh on: '+str(file_item['bxhfile']))
-            bxh_info_dict = multi_bxh_info_dict[bxh_file_name]
-            convert_bxh(file_item['bxhfile'], bxh_info_dict, target_study_dir=target_study_dir)
-        
-    #Create dataset_description.json if it does not already exist
-    logging.info('Running create_dataset_description().')
-    create_dataset_description(target_study_dir)
+    return bxh_list, multi_bxh_info_dict
 
-    logging.info('-----FINISH: multi_bxhtobids-----')
 
+def plan_session(dataid, ses_dict, source_study_dir, session_manifest=None, scan_filter=None):
 
-def multi_bxhtobids(dataid, ses_dict, source_study_dir, target_study_dir, log_dir):
-    
+    #Find the bxh files for this session and build the conversion entry
+    #for each of them. Nothing is written by this function.
+    #If a session manifest is passed and neither the bxh files, the session
+    #info nor psd_types.json have changed since it was written, the entries
+    #recorded in it are used instead of parsing every bxh file again.
+    #Only the scans selected by scan_filter (see scan_filter.py) are planned.
 
-    __set_logging(dataid, log_dir)
-
-    logging.info('-----START: multi_bxhtobids-----')
-    
     #Make sure the passed study directory exists
     if not os.path.exists(source_study_dir):
         raise RuntimeError('Study directory cannot be found: ' + str(source_study_dir))
@@ -1380,17 +1523,41 @@ def multi_bxhtobids(dataid, ses_dict, source_study_dir, target_study_dir, log_di
     if 'Data' not in contents:
         raise RuntimeError('The study directory does not appear as expected: ' + str(source_study_dir))
 
-    bidsid = ses_dict['sub']
-    sesid = ses_dict['ses']
+    bxh_list = find_session_bxh_files(dataid, source_study_dir)
 
-    #Record input arguments
-    logging.info('--------------------------')
-    logging.info('dataid: '+str(dataid))
-    logging.info('bidsid: '+str(bidsid))
-    logging.info('sesid: '+str(sesid))
-    logging.info('source_study_dir: '+str(source_study_dir))
-    logging.info('target_study_dir: '+str(target_study_dir))
-    logging.info('log_dir: '+str(log_dir))
+    if session_manifest is not None:
+        multi_bxh_info_dict = manifest.cached_plan(session_manifest, bxh_list, manifest.plan_key(ses_dict, PSD_TYPES_FILE))
+        if multi_bxh_info_dict is not None:
+            logging.info('Session unchanged since last run, using planned entries from manifest.')
+            if scan_filter is not None:
+                bxh_list = scan_filters.filter_bxh_list(scan_filter, bxh_list, ses_dict)
+                bxh_files = {os.path.split(item['bxhfile'])[-1]: item['bxhfile'] for item in bxh_list}
+                multi_bxh_info_dict = {bxh_name: entry for bxh_name, entry in multi_bxh_info_dict.items()
+                                       if bxh_name in bxh_files and scan_filters.entry_selected(scan_filter, bxh_files[bxh_name], entry)}
+            return bxh_list, multi_bxh_info_dict
+
+    bxh_list = scan_filters.filter_bxh_list(scan_filter, bxh_list, ses_dict)
+
+    #Construct dictionaries with information about all the bxh files
+    multi_bxh_info_dict = {}
+    for file_item in bxh_list:
+        with trace.span('create_internal_info', scan=os.path.split(file_item['bxhfile'])[-1], input_file=file_item['bxhfile']):
+            multi_bxh_info_dict = create_internal_info(file_item['bxhfile'], ses_dict, multi_bxh_info_dict, scan_filter=scan_filter)
+
+    #The output file name stored for each bxh file should be unique.
+    #If two of them are the same it means:
+    #   1) The same anatomical scan was run multiple times and there is no
+    #      information in the bxh2bids session info file about handling this.
+    #   2) Multiple entries in the "funcs" portion of the session info file
+    #      have the same task and run values.
+    
+    #Make sure the output file names are unique. If not, try to fix them.
+    multi_bxh_info_dict = compare_output_names(multi_bxh_info_dict)
+
+    return bxh_list, multi_bxh_info_dict
+
+
+def find_session_bxh_files(dataid, source_study_dir):
 
     #Make sure dataid is in the format of a subject data directory
     r = re.compile('^\d\d\d\d\d\d\d\d_\d\d\d\d\d$')
@@ -1412,37 +1579,705 @@ def multi_bxhtobids(dataid, ses_dict, source_study_dir, target_study_dir, log_di
     else:
         func_bxh_list = __find_bxh_files(func_dir)
 
-    bxh_list = anat_bxh_list + func_bxh_list
-    
-    #Construct dictionaries with information about all the bxh files
-    multi_bxh_info_dict = {}
-    for file_item in bxh_list:
-        multi_bxh_info_dict = create_internal_info(file_item['bxhfile'], ses_dict, multi_bxh_info_dict)
+    return anat_bxh_list + func_bxh_list
+
+
+def expected_outputs(bxh_file, bxh_info_dict, target_study_dir):
+
+    #Return the files convert_bxh() will write for this bxh file, as a list
+    #of [output file, source file] pairs. The source is the file the output
+    #is made from (image, BIAC json, events tsv, or the bxh itself).
+
+    scan_type = bxh_info_dict['scan_type']
+    if scan_type not in ['anat', 'func', 'dwi', 'fmap']:
+        return []
+
+    output_dir = output_dir_func(target_study_dir, bxh_info_dict, scan_type)
+    json_output = os.path.join(output_dir, bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label']+'.json')
+    json_source = bxh_info_dict.get('biac_json')
+    if json_source is None:
+        json_source = bxh_file
+
+    if scan_type == 'fmap' and bxh_info_dict['bxh_desc'] == 'ncanda-grefieldmap-v1':
+        fmap_part = bxh_info_dict['orig_image'].split('.nii')[0][-1]
+        b_label = {'1': 'magnitude', '2': 'real', '3': 'imaginary'}.get(fmap_part, fmap_part)
+        file_type = '.nii.gz' if bxh_info_dict['orig_image'][-3:] == '.gz' else '.nii'
+        image_output = os.path.join(output_dir, bxh_info_dict['output_prefix']+'_'+b_label+file_type)
+        return [[image_output, bxh_info_dict['orig_image']], [json_output, bxh_file]]
+
+    outputs = [[os.path.join(output_dir, bxh_info_dict['output_name']), bxh_info_dict['orig_image']],
+               [json_output, json_source]]
+
+    if scan_type == 'func' and 'tsv_file' in bxh_info_dict.keys():
+        outputs.append([os.path.join(output_dir, bxh_info_dict['output_prefix']+'_events.tsv'), bxh_info_dict['tsv_file']])
+
+    if scan_type == 'dwi':
+        outputs.append([os.path.join(output_dir, bxh_info_dict['output_prefix']+'_dwi.bval'), bxh_file])
+        outputs.append([os.path.join(output_dir, bxh_info_dict['output_prefix']+'_dwi.bvec'), bxh_file])
+
+    return outputs
+
+
+class Converter(object):
+
+    #Converts any number of sessions of one study. The study directories,
+    #execution settings and templates are set up once, when the Converter
+    #is made, instead of for every session:
+    #   source_study_dir, target_study_dir, log_dir - as for multi_bxhtobids()
+    #   manifest_dir     - where session manifests are kept (None: no manifests)
+    #   events_files_dir - events .tsv files of sessions described by data_info (convert_auto)
+    #   incremental, scan_filter, scan_jobs, memory_budget - as for multi_bxhtobids()
+    #   retry_policy     - how transient I/O errors are retried (retry.RetryPolicy)
+    #   log_level        - lowest level written to the session log files (e.g. logging.INFO)
+    #   trace_file       - JSON-lines file the time of each conversion stage is written to (see trace.py)
+    #   profile_prefix   - start of the names of the cProfile files sessions are profiled into (see profiling.py)
+    #   profile_scan     - with a profile_prefix, profile only the scan with this .bxh file name
+    #A scan that fails does not stop the others: the session is published
+    #without it, the failure is recorded in the manifest (so an incremental
+    #run tries the scan again) and ScanConversionError is raised at the end.
+    #The parsed templates are kept in self.templates; a template file that
+    #changes while the Converter is in use is read again.
+
+    def __init__(self, source_study_dir, target_study_dir, log_dir, manifest_dir=None, events_files_dir=None, incremental=False,
+                 scan_filter=None, scan_jobs=1, memory_budget=None, retry_policy=None, log_level=logging.INFO, trace_file=None,
+                 profile_prefix=None, profile_scan=None):
+        if incremental and manifest_dir is None:
+            raise RuntimeError('Incremental runs need a manifest_dir!')
+        self.source_study_dir = source_study_dir
+        self.target_study_dir = target_study_dir
+        self.log_dir = log_dir
+        self.manifest_dir = manifest_dir
+        self.events_files_dir = events_files_dir
+        self.incremental = incremental
+        self.scan_filter = scan_filter
+        self.scan_jobs = scan_jobs
+        self.memory_budget = memory_budget
+        self.retry_policy = retry.DEFAULT_POLICY if retry_policy is None else retry_policy
+        self.log_level = log_level
+        self.trace_file = trace_file
+        self.profile_prefix = profile_prefix
+        self.profile_scan = profile_scan
+        #Fail before the first session if a template is missing
+        self.templates = {}
+        for template_file in TEMPLATE_FILES:
+            self.templates[os.path.split(template_file)[-1]] = load_template(template_file)
+        if not os.path.exists(log_dir):
+            print('Log file directory cannot be found!')
+            print('Creating it: '+str(log_dir))
+            os.makedirs(log_dir, exist_ok=True)
+
+    def convert(self, dataid, ses_dict):
+
+        #Convert one session described by a session info dictionary
+        log_handler = self.__start_log(dataid)
+        trace_token = trace.open_trace(self.trace_file)
+        profile_token = profiling.open_profile(self.profile_prefix, self.profile_scan)
+        profiler = profiling.start_session_profile(dataid)
+        try:
+            logging.info('-----START: multi_bxhtobids-----')
+            self.__log_arguments(dataid, ses_dict)
+
+            session_manifest = None
+            if self.incremental:
+                session_manifest = manifest.read_session_manifest(self.manifest_dir, dataid)
+
+            bxh_list, multi_bxh_info_dict = self.retry_policy.call(plan_session, dataid, ses_dict, self.source_study_dir,
+                                                                   session_manifest=session_manifest, scan_filter=self.scan_filter)
+
+            #Process bxh files
+            scan_records = self.__convert_planned(dataid, bxh_list, multi_bxh_info_dict, session_manifest=session_manifest,
+                                                  key=manifest.plan_key(ses_dict, PSD_TYPES_FILE))
+
+            logging.info('-----FINISH: multi_bxhtobids-----')
+        finally:
+            #Later sessions in this process must not write to this session's log
+            profiling.stop_profile(profiler)
+            profiling.close_profile(profile_token)
+            trace.close_trace(trace_token)
+            self.__stop_log(log_handler)
+
+        return scan_records
+
+    def convert_auto(self, dataid, data_info):
+
+        #Convert one session whose scans are described by their bxh descriptions
+        log_handler = self.__start_log(dataid)
+        trace_token = trace.open_trace(self.trace_file)
+        profile_token = profiling.open_profile(self.profile_prefix, self.profile_scan)
+        profiler = profiling.start_session_profile(dataid)
+        try:
+            logging.info('-----START: multi_bxhtobids-----')
+            self.__log_arguments(dataid, data_info)
+            logging.info('events_files_dir: '+str(self.events_files_dir))
+
+            bxh_list, multi_bxh_info_dict = self.retry_policy.call(plan_auto_session, dataid, data_info, self.source_study_dir,
+                                                                   self.events_files_dir, scan_filter=self.scan_filter)
+
+            #Process bxh files
+            scan_records = self.__convert_planned(dataid, bxh_list, multi_bxh_info_dict)
+
+            logging.info('-----FINISH: multi_bxhtobids-----')
+        finally:
+            #Later sessions in this process must not write to this session's log
+            profiling.stop_profile(profiler)
+            profiling.close_profile(profile_token)
+            trace.close_trace(trace_token)
+            self.__stop_log(log_handler)
+
+        return scan_records
+
+    def __log_arguments(self, dataid, ses_dict):
+
+        #Record input arguments
+        logging.info('--------------------------')
+        logging.info('dataid: '+str(dataid))
+        logging.info('bidsid: '+str(ses_dict['sub']))
+        logging.info('sesid: '+str(ses_dict['ses']))
+        logging.info('source_study_dir: '+str(self.source_study_dir))
+        logging.info('target_study_dir: '+str(self.target_study_dir))
+        logging.info('log_dir: '+str(self.log_dir))
+
+    def __start_log(self, dataid):
+
+        #Lines are written by a background thread (see session_log.py)
+        log_handler = session_log.start_session_log(self.log_dir, dataid, level=self.log_level)
+        logging.info('Created this log file.')
+
+        return log_handler
+
+    def __stop_log(self, log_handler):
+
+        session_log.stop_session_log(log_handler)
+
+    def __convert_planned(self, dataid, bxh_list, multi_bxh_info_dict, session_manifest=None, key=None):
+
+        #Run convert_bxh() on every planned bxh file, then write the dataset
+        #description and (optionally) the session manifest.
+        #In incremental mode, scans the manifest shows have not changed since
+        #they were converted are skipped; changed scans, and scans that failed
+        #last time, are converted again and replace their old outputs when
+        #the session is published.
+        target_study_dir = self.target_study_dir
+        if self.incremental and session_manifest is None:
+            session_manifest = manifest.read_session_manifest(self.manifest_dir, dataid)
+        if session_manifest is None:
+            session_manifest = {'scans': {}}
+
+        #Decide which bxh files to convert
+        to_convert = []
+        replace = {}
+        previously_failed = manifest.failed_scans(session_manifest)
+        for file_item in bxh_list:
+            bxh_file_name = os.path.split(file_item['bxhfile'])[-1]
+            if bxh_file_name in multi_bxh_info_dict.keys():
+                outputs = expected_outputs(file_item['bxhfile'], multi_bxh_info_dict[bxh_file_name], target_study_dir)
+                if self.incremental:
+                    scan_manifest = session_manifest['scans'].get(bxh_file_name)
+                    if bxh_file_name in previously_failed:
+                        logging.info('Failed last time, converting again: '+str(file_item['bxhfile']))
+                    elif manifest.scan_unchanged(scan_manifest, outputs):
+                        logging.info('Unchanged since last run, skipping: '+str(file_item['bxhfile']))
+                        continue
+                    #What an earlier run wrote for this scan is replaced when the session is published
+                    replace[file_item['bxhfile']] = [output for output, source in outputs]
+                    if scan_manifest is not None:
+                        replace[file_item['bxhfile']] = replace[file_item['bxhfile']] + list(scan_manifest['outputs'])
+                to_convert.append([file_item['bxhfile'], multi_bxh_info_dict[bxh_file_name]])
+
+        failures = convert_session_scans(dataid, to_convert, target_study_dir, replace=replace, scan_jobs=self.scan_jobs,
+                                         memory_budget=self.memory_budget, retry_policy=self.retry_policy)
+
+        #Create dataset_description.json if it does not already exist
+        logging.info('Running create_dataset_description().')
+        create_dataset_description(target_study_dir)
+
+        scan_records = {}
+        if self.manifest_dir is not None:
+            logging.info('Writing session manifest.')
+            #The earlier records keep the hashes of unchanged sources
+            previous_manifest = session_manifest
+            if not self.incremental:
+                previous_manifest = manifest.read_session_manifest(self.manifest_dir, dataid) or {'scans': {}}
+            for bxh_file, bxh_info_dict in to_convert:
+                if bxh_file in failures:
+                    continue
+                bxh_file_name = os.path.split(bxh_file)[-1]
+                outputs = expected_outputs(bxh_file, bxh_info_dict, target_study_dir)
+                scan_records[bxh_file_name] = manifest.scan_record(bxh_file, outputs, bxh_info_dict,
+                                                                   previous=previous_manifest['scans'].get(bxh_file_name))
+            no_longer_planned = [bxh_name for bxh_name in session_manifest['scans'] if bxh_name not in multi_bxh_info_dict]
+            if self.scan_filter is not None:
+                #Only a part of the session was planned; keep the records of the
+                #scans that were not selected, and do not cache the plan.
+                selected = [os.path.split(item['bxhfile'])[-1] for item in bxh_list]
+                no_longer_planned = [bxh_name for bxh_name in no_longer_planned if bxh_name in selected]
+                key = None
+            if failures:
+                #The plan must be made again to retry the failed scans
+                key = None
+            failed_records = {os.path.split(bxh_file)[-1]: manifest.failure_record(bxh_file, failure) for bxh_file, failure in failures.items()}
+            self.retry_policy.call(manifest.update_session_manifest, self.manifest_dir, dataid, scan_records, remove=no_longer_planned,
+                                   key=key, bxh_list=bxh_list, failed=failed_records)
+
+        if failures:
+            raise ScanConversionError(dataid, failures)
+
+        return scan_records
+
+
+def multi_autobxhtobids(dataid, data_info, source_study_dir, target_study_dir, events_files_dir, log_dir, manifest_dir=None, incremental=False,
+                        scan_filter=None, scan_jobs=1, memory_budget=None):
+
+    converter = Converter(source_study_dir, target_study_dir, log_dir, manifest_dir=manifest_dir, events_files_dir=events_files_dir,
+                          incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs, memory_budget=memory_budget)
+    converter.convert_auto(dataid, data_info)
+
+
+def multi_bxhtobids(dataid, ses_dict, source_study_dir, target_study_dir, log_dir, manifest_dir=None, incremental=False, scan_filter=None,
+                    scan_jobs=1, memory_budget=None):
+
+    converter = Converter(source_study_dir, target_study_dir, log_dir, manifest_dir=manifest_dir, incremental=incremental,
+                          scan_filter=scan_filter, scan_jobs=scan_jobs, memory_budget=memory_budget)
+    converter.convert(dataid, ses_dict)
+
+
+def regenerate_sidecars(dataid, ses_dict, source_study_dir, target_study_dir, events=False, manifest_dir=None):
+
+    #Write again the sidecar files of every already-converted image in a
+    #session, using the current templates and the source .bxh files.
+    #Image files are left untouched. As in a conversion, the files are
+    #staged and then published under the subject lock, so a conversion of
+    #the same subject never sees them half written.
+
+    logging.info('-----START: regenerate_sidecars-----')
+
+    bxh_list, multi_bxh_info_dict = plan_session(dataid, ses_dict, source_study_dir)
+
+    session_manifest = None
+    if manifest_dir is not None:
+        session_manifest = manifest.read_session_manifest(manifest_dir, dataid)
+    if session_manifest is None:
+        session_manifest = {'scans': {}}
+
+    bxh_files = {os.path.split(file_item['bxhfile'])[-1]: file_item['bxhfile'] for file_item in bxh_list}
+    regenerated = []
+    with subject_lock(target_study_dir, str(ses_dict['sub'])):
+        stage_dir = session_staging_dir(target_study_dir, dataid)
+        if os.path.exists(stage_dir):
+            logging.warning('Removing staging directory left by an earlier run: '+str(stage_dir))
+            shutil.rmtree(stage_dir)
+        __make_staging_dir(stage_dir)
+        try:
+            for file_item in bxh_list:
+                bxh_file_name = os.path.split(file_item['bxhfile'])[-1]
+                if bxh_file_name in multi_bxh_info_dict.keys():
+                    logging.info('Running convert_sidecars on: '+str(file_item['bxhfile']))
+                    if convert_sidecars(file_item['bxhfile'], multi_bxh_info_dict[bxh_file_name], target_study_dir=target_study_dir,
+                                        events=events, stage_dir=stage_dir):
+                        regenerated.append(bxh_file_name)
+            publish_staged_session(stage_dir, target_study_dir)
+        finally:
+            __remove_staging_dir(stage_dir)
+
+    scan_records = {}
+    if manifest_dir is not None:
+        for bxh_file_name in regenerated:
+            outputs = expected_outputs(bxh_files[bxh_file_name], multi_bxh_info_dict[bxh_file_name], target_study_dir)
+            scan_records[bxh_file_name] = manifest.scan_record(bxh_files[bxh_file_name], outputs, multi_bxh_info_dict[bxh_file_name],
+                                                               previous=session_manifest['scans'].get(bxh_file_name))
+
+    if scan_records:
+        logging.info('Updating session manifest.')
+        manifest.update_session_manifest(manifest_dir, dataid, scan_records)
+
+    logging.info('-----FINISH: regenerate_sidecars-----')
+
+    return sorted(regenerated)
+
+
+#Staged files are flushed to disk this many at a time before publishing
+FSYNC_BATCH_SIZE = 64
+
+#Directory in a session's staging directory that keeps the outputs publishing overwrites
+PUBLISH_BACKUP_DIR = '.bxh2bids_replaced'
+
+
+@contextlib.contextmanager
+def subject_lock(target_study_dir, sub):
+
+    #Hold an exclusive lock on a subject while one of its sessions is
+    #published, so two sessions of one subject never write at the same time.
+    #Locks are files in TARGET_STUDY_DIR/.bxh2bids_locks/ and are released
+    #by the operating system if the process dies.
+    if fcntl is None:
+        yield
+        return
+
+    lock_dir = os.path.join(target_study_dir, '.bxh2bids_locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, 'sub-{}.lock'.format(sub)), 'w') as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info('Waiting for another session of subject {} to finish.'.format(sub))
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def session_staging_dir(target_study_dir, dataid):
+
+    #Outputs of a session are written here first. It is inside the target
+    #directory so publishing them is a rename on the same file system.
+    return os.path.join(target_study_dir, '.bxh2bids_staging', dataid)
+
+
+def convert_session_scans(dataid, to_convert, target_study_dir, replace=None, scan_jobs=1, memory_budget=None, retry_policy=None):
+
+    #Convert a list of [bxh file, bxh entry] pairs and publish them together.
+    #Every output is written to the session's staging directory first, and
+    #the scans that converted are then moved into the target directory, each
+    #file with an atomic rename. A scan that fails is left out (its staged
+    #files are removed) and the other scans keep going; the failed scans are
+    #returned as {bxh file: {'error', 'transient', 'attempts'}}.
+    #replace is {bxh file: [outputs]}; a scan's outputs listed there are
+    #removed once the session is published (see publish_staged_session()).
+    #Any other output that already exists and
+    #must not be overwritten (anat/dwi images and events files) fails the scan
+    #before copying.
+    #Transient I/O errors (see retry.py) are retried with backoff following
+    #retry_policy, for every scan and for every file that is published.
+    #If the session is cancelled, or publishing fails, the files published
+    #so far are rolled back, the staging directory is removed and the error
+    #is raised.
+    #With scan_jobs > 1, that many scans are converted at once in threads,
+    #largest source image first; copying and compressing images release the GIL.
+    #If a memory_budget (admission.MemoryBudget) is passed, a scan only
+    #starts while the estimated peak memory of the running scans fits in it.
+
+    failures = {}
+    if not to_convert:
+        return failures
+    if replace is None:
+        replace = {}
+    if retry_policy is None:
+        retry_policy = retry.DEFAULT_POLICY
+
+    with subject_lock(target_study_dir, to_convert[0][1]['sub']):
+        #An output of one scan may be replaced because another scan was renamed
+        all_replaced = set([output for outputs in replace.values() for output in outputs])
+        to_stage = []
+        for bxh_file, bxh_info_dict in to_convert:
+            existing = [output for output in protected_outputs(bxh_file, bxh_info_dict, target_study_dir)
+                        if os.path.exists(output) and output not in all_replaced]
+            if existing:
+                logging.error('Output file already exists: '+str(existing[0]))
+                failures[bxh_file] = {'error': 'Output file already exists: '+str(existing[0]), 'transient': False, 'attempts': 0}
+                __record_scan(bxh_file, bxh_info_dict, None, False, 0.0, 0)
+            else:
+                to_stage.append([bxh_file, bxh_info_dict])
+
+        stage_dir = session_staging_dir(target_study_dir, dataid)
+        if os.path.exists(stage_dir):
+            logging.warning('Removing staging directory left by an earlier run: '+str(stage_dir))
+            shutil.rmtree(stage_dir)
+        __make_staging_dir(stage_dir)
+        __notify('session_planned', dataid=dataid, scans=[bxh_file for bxh_file, bxh_info_dict in to_convert])
+
+        try:
+            if scan_jobs <= 1:
+                for bxh_file, bxh_info_dict in to_stage:
+                    failure = __convert_staged_scan(bxh_file, bxh_info_dict, stage_dir, retry_policy=retry_policy)
+                    if failure is not None:
+                        failures[bxh_file] = failure
+            elif to_stage:
+                scan_sizes = [[index, __image_size(bxh_info_dict['orig_image'])] for index, (bxh_file, bxh_info_dict) in enumerate(to_stage)]
+                scan_order = [to_stage[index] for index in scheduler.order_jobs(scan_sizes, 'lpt')]
+                with ThreadPoolExecutor(max_workers=scan_jobs) as executor:
+                    futures = {executor.submit(contextvars.copy_context().run, __convert_staged_scan, bxh_file, bxh_info_dict, stage_dir,
+                                               memory_budget, retry_policy): bxh_file
+                               for bxh_file, bxh_info_dict in scan_order}
+                    try:
+                        for future in as_completed(futures):
+                            failure = future.result()
+                            if failure is not None:
+                                failures[futures[future]] = failure
+                    except BaseException:
+                        #Do not start any more scans of a cancelled session
+                        for future in futures:
+                            future.cancel()
+                        raise
+            __check_cancelled()
+            published_replace = [output for bxh_file, bxh_info_dict in to_stage if bxh_file not in failures
+                                 for output in replace.get(bxh_file, [])]
+            publish_staged_session(stage_dir, target_study_dir, replace=published_replace, retry_policy=retry_policy)
+        except BaseException:
+            logging.error('Session failed, rolling back: '+str(dataid))
+            __remove_staging_dir(stage_dir)
+            raise
+        __notify('session_published', dataid=dataid, failed=sorted(failures))
+
+        __remove_staging_dir(stage_dir)
+
+    for bxh_file in sorted(failures):
+        logging.error('Scan not converted: {} ({})'.format(bxh_file, failures[bxh_file]['error']))
+
+    return failures
+
+
+def __image_size(image_file):
+
+    #A missing image fails only its own scan, when it is converted
+    try:
+        return os.path.getsize(image_file)
+    except OSError:
+        return 0
 
-    #The output file name stored for each bxh file should be unique.
-    #If two of them are the same it means:
-    #   1) The same anatomical scan was run multiple times and there is no
-    #      information in the bxh2bids session info file about handling this.
-    #   2) Multiple entries in the "funcs" portion of the session info file
-    #      have the same task and run values.
-    
-    #Make sure the output file names are unique. If not, try to fix them.
-    multi_bxh_info_dict = compare_output_names(multi_bxh_info_dict)
 
-    #Process bxh files
-    for file_item in bxh_list:
-        bxh_file_name = os.path.split(file_item['bxhfile'])[-1]
-        if bxh_file_name in multi_bxh_info_dict.keys():
-            logging.info('Running convert_bxh on: '+str(file_item['bxhfile']))
-            bxh_info_dict = multi_bxh_info_dict[bxh_file_name]
-            convert_bxh(file_item['bxhfile'], bxh_info_dict, target_study_dir=target_study_dir)
-        
-    #Create dataset_description.json if it does not already exist
-    logging.info('Running create_dataset_description().')
-    create_dataset_description(target_study_dir)
+def __convert_staged_scan(bxh_file, bxh_info_dict, stage_dir, memory_budget=None, retry_policy=None):
+
+    #Convert one scan into the staging directory. Returns None if it
+    #converted, or a description of the failure if it did not.
+    if retry_policy is None:
+        retry_policy = retry.DEFAULT_POLICY
+    token = current_scan.set(os.path.split(bxh_file)[-1])
+    profiler = profiling.start_scan_profile(bxh_file)
+    start = time.time()
+    attempt = 1
+    try:
+        __check_cancelled()
+        __notify('scan_started', bxh_file=bxh_file, output=bxh_info_dict['output_prefix']+'_'+bxh_info_dict['scan_label'])
+        while True:
+            try:
+                __convert_bxh_within_budget(bxh_file, bxh_info_dict, stage_dir, memory_budget)
+                break
+            except ConversionCancelled:
+                raise
+            except Exception as ex:
+                logging.exception('Converting {} failed.'.format(bxh_file))
+                #Start again from nothing, or leave nothing half-written
+                __remove_staged_outputs(bxh_file, bxh_info_dict, stage_dir)
+                if not retry_policy.retry_after(ex, attempt, 'convert_bxh'):
+                    __notify('scan_failed', bxh_file=bxh_file, seconds=time.time()-start, error=str(ex))
+                    __record_scan(bxh_file, bxh_info_dict, None, False, time.time()-start, attempt)
+                    return {'error': str(ex), 'transient': retry.is_transient(ex), 'attempts': attempt}
+                attempt = attempt+1
+                __check_cancelled()
+    except ConversionCancelled as ex:
+        __notify('scan_failed', bxh_file=bxh_file, seconds=time.time()-start, error=str(ex))
+        raise
+    finally:
+        profiling.stop_profile(profiler)
+        current_scan.reset(token)
+    __notify('scan_finished', bxh_file=bxh_file, seconds=time.time()-start, attempts=attempt)
+    __record_scan(bxh_file, bxh_info_dict, stage_dir, True, time.time()-start, attempt)
+
+    return None
+
+
+def __record_scan(bxh_file, bxh_info_dict, stage_dir, ok, seconds, attempts):
+
+    #Add a scan to scan_statistics, if it is collected. For a converted scan,
+    #bytes read are the sizes of its source files and bytes written those of
+    #its staged outputs; a failed scan counts no bytes.
+    statistics = scan_statistics.get()
+    if statistics is None:
+        return
+    bytes_read = 0
+    bytes_written = 0
+    if ok:
+        outputs = expected_outputs(bxh_file, bxh_info_dict, stage_dir)
+        bytes_read = sum([__image_size(source) for source in set([source for output, source in outputs]+[bxh_file])])
+        bytes_written = sum([__image_size(output) for output, source in outputs])
+    statistics.append({'bxh_file': bxh_file, 'modality': bxh_info_dict['scan_type'], 'ok': ok, 'seconds': seconds,
+                       'attempts': attempts, 'bytes_read': bytes_read, 'bytes_written': bytes_written})
+
+
+def __convert_bxh_within_budget(bxh_file, bxh_info_dict, stage_dir, memory_budget=None):
+
+    if memory_budget is None:
+        logging.info('Running convert_bxh on: '+str(bxh_file))
+        with trace.span('convert_bxh', modality=bxh_info_dict['scan_type'], input_file=bxh_info_dict['orig_image']):
+            convert_bxh(bxh_file, bxh_info_dict, target_study_dir=stage_dir)
+        return
+    import bxh2bids.estimate as estimate
+    disk_bytes, uncompressed_bytes = estimate.image_sizes(bxh_info_dict['orig_image'])
+    with memory_budget.reserve(admission.scan_peak_memory(uncompressed_bytes, bxh_info_dict['orig_image'][-3:] == '.gz')):
+        logging.info('Running convert_bxh on: '+str(bxh_file))
+        with trace.span('convert_bxh', modality=bxh_info_dict['scan_type'], input_file=bxh_info_dict['orig_image']):
+            convert_bxh(bxh_file, bxh_info_dict, target_study_dir=stage_dir)
+
+
+def __remove_staged_outputs(bxh_file, bxh_info_dict, stage_dir):
+
+    for output, source in expected_outputs(bxh_file, bxh_info_dict, stage_dir):
+        if os.path.exists(output):
+            os.remove(output)
+
+
+def __make_staging_dir(stage_dir):
+
+    #Another session may remove the shared staging directory between
+    #creating it and creating this session's directory inside it
+    for attempt in range(3):
+        try:
+            os.makedirs(stage_dir)
+            return
+        except FileNotFoundError:
+            continue
+    os.makedirs(stage_dir)
+
+
+def __remove_staging_dir(stage_dir):
+
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    #Remove the shared staging directory too once no session is using it
+    try:
+        os.rmdir(os.path.dirname(stage_dir))
+    except OSError:
+        pass
+
+
+def protected_outputs(bxh_file, bxh_info_dict, target_study_dir):
+
+    #Outputs convert_bxh() has always refused to overwrite
+    outputs = [output for output, source in expected_outputs(bxh_file, bxh_info_dict, target_study_dir)]
+    if not outputs:
+        return []
+    if bxh_info_dict['scan_type'] in ['anat', 'dwi']:
+        return [outputs[0]]
+    if bxh_info_dict['scan_type'] == 'fmap' and bxh_info_dict['bxh_desc'] == 'ncanda-grefieldmap-v1':
+        return [outputs[0]]
+    if bxh_info_dict['scan_type'] == 'func':
+        return [output for output in outputs if output[-11:] == '_events.tsv']
+    return []
+
+
+def __fsync_files(file_list):
+
+    #Flush files, then the directories holding them, in batches
+    for batch_start in range(0, len(file_list), FSYNC_BATCH_SIZE):
+        batch = file_list[batch_start:batch_start+FSYNC_BATCH_SIZE]
+        for file_name in batch:
+            fd = os.open(file_name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for dir_name in set([os.path.dirname(file_name) for file_name in batch]):
+            __fsync_dir(dir_name)
+
+
+def __fsync_dir(dir_name):
+
+    try:
+        fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        #Not every file system allows syncing a directory
+        pass
+    finally:
+        os.close(fd)
+
+
+def publish_staged_session(stage_dir, target_study_dir, replace=(), retry_policy=None):
+
+    #Move every file in the staging directory to the same place under the
+    #target directory. Transient I/O errors are retried following retry_policy.
+    #An output that is overwritten is first hard-linked into the staging
+    #directory; if a rename fails, every file published so far is put back
+    #as it was (or removed if it is new) and the error is raised, so the
+    #target directory is left as it was before. Only once every file is in
+    #place are the outputs in replace that were not overwritten removed.
+    if retry_policy is None:
+        retry_policy = retry.DEFAULT_POLICY
+    staged_files = []
+    for dir_name, sub_dirs, file_names in os.walk(stage_dir):
+        for file_name in file_names:
+            staged_files.append(os.path.join(dir_name, file_name))
+
+    logging.info('Flushing {} staged files to disk.'.format(len(staged_files)))
+    with trace.span('publish.fsync') as fsync_span:
+        fsync_span['files'] = len(staged_files)
+        retry_policy.call(__fsync_files, staged_files)
+
+    backup_dir = os.path.join(stage_dir, PUBLISH_BACKUP_DIR)
+    #[final file, backup of the file it replaced or None]
+    published = []
+    published_dirs = set()
+    with trace.span('publish.rename') as rename_span:
+        rename_span['files'] = len(staged_files)
+        try:
+            for staged_file in staged_files:
+                final_file = os.path.join(target_study_dir, os.path.relpath(staged_file, stage_dir))
+                final_dir = os.path.dirname(final_file)
+                if final_dir not in published_dirs:
+                    retry_policy.call(os.makedirs, final_dir, exist_ok=True)
+                    published_dirs.add(final_dir)
+                backup_file = None
+                if os.path.exists(final_file):
+                    backup_file = os.path.join(backup_dir, os.path.relpath(staged_file, stage_dir))
+                    retry_policy.call(__keep_copy, final_file, backup_file)
+                logging.info('Publishing: '+str(final_file))
+                retry_policy.call(os.replace, staged_file, final_file)
+                published.append([final_file, backup_file])
+        except BaseException:
+            __roll_back_published(published)
+            raise
+
+        for dir_name in published_dirs:
+            __fsync_dir(dir_name)
+
+    published_files = set([final_file for final_file, backup_file in published])
+    for old_output in replace:
+        if old_output in published_files or not os.path.exists(old_output):
+            continue
+        logging.info('Removing old output: '+str(old_output))
+        try:
+            retry_policy.call(__remove_if_exists, old_output)
+        except OSError as ex:
+            #The session is already published; the file is left for reconcile to report
+            logging.error('Could not remove old output {}: {}'.format(old_output, ex))
+
+
+def __keep_copy(file_name, backup_file):
+
+    #A hard link keeps the old contents when the file is replaced, without copying them
+    os.makedirs(os.path.dirname(backup_file), exist_ok=True)
+    __remove_if_exists(backup_file)
+    try:
+        os.link(file_name, backup_file)
+    except OSError:
+        shutil.copy2(file_name, backup_file)
+
+
+def __roll_back_published(published):
+
+    logging.error('Publishing failed; restoring {} published file(s).'.format(len(published)))
+    for final_file, backup_file in reversed(published):
+        try:
+            if backup_file is None:
+                __remove_if_exists(final_file)
+            else:
+                os.replace(backup_file, final_file)
+        except OSError as ex:
+            logging.error('Could not restore {}: {}'.format(final_file, ex))
+
+
+def __remove_if_exists(file_name):
+
+    #A retried remove may find the file already gone
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
 
-    logging.info('-----FINISH: multi_bxhtobids-----')
-        
 if __name__ == '__main__':
     ###TODO: handle input arguments
     #Check to make sure they're strings
@@ -45,6 +45,90 @@ Example Usage:
 
         bxh2bids --proj-dir /path/bids_dir --biac-dirs 01011900_12345 01021900_56789
 
+
+    Convert many sessions, eight at a time.
+
+        bxh2bids --jobs 8 --biac-dirs 01011900_12345 01021900_56789 ...
+
+    Or let bxh2bids find the number that converts the most data per second.
+
+        bxh2bids --jobs auto --biac-dirs 01011900_12345 01021900_56789 ...
+
+
+    Re-run a session after adding a forgotten scan, converting only new
+    or changed scans.
+
+        bxh2bids --incremental --biac-dirs 01011900_12345
+
+
+    Convert only acquisition 005 of two sessions, or only their
+    functional scans for the "faces" task.
+
+        bxh2bids --acquisitions 005 --biac-dirs 01011900_12345 01021900_56789
+        bxh2bids --scan-types func --tasks faces --biac-dirs 01011900_12345 01021900_56789
+
+
+Other Commands:
+
+    bxh2bids auto --table sessions.tsv [--jobs N] [--check]
+        Convert every session listed in a .csv/.tsv table (columns
+        dataid, sub, ses and optionally IntendedFor) from its scan
+        descriptions, as multi_autobxhtobids() does, with the same
+        options as a normal conversion. The whole table, and every
+        session in it, is checked before anything is converted.
+
+    bxh2bids check --biac-dirs ... [--incremental]
+        Check session info files, scan descriptions, events files,
+        image paths and output names for every session, without
+        converting anything. (These checks also run before every
+        conversion unless --skip-preflight is passed.)
+
+    bxh2bids estimate [--biac-dirs ...] [--jobs N] [--calibrate]
+        Estimate the size of the converted data, the free space left on
+        the target file system and the run time. A conversion does not
+        start if the data would not fit.
+
+    bxh2bids reconcile [--biac-dirs ...] [--repair] [--remove-extra]
+        Compare the BIDS data on disk with what a conversion would
+        produce, without copying anything. With no --biac-dirs, every
+        session with a session info file is checked.
+
+    bxh2bids queue add [--biac-dirs ...] [--incremental]
+    bxh2bids queue status
+    bxh2bids worker [--jobs N] [--scan-jobs N] [--forever]
+        Convert sessions on several nodes that share the project file
+        system. "queue add" puts sessions in derivatives/bxh2bids_queue/;
+        every "bxh2bids worker", on any node, takes sessions from it
+        until it is empty. Sessions of workers that stop sending
+        heartbeats are queued again. "queue status" shows the queue.
+
+    bxh2bids serve [--jobs N] [--socket PATH] [--status] [--stop]
+        Run a daemon whose worker processes keep bxh2bids loaded, and
+        convert sessions it is sent over a Unix socket. Submit sessions
+        with the usual command and --daemon:
+            bxh2bids --daemon --biac-dirs 01011900_12345
+
+    bxh2bids sidecars [--biac-dirs ...] [--events] [--jobs N]
+        Write again the sidecar .json, .bvec and .bval files (and, with
+        --events, the events .tsv files) of already-converted images
+        from their source .bxh files. Image files are not touched.
+
+    bxh2bids trace summarize [TRACE_FILE ...]
+        Print percentiles of the wall and CPU time, and the bytes read
+        and written, of every conversion stage (parsing .bxh files,
+        reading and writing images, writing sidecars, publishing), for
+        all scans and per modality. Every conversion writes these
+        timings to bxh2bids_trace_*.jsonl in the log directory (unless
+        --no-trace is passed); by default the latest file is used.
+
+    bxh2bids watch [--quiet-seconds S] [--queue]
+        Convert sessions as they arrive in sourcedata/Data/Anat|Func/.
+        A session is converted once its session info file exists and
+        its files have not changed for S seconds, and converted again
+        (incrementally) if it changes later. The time from arrival to
+        conversion is written to bxh2bids_watch_latency.tsv in the log
+        directory.
+
 """
 
 # %%
@@ -54,23 +138,337 @@ import textwrap
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 # %%
+def _add_proj_dir_arg(parser):
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        type=str,
+        default='None',
+        help=textwrap.dedent(
+            """\
+            Path to BIDS-formatted project directory
+            """
+        ),
+    )
+
+
+def _add_scan_filter_args(parser):
+    filter_args = parser.add_argument_group("Scan Filters")
+    filter_args.add_argument(
+        "--scan-types",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Only convert these BIDS scan types (anat, func, dwi, fmap).
+            """
+        ),
+        type=str,
+    )
+    filter_args.add_argument(
+        "--labels",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Only convert these BIDS scan labels (e.g. T1w bold).
+            """
+        ),
+        type=str,
+    )
+    filter_args.add_argument(
+        "--tasks",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Only convert scans with these task labels.
+            """
+        ),
+        type=str,
+    )
+    filter_args.add_argument(
+        "--acquisitions",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Only convert these BIAC acquisition numbers (e.g. 005 or 005_01).
+            """
+        ),
+        type=str,
+    )
+    filter_args.add_argument(
+        "--desc-regex",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Only convert scans whose description matches this regular
+            expression.
+            """
+        ),
+        type=str,
+    )
+
+
+def _scan_filter_kwargs(args):
+    return {"scan_types": args.scan_types, "labels": args.labels, "tasks": args.tasks,
+            "acquisitions": args.acquisitions, "desc_regex": args.desc_regex}
+
+
+def _scan_filter(args):
+    import bxh2bids.scan_filter as scan_filters
+    return scan_filters.make_scan_filter(**_scan_filter_kwargs(args))
+
+
+def _retry_policy(args):
+    import bxh2bids.retry as retry
+    return retry.RetryPolicy(retries=args.retries, delay=args.retry_delay)
+
+
+def _log_level(args):
+    import bxh2bids.session_log as session_log
+    return session_log.LOG_LEVELS[args.log_level]
+
+
+def _add_socket_arg(parser):
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Unix socket of the bxh2bids daemon
+            (default: bxh2bids-<uid>.sock in the temporary directory).
+            """
+        ),
+        type=str,
+    )
+
+
+def _add_metrics_args(parser):
+    import bxh2bids.metrics as metrics
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            Write Prometheus metrics (sessions and scans converted or
+            failed, bytes read and written, durations per modality,
+            queue depth, active workers) to this file, e.g. a .prom file
+            in node_exporter's textfile collector directory.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        default=metrics.DEFAULT_INTERVAL,
+        help=textwrap.dedent(
+            """\
+            Seconds between writes of the metrics file (default: {}).
+            """.format(metrics.DEFAULT_INTERVAL)
+        ),
+        type=float,
+    )
+
+
+def _jobs_arg(value):
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def _add_conversion_args(parser):
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Skip scans that have not changed since they were last
+            converted (according to the session manifest) and convert
+            only new or changed scans.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--skip-preflight",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Do not check every session before converting the batch.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of sessions to convert at once, each in its own
+            process (default: 1). With "auto", the number is adjusted
+            while the batch runs to get the most data converted per
+            second; every change is logged.
+            """
+        ),
+        type=_jobs_arg,
+    )
+
+    parser.add_argument(
+        "--scan-jobs",
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of scans of each session to convert at once
+            (default: 1).
+            """
+        ),
+        type=int,
+    )
+
+    parser.add_argument(
+        "--schedule",
+        default="lpt",
+        choices=["fifo", "lpt"],
+        help=textwrap.dedent(
+            """\
+            Order to convert sessions in: "lpt" (default) starts the
+            largest sessions first, "fifo" keeps the --biac-dirs order.
+            The expected and achieved run times are printed at the end.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--memory-budget",
+        help=textwrap.dedent(
+            """\
+            Memory, in GiB, that sessions and scans converted at once may
+            use together (default: half of the available memory). Work
+            that does not fit waits for running conversions to finish.
+            """
+        ),
+        type=float,
+    )
+
+    parser.add_argument(
+        "--retries",
+        default=3,
+        help=textwrap.dedent(
+            """\
+            Times a read or write that fails with a transient I/O error
+            (EIO, ESTALE, timeouts, e.g. on NFS) is tried again (default:
+            3). A scan that still fails is left out; the rest of its
+            session is converted and --incremental retries it later.
+            """
+        ),
+        type=int,
+    )
+
+    parser.add_argument(
+        "--retry-delay",
+        default=1.0,
+        help=textwrap.dedent(
+            """\
+            Seconds to wait before the first retry (default: 1); every
+            further retry waits twice as long.
+            """
+        ),
+        type=float,
+    )
+
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help=textwrap.dedent(
+            """\
+            Lowest level of the lines written to the session log files
+            (default: INFO). WARNING keeps only problems, and writes
+            much less to the log directory.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--no-trace",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Do not write the time of each conversion stage to a
+            bxh2bids_trace_*.jsonl file in the log directory.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Profile every session with cProfile (in worker processes
+            too) and write the profiles to bxh2bids_profile_*.pstats
+            files in the log directory. Scans run in other threads
+            (--scan-jobs) are not in a session's profile; use
+            --scan-jobs 1, or --profile-scan.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--profile-scan",
+        help=textwrap.dedent(
+            """\
+            Profile only the conversion of this scan, given by the name
+            of its .bxh file (e.g. bia5_12345_005.bxh).
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        help=textwrap.dedent(
+            """\
+            Print the N functions with the most cumulative time over
+            all the profiles at the end (implies --profile).
+            """
+        ),
+    )
+
+    _add_metrics_args(parser)
+
+
 def _get_args():
     """Get and parse arguments."""
     parser = ArgumentParser(
         description=__doc__, formatter_class=RawTextHelpFormatter
     )
 
+    _add_proj_dir_arg(parser)
+
+    _add_conversion_args(parser)
+
     parser.add_argument(
-        "-p",
-        "--proj-dir",
-        type=str,
-        default='None',
+        "--daemon",
+        action="store_true",
         help=textwrap.dedent(
             """\
-            Path to BIDS-formatted project directory
+            Submit the sessions to a running "bxh2bids serve" daemon and
+            wait for them, instead of converting them in this process.
+            --incremental, --scan-jobs, --retries, --retry-delay,
+            --log-level and the scan filters are passed on; the daemon's
+            own options set its workers and metrics. Daemon jobs are not
+            pre-flight checked or traced.
             """
         ),
     )
+    _add_socket_arg(parser)
+
+    _add_scan_filter_args(parser)
 
     required_args = parser.add_argument_group("Required Arguments")
     required_args.add_argument(
@@ -94,16 +492,56 @@ def _get_args():
     return parser
 
 
-# %%
-def main():
-    """Setup working environment."""
+def _get_reconcile_args():
+    """Get and parse arguments for the reconcile command."""
+    parser = ArgumentParser(
+        prog="bxh2bids reconcile",
+        description="Compare BIDS data on disk with what a conversion would produce.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-b",
+        "--biac-dirs",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            BIAC directory IDs to check, in the form of MMDDYYYY_#####.
+            If not passed, every session with a session info file is checked.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Convert again only the scans with missing, stale or renamed outputs.
+            """
+        ),
+    )
+    parser.add_argument(
+        "--remove-extra",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            With --repair, also delete files an earlier conversion of the
+            session wrote (according to its manifest) that it no longer
+            produces. Files no manifest of the session records, or that
+            another session's manifest records, are never deleted.
+            """
+        ),
+    )
+
+    return parser
 
-    # Capture CLI arguments
-    args = _get_args().parse_args()
-    biac_dirs = args.biac_dirs
-    proj_dir = args.proj_dir
 
-    # Check proj_dir. If not passed, check for env variable.
+def _check_proj_dir(proj_dir):
+    """Check proj_dir. If not passed, check for env variable."""
     if proj_dir == 'None':
         try:
             proj_dir = os.environ["BIDS_DIR"]
@@ -114,8 +552,678 @@ def main():
     if not os.path.exists(proj_dir):
         raise FileNotFoundError(f"Expected to find project directory : {proj_dir}")
 
+    return proj_dir
+
+
+def reconcile_main(argv):
+    """Run the reconcile command."""
+    args = _get_reconcile_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.run_bxh2bids as rb2b
+    rb2b.reconcile(proj_dir, args.biac_dirs, repair=args.repair, remove_extra=args.remove_extra)
+
+
+def _get_sidecars_args():
+    """Get and parse arguments for the sidecars command."""
+    parser = ArgumentParser(
+        prog="bxh2bids sidecars",
+        description="Regenerate sidecar files of already-converted images.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-b",
+        "--biac-dirs",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            BIAC directory IDs to process, in the form of MMDDYYYY_#####.
+            If not passed, every session with a session info file is processed.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "--events",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Also copy the events .tsv files of functional runs again.
+            """
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of sessions to process at the same time.
+            """
+        ),
+    )
+
+    return parser
+
+
+def sidecars_main(argv):
+    """Run the sidecars command."""
+    args = _get_sidecars_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.run_bxh2bids as rb2b
+    rb2b.regenerate_sidecars(proj_dir, args.biac_dirs, events=args.events, jobs=args.jobs)
+
+
+def _get_check_args():
+    """Get and parse arguments for the check command."""
+    parser = ArgumentParser(
+        prog="bxh2bids check",
+        description="Run pre-flight checks on sessions without converting them.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-b",
+        "--biac-dirs",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            BIAC directory IDs to check, in the form of MMDDYYYY_#####.
+            If not passed, every session with a session info file is checked.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Check as for an incremental run (existing outputs are allowed).
+            """
+        ),
+    )
+
+    _add_scan_filter_args(parser)
+
+    return parser
+
+
+def check_main(argv):
+    """Run the check command."""
+    args = _get_check_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.run_bxh2bids as rb2b
+    biac_dirs = args.biac_dirs
+    if biac_dirs is None:
+        biac_dirs = rb2b.find_study_sessions(proj_dir)
+    if not rb2b.check(proj_dir, biac_dirs, incremental=args.incremental, scan_filter=_scan_filter(args)):
+        sys.exit(1)
+
+
+def _get_estimate_args():
+    """Get and parse arguments for the estimate command."""
+    parser = ArgumentParser(
+        prog="bxh2bids estimate",
+        description="Estimate output size, free space and run time for a batch.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-b",
+        "--biac-dirs",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            BIAC directory IDs to estimate, in the form of MMDDYYYY_#####.
+            If not passed, every session with a session info file is used.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Only count scans an incremental run would convert.
+            """
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of sessions converted at once (default: 1).
+            """
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of scans of each session converted at once (default: 1).
+            """
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--schedule",
+        default="lpt",
+        choices=["fifo", "lpt"],
+        help=textwrap.dedent(
+            """\
+            Order sessions are converted in (default: lpt, largest first).
+            """
+        ),
+    )
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Convert a few images into a temporary directory on the target
+            file system first, and save the measured throughput and
+            compression ratio for later estimates.
+            """
+        ),
+    )
+
+    _add_scan_filter_args(parser)
+
+    return parser
+
+
+def estimate_main(argv):
+    """Run the estimate command."""
+    args = _get_estimate_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.run_bxh2bids as rb2b
+    biac_dirs = args.biac_dirs
+    if biac_dirs is None:
+        biac_dirs = rb2b.find_study_sessions(proj_dir)
+    batch_estimate = rb2b.estimate(proj_dir, biac_dirs, jobs=args.jobs, incremental=args.incremental,
+                                   calibrate=args.calibrate, scan_filter=_scan_filter(args), scan_jobs=args.scan_jobs,
+                                   strategy=args.schedule)
+    if not batch_estimate['fits']:
+        sys.exit(1)
+
+
+def _get_auto_args():
+    """Get and parse arguments for the auto command."""
+    parser = ArgumentParser(
+        prog="bxh2bids auto",
+        description="Convert the sessions listed in a session table from their scan descriptions.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-t",
+        "--table",
+        required=True,
+        help=textwrap.dedent(
+            """\
+            .csv or .tsv file with one row per session and the columns
+            dataid, sub, ses and (optionally) IntendedFor; several
+            IntendedFor targets are separated with ";". Events .tsv
+            files are read from code/bxh2bids_ses_info/.
+            """
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Only check the table and its sessions; convert nothing.
+            """
+        ),
+    )
+
+    _add_conversion_args(parser)
+    _add_scan_filter_args(parser)
+
+    return parser
+
+
+def auto_main(argv):
+    """Run the auto command."""
+    args = _get_auto_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.run_bxh2bids as rb2b
+    if args.check:
+        import bxh2bids.session_table as session_table
+        data_infos, problems = session_table.read_session_table(args.table)
+        if problems:
+            print(session_table.format_problems(problems))
+            sys.exit(1)
+        if not rb2b.check(proj_dir, list(data_infos), incremental=args.incremental, scan_filter=_scan_filter(args),
+                          data_infos=data_infos):
+            sys.exit(1)
+        return
+
+    results = rb2b.bidsify_table(proj_dir, args.table, incremental=args.incremental, preflight=not args.skip_preflight,
+                                 scan_filter=_scan_filter(args), jobs=args.jobs, scan_jobs=args.scan_jobs,
+                                 strategy=args.schedule,
+                                 memory_budget=None if args.memory_budget is None else int(args.memory_budget*2**30),
+                                 retry_policy=_retry_policy(args), log_level=_log_level(args), trace=not args.no_trace,
+                                 metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                                 profile=args.profile, profile_scan=args.profile_scan, profile_top=args.profile_top)
+    if not all([result["ok"] for result in results]):
+        sys.exit(1)
+
+
+def _get_trace_args():
+    """Get and parse arguments for the trace command."""
+    parser = ArgumentParser(
+        prog="bxh2bids trace",
+        description="Summarize the stage timings written by conversion runs.",
+        formatter_class=RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    summarize_parser = subparsers.add_parser(
+        "summarize",
+        help="Percentiles of the time of each stage, per stage and per modality.",
+        formatter_class=RawTextHelpFormatter,
+    )
+    _add_proj_dir_arg(summarize_parser)
+    summarize_parser.add_argument(
+        "trace_files",
+        nargs="*",
+        help=textwrap.dedent(
+            """\
+            bxh2bids_trace_*.jsonl files to summarize together. If none
+            is passed, the latest one in the project's log directory is used.
+            """
+        ),
+    )
+
+    return parser
+
+
+def trace_main(argv):
+    """Run the trace command."""
+    args = _get_trace_args().parse_args(argv)
+
+    import bxh2bids.trace as trace
+    trace_files = args.trace_files
+    if not trace_files:
+        proj_dir = _check_proj_dir(args.proj_dir)
+        import bxh2bids.run_bxh2bids as rb2b
+        log_dir = rb2b._study_dirs(proj_dir)["log_dir"]
+        latest = trace.latest_trace_file(log_dir)
+        if latest is None:
+            print("No trace files found in: {}".format(log_dir))
+            sys.exit(1)
+        trace_files = [latest]
+    records = trace.read_trace(trace_files)
+    print("{} spans from {}".format(len(records), ", ".join(trace_files)))
+    print(trace.format_summary(trace.summarize(records)))
+
+
+def _get_queue_args():
+    """Get and parse arguments for the queue command."""
+    parser = ArgumentParser(
+        prog="bxh2bids queue",
+        description="Add sessions to the shared work queue, or show its status.",
+        formatter_class=RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    add_parser = subparsers.add_parser(
+        "add",
+        help="Queue sessions for bxh2bids worker processes.",
+        formatter_class=RawTextHelpFormatter,
+    )
+    _add_proj_dir_arg(add_parser)
+    add_parser.add_argument(
+        "-b",
+        "--biac-dirs",
+        nargs="+",
+        default=None,
+        help=textwrap.dedent(
+            """\
+            BIAC directory IDs to queue, in the form of MMDDYYYY_#####.
+            If not passed, every session with a session info file is queued.
+            """
+        ),
+        type=str,
+    )
+    add_parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Convert only new or changed scans of the queued sessions.
+            """
+        ),
+    )
+    _add_scan_filter_args(add_parser)
+
+    status_parser = subparsers.add_parser(
+        "status",
+        help="Show pending, leased, done and failed sessions.",
+        formatter_class=RawTextHelpFormatter,
+    )
+    _add_proj_dir_arg(status_parser)
+    _add_lease_arg(status_parser)
+
+    return parser
+
+
+def _add_lease_arg(parser):
+    import bxh2bids.work_queue as work_queue
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=work_queue.DEFAULT_LEASE_SECONDS,
+        help=textwrap.dedent(
+            """\
+            Seconds without a heartbeat after which a worker is taken to
+            have died and its session is queued again (default: {}).
+            """.format(work_queue.DEFAULT_LEASE_SECONDS)
+        ),
+    )
+
+
+def queue_main(argv):
+    """Run the queue command."""
+    args = _get_queue_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.work_queue as work_queue
+    if args.action == "add":
+        biac_dirs = args.biac_dirs
+        if biac_dirs is None:
+            import bxh2bids.run_bxh2bids as rb2b
+            biac_dirs = rb2b.find_study_sessions(proj_dir)
+        filter_args = _scan_filter_kwargs(args)
+        work_queue.add_sessions(proj_dir, biac_dirs, incremental=args.incremental,
+                                filter_args=filter_args if _scan_filter(args) is not None else None)
+    else:
+        print(work_queue.format_status(work_queue.queue_status(proj_dir, lease_seconds=args.lease_seconds)))
+
+
+def _get_worker_args():
+    """Get and parse arguments for the worker command."""
+    import bxh2bids.work_queue as work_queue
+    parser = ArgumentParser(
+        prog="bxh2bids worker",
+        description="Convert sessions from the shared work queue.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of worker processes to run on this node (default: 1).
+            """
+        ),
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of scans of each session to convert at once (default: 1).
+            """
+        ),
+    )
+    _add_lease_arg(parser)
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=work_queue.DEFAULT_POLL_SECONDS,
+        help=textwrap.dedent(
+            """\
+            Seconds to wait before looking at the queue again when no
+            session is pending (default: {}).
+            """.format(work_queue.DEFAULT_POLL_SECONDS)
+        ),
+    )
+    parser.add_argument(
+        "--forever",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Keep waiting for new sessions instead of exiting once the
+            queue is empty.
+            """
+        ),
+    )
+
+    return parser
+
+
+def worker_main(argv):
+    """Run the worker command."""
+    args = _get_worker_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.work_queue as work_queue
+    work_queue.run_workers(proj_dir, jobs=args.jobs, scan_jobs=args.scan_jobs, lease_seconds=args.lease_seconds,
+                           poll_seconds=args.poll_seconds, forever=args.forever)
+
+
+def _get_watch_args():
+    """Get and parse arguments for the watch command."""
+    import bxh2bids.watch as watch
+    parser = ArgumentParser(
+        prog="bxh2bids watch",
+        description="Convert new sessions as they arrive.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_proj_dir_arg(parser)
+
+    parser.add_argument(
+        "--quiet-seconds",
+        type=float,
+        default=watch.DEFAULT_QUIET_SECONDS,
+        help=textwrap.dedent(
+            """\
+            Seconds nothing in a session may change before it is
+            converted (default: {}).
+            """.format(watch.DEFAULT_QUIET_SECONDS)
+        ),
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=watch.DEFAULT_POLL_SECONDS,
+        help=textwrap.dedent(
+            """\
+            Seconds between looks at the source directories when inotify
+            (the inotify_simple package) is not available (default: {}).
+            """.format(watch.DEFAULT_POLL_SECONDS)
+        ),
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of scans of each session to convert at once (default: 1).
+            """
+        ),
+    )
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Put sessions in the work queue for "bxh2bids worker"
+            processes instead of converting them here.
+            """
+        ),
+    )
+    _add_metrics_args(parser)
+
+    return parser
+
+
+def watch_main(argv):
+    """Run the watch command."""
+    args = _get_watch_args().parse_args(argv)
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    import bxh2bids.watch as watch
+    watch.watch(proj_dir, quiet_seconds=args.quiet_seconds, poll_seconds=args.poll_seconds, scan_jobs=args.scan_jobs,
+                use_queue=args.queue, metrics_file=args.metrics_file, metrics_interval=args.metrics_interval)
+
+
+def _get_serve_args():
+    """Get and parse arguments for the serve command."""
+    parser = ArgumentParser(
+        prog="bxh2bids serve",
+        description="Run a conversion daemon that takes sessions over a Unix socket.",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    _add_socket_arg(parser)
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of worker processes, i.e. sessions converted at once
+            (default: 1).
+            """
+        ),
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Show the jobs of the running daemon instead of starting one.
+            """
+        ),
+    )
+    parser.add_argument(
+        "--stop",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Stop the running daemon once its jobs have finished.
+            """
+        ),
+    )
+    _add_metrics_args(parser)
+
+    return parser
+
+
+def serve_main(argv):
+    """Run the serve command."""
+    args = _get_serve_args().parse_args(argv)
+
+    import bxh2bids.serve as serve
+    socket_path = args.socket or serve.default_socket()
+    if args.status:
+        for job in serve.request(socket_path, {"command": "list"})["jobs"]:
+            error = "" if job["result"] is None or job["result"]["ok"] else ": {}".format(job["result"]["error"])
+            print("{:>5} {:<16} {:<8}{}".format(job["job_id"], job["request"]["dataid"], job["state"], error))
+    elif args.stop:
+        serve.request(socket_path, {"command": "shutdown"})
+    else:
+        serve.serve(socket_path, jobs=args.jobs, metrics_file=args.metrics_file, metrics_interval=args.metrics_interval)
+
+
+# Sub-commands, selected by the first command-line argument
+COMMANDS = {
+    "auto": auto_main,
+    "check": check_main,
+    "estimate": estimate_main,
+    "queue": queue_main,
+    "worker": worker_main,
+    "reconcile": reconcile_main,
+    "serve": serve_main,
+    "sidecars": sidecars_main,
+    "trace": trace_main,
+    "watch": watch_main,
+}
+
+
+# %%
+def main():
+    """Setup working environment."""
+
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    # Capture CLI arguments
+    parser = _get_args()
+    args = parser.parse_args()
+    biac_dirs = args.biac_dirs
+    proj_dir = _check_proj_dir(args.proj_dir)
+
+    if args.daemon:
+        # Options of a conversion in this process that a daemon job cannot take
+        batch_only = ["jobs", "schedule", "memory_budget", "profile", "profile_scan", "profile_top", "metrics_file",
+                      "metrics_interval"]
+        given = ["--"+dest.replace("_", "-") for dest in batch_only if getattr(args, dest) != parser.get_default(dest)]
+        if given:
+            parser.error("{} cannot be used with --daemon (start the daemon with \"bxh2bids serve\" to set "
+                         "its workers and metrics)".format(", ".join(given)))
+        import bxh2bids.serve as serve
+        results = serve.submit_sessions(args.socket or serve.default_socket(), proj_dir, biac_dirs,
+                                        incremental=args.incremental, filter_args=_scan_filter_kwargs(args),
+                                        scan_jobs=args.scan_jobs, retries=args.retries, retry_delay=args.retry_delay,
+                                        log_level=args.log_level)
+        for result in results:
+            status = "finished" if result["ok"] else "FAILED: {}".format(result["error"])
+            print("{}: {}".format(result["dataid"], status))
+        if not all([result["ok"] for result in results]):
+            sys.exit(1)
+        return
+
     import bxh2bids.run_bxh2bids as rb2b
-    rb2b.bidsify(proj_dir, biac_dirs)
+    rb2b.bidsify(proj_dir, biac_dirs, incremental=args.incremental, preflight=not args.skip_preflight,
+                 scan_filter=_scan_filter(args), jobs=args.jobs, scan_jobs=args.scan_jobs,
+                 strategy=args.schedule,
+                 memory_budget=None if args.memory_budget is None else int(args.memory_budget*2**30),
+                 retry_policy=_retry_policy(args), log_level=_log_level(args), trace=not args.no_trace,
+                 metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                 profile=args.profile, profile_scan=args.profile_scan, profile_top=args.profile_top)
 
 
 
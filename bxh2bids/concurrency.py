@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+
+
+#Adaptive number of sessions converted at once (--jobs auto).
+#
+#Whether more workers help depends on whether the source file system, the
+#target file system or the CPUs are the bottleneck, and on shared storage
+#that changes during the day. The controller is given the source bytes and
+#time of every scan a finished session converted. Over a window of finished
+#sessions it measures the throughput (source bytes per second of one scan,
+#times the number of workers) and the mean scan latency, and changes the
+#number of workers with AIMD:
+#   - throughput went down by more than TOLERANCE: halve the workers
+#   - otherwise: add one worker, to probe whether more workers help
+#So the number of workers keeps growing until throughput drops (or the
+#maximum is reached), and backs off from there.
+#Every decision is printed, logged, and written as a line to:
+#   LOG_DIR/bxh2bids_concurrency_YYYYMMDD_HHMMSS.tsv
+
+
+#Workers to start with
+START_JOBS = 2
+
+#Most workers per CPU; conversion mostly waits on the file systems
+MAX_JOBS_PER_CPU = 2
+
+#Relative change in throughput that counts as a change
+TOLERANCE = 0.05
+
+#Factor the workers are multiplied by when throughput drops
+DECREASE_FACTOR = 0.5
+
+
+class AimdController(object):
+
+    def __init__(self, min_jobs=1, max_jobs=None, start_jobs=START_JOBS, log_dir=None):
+        if max_jobs is None:
+            max_jobs = MAX_JOBS_PER_CPU*(os.cpu_count() or 1)
+        self.min_jobs = min_jobs
+        self.max_jobs = max(min_jobs, max_jobs)
+        self.jobs = min(max(start_jobs, min_jobs), self.max_jobs)
+        self.last_throughput = None
+        self.window = []
+        self.window_start = time.time()
+        self.log_file = None
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            self.log_file = os.path.join(log_dir, 'bxh2bids_concurrency_{}.tsv'.format(time.strftime('%Y%m%d_%H%M%S')))
+            with open(self.log_file, 'w') as fd:
+                fd.write('time\tjobs_before\tjobs_after\tthroughput_mib_s\tmean_scan_latency_s\tsessions\tdecision\n')
+
+    def record(self, scans):
+
+        #Called when a session finishes, with [source bytes, seconds] of each
+        #scan it converted; returns the number of workers to use now
+        if not scans:
+            return self.jobs
+        self.window.append(scans)
+        #Measure over at least as many sessions as there are workers
+        if len(self.window) >= max(2, self.jobs):
+            self.adjust()
+
+        return self.jobs
+
+    def adjust(self):
+
+        #Sessions only report when they finish, so the bytes finished per
+        #second of wall time depend on when sessions happen to end; the scan
+        #timings do not
+        scans = [scan for session_scans in self.window for scan in session_scans]
+        scan_seconds = max(sum([seconds for nbytes, seconds in scans]), 1e-6)
+        throughput = sum([nbytes for nbytes, seconds in scans])/scan_seconds*self.jobs
+        latency = scan_seconds/len(scans)
+
+        jobs_before = self.jobs
+        if self.last_throughput is not None and throughput < self.last_throughput*(1-TOLERANCE):
+            self.jobs = max(int(self.jobs*DECREASE_FACTOR), self.min_jobs)
+            decision = 'decrease' if self.jobs != jobs_before else 'hold (at minimum)'
+        else:
+            self.jobs = min(self.jobs+1, self.max_jobs)
+            decision = 'increase' if self.jobs != jobs_before else 'hold (at maximum)'
+
+        message = 'Concurrency: {} -> {} workers ({}; {:.1f} MiB/s, {:.1f} s per scan over {} sessions)'.format(
+                  jobs_before, self.jobs, decision, throughput/2**20, latency, len(self.window))
+        print(message)
+        logging.info(message)
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as fd:
+                fd.write('{}\t{}\t{}\t{:.3f}\t{:.3f}\t{}\t{}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), jobs_before, self.jobs,
+                                                                   throughput/2**20, latency, len(self.window), decision))
+
+        self.last_throughput = throughput
+        self.window = []
+        self.window_start = time.time()
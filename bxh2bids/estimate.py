@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import shutil
+import struct
+import tempfile
+import logging
+
+import bxh2bids.bxh2bids as b2b
+import bxh2bids.manifest as manifest
+import bxh2bids.scheduler as scheduler
+
+
+#Disk space and run time estimates for a batch of sessions.
+#
+#Each planned image is sized without reading it: .nii files with stat, and
+#.nii.gz files with the ISIZE field at the end of the gzip stream (the
+#uncompressed size, modulo 4 GiB). bxh2bids keeps the compression of the
+#source (a .nii.gz is written as a .nii.gz), so the expected output size is
+#the uncompressed size for .nii images and the uncompressed size times the
+#compression ratio for .nii.gz images.
+#
+#The compression ratio and the conversion throughput (uncompressed bytes per
+#second for one worker) come from a calibration run, which converts a few
+#real images into the target file system and times them. Without one, the
+#source's own compression ratio and DEFAULT_THROUGHPUT are used.
+#
+#Calibration results are saved as:
+#   LOG_DIR/bxh2bids_calibration.json
+
+
+#Uncompressed bytes per second one worker converts, if never calibrated
+DEFAULT_THROUGHPUT = 50*1024*1024
+
+#Fraction of the target file system to leave free
+DEFAULT_RESERVE = 0.05
+
+#Allowance for sidecar .json, .bvec and .bval files per scan
+SIDECAR_BYTES = 16*1024
+
+
+def gzip_isize(gz_file):
+
+    #Uncompressed size stored in the last four bytes of a gzip file
+    with open(gz_file, 'rb') as fd:
+        fd.seek(-4, os.SEEK_END)
+        isize = struct.unpack('<I', fd.read(4))[0]
+
+    #ISIZE wraps at 4 GiB; an image never compresses to more than its own size
+    compressed_size = os.path.getsize(gz_file)
+    while isize < compressed_size:
+        isize = isize + 2**32
+
+    return isize
+
+
+def image_sizes(image_file):
+
+    #Returns [bytes on disk, uncompressed bytes] of a source image
+    disk_bytes = os.path.getsize(image_file)
+    if image_file[-3:] == '.gz':
+        return [disk_bytes, gzip_isize(image_file)]
+
+    return [disk_bytes, disk_bytes]
+
+
+def calibration_file(log_dir):
+
+    return os.path.join(log_dir, 'bxh2bids_calibration.json')
+
+
+def read_calibration(log_dir):
+
+    cal_file = calibration_file(log_dir)
+    if not os.path.exists(cal_file):
+        return None
+    with open(cal_file) as fd:
+        return json.loads(fd.read())
+
+
+def calibrate(image_files, target_study_dir, log_dir):
+
+    #Convert each image once into a temporary directory on the target file
+    #system, and record throughput and gzip compression ratio.
+    logging.info('-----START: calibrate-----')
+
+    total_uncompressed = 0
+    total_seconds = 0.0
+    gz_uncompressed = 0
+    gz_output = 0
+    work_dir = tempfile.mkdtemp(prefix='.bxh2bids_calibration_', dir=target_study_dir)
+    try:
+        for image_file in image_files:
+            disk_bytes, uncompressed_bytes = image_sizes(image_file)
+            output = os.path.join(work_dir, 'calibration'+('.nii.gz' if image_file[-3:] == '.gz' else '.nii'))
+            start = time.perf_counter()
+            b2b.copy_image(image_file, output)
+            total_seconds = total_seconds + time.perf_counter() - start
+            total_uncompressed = total_uncompressed + uncompressed_bytes
+            if image_file[-3:] == '.gz':
+                gz_uncompressed = gz_uncompressed + uncompressed_bytes
+                gz_output = gz_output + os.path.getsize(output)
+            os.remove(output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    calibration = {
+                   'images': len(image_files),
+                   'throughput': total_uncompressed/total_seconds if total_seconds > 0 else DEFAULT_THROUGHPUT,
+                   'gzip_ratio': gz_output/gz_uncompressed if gz_uncompressed > 0 else None,
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S')
+                   }
+
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    with open(calibration_file(log_dir), 'w') as fd:
+        fd.write(json.dumps(calibration, indent=4))
+
+    logging.info('-----FINISH: calibrate-----')
+
+    return calibration
+
+
+def size_scan(bxh_info_dict, calibration=None):
+
+    #Returns {'source_bytes', 'uncompressed_bytes', 'output_bytes', 'compressed'} for one scan
+    disk_bytes, uncompressed_bytes = image_sizes(bxh_info_dict['orig_image'])
+
+    if bxh_info_dict['orig_image'][-3:] == '.gz':
+        if calibration is not None and calibration.get('gzip_ratio') is not None:
+            output_bytes = int(uncompressed_bytes*calibration['gzip_ratio'])
+        else:
+            output_bytes = disk_bytes
+    else:
+        output_bytes = uncompressed_bytes
+
+    output_bytes = output_bytes + SIDECAR_BYTES
+    if 'tsv_file' in bxh_info_dict.keys() and os.path.exists(bxh_info_dict['tsv_file']):
+        output_bytes = output_bytes + os.path.getsize(bxh_info_dict['tsv_file'])
+
+    return {'source_bytes': disk_bytes, 'uncompressed_bytes': uncompressed_bytes, 'output_bytes': output_bytes,
+            'compressed': bxh_info_dict['orig_image'][-3:] == '.gz'}
+
+
+def size_session(dataid, ses_dict, source_study_dir, target_study_dir, calibration=None, manifest_dir=None, incremental=False,
+                 scan_filter=None):
+
+    #Returns {bxh name: scan sizes} for the scans a conversion would copy
+    session_manifest = None
+    if incremental and manifest_dir is not None:
+        session_manifest = manifest.read_session_manifest(manifest_dir, dataid)
+
+    bxh_list, multi_bxh_info_dict = b2b.plan_session(dataid, ses_dict, source_study_dir, session_manifest=session_manifest,
+                                                     scan_filter=scan_filter)
+
+    return _size_planned(bxh_list, multi_bxh_info_dict, target_study_dir, calibration, session_manifest)
+
+
+def size_auto_session(dataid, data_info, source_study_dir, target_study_dir, events_files_dir, calibration=None, manifest_dir=None,
+                      incremental=False, scan_filter=None):
+
+    #Same as size_session(), for a session described by a session table row
+    session_manifest = None
+    if incremental and manifest_dir is not None:
+        session_manifest = manifest.read_session_manifest(manifest_dir, dataid)
+
+    bxh_list, multi_bxh_info_dict = b2b.plan_auto_session(dataid, data_info, source_study_dir, events_files_dir, scan_filter=scan_filter)
+
+    return _size_planned(bxh_list, multi_bxh_info_dict, target_study_dir, calibration, session_manifest)
+
+
+def _size_planned(bxh_list, multi_bxh_info_dict, target_study_dir, calibration=None, session_manifest=None):
+
+    sizes = {}
+    for file_item in bxh_list:
+        bxh_name = os.path.split(file_item['bxhfile'])[-1]
+        if bxh_name not in multi_bxh_info_dict:
+            continue
+        bxh_info_dict = multi_bxh_info_dict[bxh_name]
+        if session_manifest is not None:
+            outputs = b2b.expected_outputs(file_item['bxhfile'], bxh_info_dict, target_study_dir)
+            if manifest.scan_unchanged(session_manifest['scans'].get(bxh_name), outputs):
+                continue
+        sizes[bxh_name] = size_scan(bxh_info_dict, calibration)
+
+    return sizes
+
+
+def estimate_batch(session_sizes, target_study_dir, jobs=1, calibration=None, reserve=DEFAULT_RESERVE, scan_jobs=1, strategy='lpt'):
+
+    #session_sizes is {dataid: size_session() result}
+    throughput = DEFAULT_THROUGHPUT
+    if calibration is not None:
+        throughput = calibration['throughput']
+
+    output_bytes = 0
+    for dataid, scan_sizes in session_sizes.items():
+        for scan in scan_sizes.values():
+            output_bytes = output_bytes + scan['output_bytes']
+
+    #The target directory may not exist yet; measure the file system it will be on
+    space_dir = target_study_dir
+    while not os.path.exists(space_dir):
+        space_dir = os.path.dirname(space_dir)
+    usage = shutil.disk_usage(space_dir)
+    usable_bytes = usage.free - int(usage.total*reserve)
+
+    schedule = scheduler.plan_batch(session_sizes, throughput, jobs=jobs, scan_jobs=scan_jobs, strategy=strategy)
+
+    return {
+            'sessions': len(session_sizes),
+            'scans': sum([len(scan_sizes) for scan_sizes in session_sizes.values()]),
+            'output_bytes': output_bytes,
+            'free_bytes': usage.free,
+            'headroom_bytes': usable_bytes - output_bytes,
+            'fits': output_bytes <= usable_bytes,
+            'jobs': jobs,
+            'throughput': throughput,
+            'calibrated': calibration is not None,
+            'seconds': schedule['expected_makespan'],
+            'schedule': schedule
+            }
+
+
+def format_estimate(estimate):
+
+    gib = float(2**30)
+    lines = [
+             'Sessions: {}  Scans to convert: {}'.format(estimate['sessions'], estimate['scans']),
+             'Expected output: {:.2f} GiB'.format(estimate['output_bytes']/gib),
+             'Free space on target: {:.2f} GiB'.format(estimate['free_bytes']/gib),
+             'Headroom after conversion: {:.2f} GiB'.format(estimate['headroom_bytes']/gib),
+             'Throughput per worker: {:.1f} MiB/s ({})'.format(estimate['throughput']/2**20,
+                                                             'calibrated' if estimate['calibrated'] else 'default, not calibrated'),
+             'Expected run time with {} worker(s) x {} scan job(s), {} order: {:.0f} s'.format(
+                 estimate['jobs'], estimate['schedule']['scan_jobs'], estimate['schedule']['strategy'], estimate['seconds']),
+             ]
+    if not estimate['fits']:
+        lines.append('WARNING: the target file system would fill up!')
+
+    return '\n'.join(lines)
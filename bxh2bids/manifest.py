@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import hashlib
+
+from bxh2bids.scan_entry import ScanEntry
+
+
+#Per-session conversion manifests.
+#
+#After a session is converted, a manifest is written recording, for every
+#converted bxh file, the files it was made from (bxh, image, BIAC json,
+#events tsv) and the files it produced, each with a size/mtime fingerprint.
+#
+#Manifests are saved as:
+#   MANIFEST_DIR/bxh2bids_manifest_YYYYMMDD_#####.json
+#
+#and look like:
+#
+#{
+#    "dataid": "20200101_12345",
+#    "updated": "2020-01-01 12:00:00",
+#    "plan_key": "<sha1 of the session info and psd_types.json>",
+#    "bxh_files": {"/path/to/bia5_12345_003.bxh": {"size": 2345, "mtime": 1577880000.0}, ...},
+#    "plan_files": {"/path/to/bia5_12345_003.json": null, ...},
+#    "scans": {
+#        "bia5_12345_003.bxh": {
+#            "bxh": "/path/to/bia5_12345_003.bxh",
+#            "entry": {"scan_type": "anat", "scan_label": "T1w", ...},
+#            "sources": {"/path/to/bia5_12345_003.nii.gz": {"size": 1234, "mtime": 1577880000.0, "sha1": "..."}, ...},
+#            "outputs": {"/path/to/sub-01_ses-1_T1w.nii.gz": {"size": 1200, "mtime": 1577890000.0}, ...}
+#        }
+#    },
+#    "failed": {
+#        "bia5_12345_005.bxh": {
+#            "bxh": "/path/to/bia5_12345_005.bxh",
+#            "error": "[Errno 5] Input/output error",
+#            "transient": true,
+#            "attempts": 4,
+#            "time": "2020-01-01 12:00:00"
+#        }
+#    }
+#}
+#
+#Incremental runs use the manifest to skip scans whose sources and outputs
+#have not changed. Sizes and modification times are checked first; the
+#sha1 of a source is only computed again if those differ, so a touched but
+#unchanged file is not converted again. Recording a scan never reads an
+#image: sources up to HASH_MAX_BYTES (bxh, json, tsv files) are hashed, and
+#a larger source keeps the sha1 of its previous record while its size and
+#mtime are unchanged (a new or changed image is recorded without one).
+#
+#"plan_files" are the files besides the bxh files that decide how the
+#session is planned (the BIAC json each image may have, events files), with
+#null for those that do not exist. A cached plan is only used while they
+#are unchanged, so e.g. a BIAC json added later is picked up.
+#
+#"failed" lists the scans that did not convert in the last run that tried
+#them. They have no record in "scans" (or only the one of an earlier
+#conversion), so an incremental run converts them again; a scan is taken
+#off the list once it converts.
+
+
+#Sources up to this size are hashed when a scan is recorded
+HASH_MAX_BYTES = 1024*1024
+
+
+def file_hash(file_path):
+
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024*1024), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def fingerprint(file_path, with_hash=False):
+
+    #Return the size/mtime fingerprint of a file, or None if it is not there.
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    file_fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if with_hash:
+        file_fingerprint['sha1'] = file_hash(file_path)
+
+    return file_fingerprint
+
+
+def same_fingerprint(recorded, current):
+
+    if recorded is None or current is None:
+        return False
+
+    return recorded['size'] == current['size'] and recorded['mtime'] == current['mtime']
+
+
+def source_unchanged(recorded, file_path):
+
+    #True if a source file still has the content it had when it was recorded
+    current = fingerprint(file_path)
+    if same_fingerprint(recorded, current):
+        return True
+    if current is None or recorded is None or 'sha1' not in recorded:
+        return False
+    if current['size'] != recorded['size']:
+        return False
+
+    return file_hash(file_path) == recorded['sha1']
+
+
+def __source_fingerprint(source, previous):
+
+    source_fingerprint = fingerprint(source)
+    if source_fingerprint is None:
+        return None
+    if source_fingerprint['size'] <= HASH_MAX_BYTES:
+        source_fingerprint['sha1'] = file_hash(source)
+    elif same_fingerprint(previous, source_fingerprint) and 'sha1' in previous:
+        source_fingerprint['sha1'] = previous['sha1']
+
+    return source_fingerprint
+
+
+def scan_record(bxh_file, outputs, entry=None, previous=None):
+
+    #outputs is the list of [output file, source file] pairs returned
+    #by bxh2bids.expected_outputs(). entry is the scan's conversion entry.
+    #previous is the scan's record from the manifest, if it has one; the
+    #sha1 of its unchanged large sources is kept instead of read again.
+    previous_sources = {} if previous is None else previous.get('sources', {})
+    sources = {bxh_file: __source_fingerprint(bxh_file, previous_sources.get(bxh_file))}
+    for output, source in outputs:
+        if source not in sources:
+            sources[source] = __source_fingerprint(source, previous_sources.get(source))
+
+    record = {
+              'bxh': bxh_file,
+              'sources': sources,
+              'outputs': {output: fingerprint(output) for output, source in outputs}
+              }
+    if entry is not None:
+        record['entry'] = dict(entry.items())
+
+    return record
+
+
+def scan_unchanged(scan_manifest, outputs):
+
+    #True if a scan was converted before and neither its sources nor
+    #its outputs have changed since.
+    if scan_manifest is None:
+        return False
+
+    if set(scan_manifest['outputs']) != set([output for output, source in outputs]):
+        return False
+
+    #The scan is now made from a different file (e.g. a new events tsv)
+    for output, source in outputs:
+        if source not in scan_manifest['sources']:
+            return False
+
+    for output, recorded in scan_manifest['outputs'].items():
+        if not same_fingerprint(recorded, fingerprint(output)):
+            return False
+
+    for source, recorded in scan_manifest['sources'].items():
+        if not source_unchanged(recorded, source):
+            return False
+
+    return True
+
+
+def plan_key(ses_dict, psd_types_file):
+
+    #Anything that changes how bxh files are planned changes this key
+    sha1 = hashlib.sha1(json.dumps(ses_dict, sort_keys=True).encode())
+    sha1.update(json.dumps(fingerprint(psd_types_file)).encode())
+
+    return sha1.hexdigest()
+
+
+def plan_files(entries):
+
+    #Files other than the bxh files that decide how scans are planned: the
+    #BIAC json next to each image (see bxh2bids.create_internal_info()),
+    #whether or not it exists, and the events tsv files
+    files = set()
+    for entry in entries:
+        image = entry.get('orig_image')
+        if image:
+            image_dir, image_name = os.path.split(image)
+            files.add(os.path.join(image_dir, image_name.split('.nii')[0]+'.json'))
+        if entry.get('tsv_file'):
+            files.add(entry['tsv_file'])
+
+    return sorted(files)
+
+
+def cached_plan(session_manifest, bxh_list, key):
+
+    #Return the conversion entries recorded in the manifest if the session
+    #would be planned exactly the same way again, otherwise None.
+
+    if session_manifest is None or session_manifest.get('plan_key') != key:
+        return None
+
+    recorded_bxh_files = session_manifest.get('bxh_files', {})
+    if set(recorded_bxh_files) != set([item['bxhfile'] for item in bxh_list]):
+        return None
+    for bxh_file, recorded in recorded_bxh_files.items():
+        if not same_fingerprint(recorded, fingerprint(bxh_file)):
+            return None
+    #Manifests written before plan_files were recorded are planned again once
+    if 'plan_files' not in session_manifest:
+        return None
+    for plan_file, recorded in session_manifest['plan_files'].items():
+        current = fingerprint(plan_file)
+        if (recorded is None) != (current is None) or (current is not None and not same_fingerprint(recorded, current)):
+            return None
+
+    multi_bxh_info_dict = {}
+    for bxh_name, scan_manifest in session_manifest['scans'].items():
+        if 'entry' not in scan_manifest:
+            return None
+        multi_bxh_info_dict[bxh_name] = ScanEntry.from_dict(scan_manifest['entry'])
+
+    return multi_bxh_info_dict
+
+
+def session_manifest_file(manifest_dir, dataid):
+
+    return os.path.join(manifest_dir, 'bxh2bids_manifest_{}.json'.format(dataid))
+
+
+def read_session_manifest(manifest_dir, dataid):
+
+    manifest_file = session_manifest_file(manifest_dir, dataid)
+    if not os.path.exists(manifest_file):
+        return None
+
+    with open(manifest_file) as fd:
+        return json.loads(fd.read())
+
+
+def failure_record(bxh_file, failure):
+
+    #failure is what bxh2bids.convert_session_scans() returned for the scan
+    return {'bxh': bxh_file, 'error': failure['error'], 'transient': failure['transient'], 'attempts': failure['attempts'],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def failed_scans(session_manifest):
+
+    #{bxh file name: failure record} of the scans that failed last time
+    if session_manifest is None:
+        return {}
+
+    return session_manifest.get('failed', {})
+
+
+def update_session_manifest(manifest_dir, dataid, scan_records, remove=(), key=None, bxh_list=None, failed=None):
+
+    #Merge new scan records into the session's manifest. Scans listed
+    #in "remove" are dropped from it. key and bxh_list record how the
+    #whole session was planned, so an unchanged session can skip planning.
+    #failed is {bxh file name: failure_record()} of scans that did not convert.
+
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    session_manifest = read_session_manifest(manifest_dir, dataid)
+    if session_manifest is None:
+        session_manifest = {'dataid': dataid, 'scans': {}}
+
+    session_failed = session_manifest.get('failed', {})
+    for bxh_name in remove:
+        session_manifest['scans'].pop(bxh_name, None)
+        session_failed.pop(bxh_name, None)
+    session_manifest['scans'].update(scan_records)
+    for bxh_name in scan_records:
+        session_failed.pop(bxh_name, None)
+    if failed:
+        session_failed.update(failed)
+    if session_failed:
+        session_manifest['failed'] = session_failed
+    else:
+        session_manifest.pop('failed', None)
+    if key is not None and bxh_list is not None:
+        session_manifest['plan_key'] = key
+        session_manifest['bxh_files'] = {item['bxhfile']: fingerprint(item['bxhfile']) for item in bxh_list}
+        session_manifest['plan_files'] = {plan_file: fingerprint(plan_file) for plan_file in
+                                          plan_files([scan_manifest['entry'] for scan_manifest in session_manifest['scans'].values()
+                                                      if 'entry' in scan_manifest])}
+    else:
+        session_manifest.pop('plan_key', None)
+        session_manifest.pop('bxh_files', None)
+        session_manifest.pop('plan_files', None)
+    session_manifest['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    #Write to a temporary file first so a crash never leaves half a manifest
+    manifest_file = session_manifest_file(manifest_dir, dataid)
+    temp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(temp_file, 'w') as fd:
+        fd.write(json.dumps(session_manifest, indent=4))
+    os.replace(temp_file, manifest_file)
+
+    return session_manifest
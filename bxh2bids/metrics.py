@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+import threading
+
+
+#Prometheus metrics of a conversion run, for node_exporter's textfile collector.
+#
+#Long-running batches ("bxh2bids --metrics-file ..."), the watcher and the
+#daemon count what they convert and write it to a metrics file every
+#interval seconds, and once more when they stop. Put the file in the
+#directory node_exporter's --collector.textfile.directory reads, e.g.
+#   bxh2bids --metrics-file /var/lib/node_exporter/textfile/bxh2bids.prom ...
+#The file is written to a temporary file next to it and renamed, so the
+#collector never reads half a file. Every metric has a "mode" label (batch,
+#watch or daemon):
+#
+#   bxh2bids_sessions_total{result="converted"|"failed"}            counter
+#   bxh2bids_scans_total{modality, result="converted"|"failed"}     counter
+#   bxh2bids_read_bytes_total{modality}                             counter
+#   bxh2bids_written_bytes_total{modality}                          counter
+#   bxh2bids_scan_duration_seconds{modality}                        histogram
+#   bxh2bids_session_duration_seconds                               histogram
+#   bxh2bids_queue_depth                                            gauge
+#   bxh2bids_active_workers                                         gauge
+#   bxh2bids_last_session_timestamp_seconds                         gauge
+#   bxh2bids_last_success_timestamp_seconds                         gauge
+#
+#Scans of a session that was rolled back count as failed. Counters start
+#at zero with every run; Prometheus' rate() and increase() allow for that.
+#An alert on time()-bxh2bids_last_success_timestamp_seconds while
+#bxh2bids_queue_depth > 0 catches conversions that are stuck.
+
+
+#Seconds between writes of the metrics file
+DEFAULT_INTERVAL = 15
+
+SCAN_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1800]
+SESSION_BUCKETS = [10, 30, 60, 120, 300, 600, 1800, 3600, 7200]
+
+MODES = ['batch', 'watch', 'daemon']
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] = self.counts[index]+1
+        self.count = self.count+1
+        self.sum = self.sum+value
+
+
+def _labels(labels):
+
+    return '{'+','.join(['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                         for name, value in labels])+'}'
+
+
+def _number(value):
+
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class ConversionMetrics(object):
+
+    #Counts sessions and scans as they finish and writes them to metrics_file.
+    #session_finished() takes the result of run_bxh2bids._bidsify_session();
+    #set_queue_depth() and set_active_workers() keep the gauges current.
+    #Safe to call from several threads.
+
+    def __init__(self, metrics_file, mode, interval=DEFAULT_INTERVAL):
+        if mode not in MODES:
+            raise RuntimeError('Unknown metrics mode: {}'.format(mode))
+        self.metrics_file = metrics_file
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sessions = {'converted': 0, 'failed': 0}
+        #{(modality, result): count}
+        self.scans = {}
+        #{modality: bytes}
+        self.read_bytes = {}
+        self.written_bytes = {}
+        #{modality: _Histogram}
+        self.scan_durations = {}
+        self.session_durations = _Histogram(SESSION_BUCKETS)
+        self.queue_depth = 0
+        self.active_workers = 0
+        self.last_session = None
+        self.last_success = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def session_finished(self, result):
+        #Scans are only published with their session
+        published = result['ok'] or 'failed_scans' in result
+        with self.lock:
+            session_result = 'converted' if result['ok'] else 'failed'
+            self.sessions[session_result] = self.sessions[session_result]+1
+            if result.get('seconds') is not None:
+                self.session_durations.observe(result['seconds'])
+            for scan in result.get('scans', []):
+                modality = scan['modality']
+                converted = scan['ok'] and published
+                key = (modality, 'converted' if converted else 'failed')
+                self.scans[key] = self.scans.get(key, 0)+1
+                self.read_bytes[modality] = self.read_bytes.get(modality, 0)+scan['bytes_read']
+                if converted:
+                    self.written_bytes[modality] = self.written_bytes.get(modality, 0)+scan['bytes_written']
+                if modality not in self.scan_durations:
+                    self.scan_durations[modality] = _Histogram(SCAN_BUCKETS)
+                self.scan_durations[modality].observe(scan['seconds'])
+            self.last_session = time.time()
+            if result['ok']:
+                self.last_success = self.last_session
+
+    def set_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depth = depth
+
+    def set_active_workers(self, workers):
+        with self.lock:
+            self.active_workers = workers
+
+    def __lines(self):
+        mode = ('mode', self.mode)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, _labels([mode]+labels), _number(value)))
+
+        def histogram_samples(histogram, labels):
+            samples = [['_bucket', labels+[('le', _number(bound))], count] for bound, count in zip(histogram.buckets, histogram.counts)]
+            samples.append(['_bucket', labels+[('le', '+Inf')], histogram.count])
+            samples.append(['_sum', labels, histogram.sum])
+            samples.append(['_count', labels, histogram.count])
+            return samples
+
+        metric('bxh2bids_sessions_total', 'counter', 'Sessions that finished converting.',
+               [['', [('result', result)], count] for result, count in sorted(self.sessions.items())])
+        metric('bxh2bids_scans_total', 'counter', 'Scans that were converted or failed.',
+               [['', [('modality', modality), ('result', result)], count] for (modality, result), count in sorted(self.scans.items())])
+        metric('bxh2bids_read_bytes_total', 'counter', 'Bytes of source files read by converted scans.',
+               [['', [('modality', modality)], nbytes] for modality, nbytes in sorted(self.read_bytes.items())])
+        metric('bxh2bids_written_bytes_total', 'counter', 'Bytes of BIDS files written by converted scans.',
+               [['', [('modality', modality)], nbytes] for modality, nbytes in sorted(self.written_bytes.items())])
+        samples = []
+        for modality, histogram in sorted(self.scan_durations.items()):
+            samples = samples+histogram_samples(histogram, [('modality', modality)])
+        metric('bxh2bids_scan_duration_seconds', 'histogram', 'Time to convert a scan, retries included.', samples)
+        metric('bxh2bids_session_duration_seconds', 'histogram', 'Time to convert a session.',
+               histogram_samples(self.session_durations, []))
+        metric('bxh2bids_queue_depth', 'gauge', 'Sessions waiting to be converted.', [['', [], self.queue_depth]])
+        metric('bxh2bids_active_workers', 'gauge', 'Sessions being converted now.', [['', [], self.active_workers]])
+        if self.last_session is not None:
+            metric('bxh2bids_last_session_timestamp_seconds', 'gauge', 'Time the last session finished.',
+                   [['', [], self.last_session]])
+        if self.last_success is not None:
+            metric('bxh2bids_last_success_timestamp_seconds', 'gauge', 'Time the last session converted.',
+                   [['', [], self.last_success]])
+
+        return lines
+
+    def write(self):
+        with self.lock:
+            contents = '\n'.join(self.__lines())+'\n'
+        temp_file = '{}.{}.tmp'.format(self.metrics_file, os.getpid())
+        try:
+            with open(temp_file, 'w') as fd:
+                fd.write(contents)
+            os.replace(temp_file, self.metrics_file)
+        except OSError as ex:
+            #Monitoring must never stop a conversion
+            logging.warning('Cannot write metrics file {}: {}'.format(self.metrics_file, ex))
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        #Write the file now and then every interval seconds, in a thread
+        metrics_dir = os.path.dirname(os.path.abspath(self.metrics_file))
+        if not os.path.isdir(metrics_dir):
+            raise RuntimeError('Metrics directory cannot be found: '+str(metrics_dir))
+        self.write()
+        self.thread = threading.Thread(target=self.__run, name='bxh2bids-metrics', daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        #Write the final values
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
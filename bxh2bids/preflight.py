@@ -0,0 +1,213 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import bxh2bids.bxh2bids as b2b
+import bxh2bids.manifest as manifest
+import bxh2bids.scan_filter as scan_filters
+
+
+#Pre-flight validation of a batch of sessions.
+#
+#Everything that would otherwise stop a conversion part of the way through
+#is checked for every session before any data are copied:
+#   - the session info file exists, is valid json and has "sub" and "ses"
+#   - the session has Anat and/or Func data directories
+#   - every .bxh file can be planned, and the image it points to exists
+#   - every scan description is in psd_types.json
+#   - every functional run matches one "funcs" entry, and its events .tsv exists
+#   - every fmap that needs it has a valid phase-encode "dir"
+#   - no two scans in the batch would be written to the same output file
+#   - (unless incremental) no output that must not be overwritten exists already
+#
+#Sessions are checked in parallel and all problems are returned together.
+#A session is planned the way the conversion will plan it (with the cached
+#plan of an unchanged session when incremental); only if that fails are its
+#bxh files planned one by one, to report every problem instead of the first.
+
+
+PE_DIRECTIONS = ['AP', 'PA', 'LR', 'RL', 'IS', 'SI']
+
+
+def validate_session(dataid, ses_info_dir, source_study_dir, target_study_dir, incremental=False, scan_filter=None, manifest_dir=None):
+
+    #Returns [list of problems, {output file: bxh file}] for one session
+    problems = []
+    outputs = {}
+
+    ses_info_file = os.path.join(ses_info_dir, 'bxh2bids_{}.json'.format(dataid))
+    if not os.path.exists(ses_info_file):
+        return ['Session info file not found: '+str(ses_info_file)], outputs
+    try:
+        with open(ses_info_file) as fd:
+            ses_dict = json.loads(fd.read())
+    except ValueError as ex:
+        return ['Session info file is not valid json: {} ({})'.format(ses_info_file, ex)], outputs
+    for key in ['sub', 'ses']:
+        if key not in ses_dict.keys():
+            problems.append('Session info file has no "{}" entry: {}'.format(key, ses_info_file))
+    if problems:
+        return problems, outputs
+
+    anat_dir = os.path.join(source_study_dir, 'Data', 'Anat', dataid)
+    func_dir = os.path.join(source_study_dir, 'Data', 'Func', dataid)
+    if not os.path.exists(anat_dir) and not os.path.exists(func_dir):
+        return ['No Anat or Func data directory found for session: '+str(dataid)], outputs
+
+    session_manifest = None
+    if incremental and manifest_dir is not None:
+        session_manifest = manifest.read_session_manifest(manifest_dir, dataid)
+
+    try:
+        bxh_list, multi_bxh_info_dict = b2b.plan_session(dataid, ses_dict, source_study_dir, session_manifest=session_manifest,
+                                                         scan_filter=scan_filter)
+        return _check_outputs(bxh_list, multi_bxh_info_dict, target_study_dir, incremental)
+    except Exception:
+        #Plan the bxh files one by one below, to report every problem
+        pass
+
+    try:
+        bxh_list = scan_filters.filter_bxh_list(scan_filter, b2b.find_session_bxh_files(dataid, source_study_dir), ses_dict)
+    except RuntimeError as ex:
+        return [str(ex)], outputs
+
+    return _check_planned(bxh_list, lambda bxh_file, multi_bxh_info_dict: b2b.create_internal_info(bxh_file, ses_dict, multi_bxh_info_dict,
+                                                                                                   scan_filter=scan_filter),
+                          target_study_dir, incremental)
+
+
+def validate_auto_session(dataid, data_info, source_study_dir, target_study_dir, events_files_dir, incremental=False, scan_filter=None):
+
+    #Same as validate_session(), for a session whose scans are described by
+    #their bxh descriptions (a session table row, see session_table.py)
+    anat_dir = os.path.join(source_study_dir, 'Data', 'Anat', dataid)
+    func_dir = os.path.join(source_study_dir, 'Data', 'Func', dataid)
+    if not os.path.exists(anat_dir) and not os.path.exists(func_dir):
+        return ['No Anat or Func data directory found for session: '+str(dataid)], {}
+
+    try:
+        bxh_list = scan_filters.filter_bxh_list(scan_filter, b2b.find_session_bxh_files(dataid, source_study_dir))
+    except RuntimeError as ex:
+        return [str(ex)], {}
+
+    return _check_planned(bxh_list, lambda bxh_file, multi_bxh_info_dict: b2b.auto_create_internal_info(
+                                        bxh_file, events_files_dir, data_info, multi_bxh_info_dict, scan_filter=scan_filter),
+                          target_study_dir, incremental)
+
+
+def _check_planned(bxh_list, make_entry, target_study_dir, incremental=False):
+
+    #Plan every bxh file with make_entry(bxh_file, multi_bxh_info_dict),
+    #recording the problem with each one that cannot be planned, and check
+    #the entries; returns [list of problems, {output file: bxh file}]
+    problems = []
+    multi_bxh_info_dict = {}
+    for file_item in bxh_list:
+        bxh_file = file_item['bxhfile']
+        try:
+            multi_bxh_info_dict = make_entry(bxh_file, multi_bxh_info_dict)
+        except Exception as ex:
+            problems.append('{}: {}'.format(bxh_file, ex))
+
+    try:
+        multi_bxh_info_dict = b2b.compare_output_names(multi_bxh_info_dict)
+    except Exception as ex:
+        problems.append('Output names cannot be made unique: {}'.format(ex))
+        return problems, {}
+
+    entry_problems, outputs = _check_outputs(bxh_list, multi_bxh_info_dict, target_study_dir, incremental)
+
+    return problems + entry_problems, outputs
+
+
+def _check_outputs(bxh_list, multi_bxh_info_dict, target_study_dir, incremental=False):
+
+    #Check the planned entries of a session and the files they would write;
+    #returns [list of problems, {output file: bxh file}]
+    problems = []
+    outputs = {}
+    bxh_files = {os.path.split(item['bxhfile'])[-1]: item['bxhfile'] for item in bxh_list}
+    for bxh_name, bxh_info_dict in multi_bxh_info_dict.items():
+        problems = problems + _check_entry(bxh_files[bxh_name], bxh_info_dict)
+        for output, source in b2b.expected_outputs(bxh_files[bxh_name], bxh_info_dict, target_study_dir):
+            if output in outputs:
+                problems.append('Two scans would be written to {}: {} and {}'.format(output, outputs[output], bxh_files[bxh_name]))
+            outputs[output] = bxh_files[bxh_name]
+        if not incremental:
+            for output in b2b.protected_outputs(bxh_files[bxh_name], bxh_info_dict, target_study_dir):
+                if os.path.exists(output):
+                    problems.append('Output file already exists: '+str(output))
+
+    return problems, outputs
+
+
+def _check_entry(bxh_file, bxh_info_dict):
+
+    problems = []
+
+    if not os.path.exists(bxh_info_dict['orig_image']):
+        problems.append('Image file not found for {}: {}'.format(bxh_file, bxh_info_dict['orig_image']))
+
+    if bxh_info_dict['scan_type'] == 'func' and 'tsv_file' in bxh_info_dict.keys():
+        if not os.path.exists(bxh_info_dict['tsv_file']):
+            problems.append('tsv_file cannot be found for {}: {}'.format(bxh_file, bxh_info_dict['tsv_file']))
+
+    if bxh_info_dict['scan_type'] == 'fmap':
+        bxh_desc = bxh_info_dict['bxh_desc']
+        if bxh_desc not in b2b.FMAP_DESCRIPTIONS+['ncanda-grefieldmap-v1']:
+            problems.append('B0 fieldmap description not recognized for {}: {}'.format(bxh_file, bxh_desc))
+        elif bxh_desc in b2b.FMAP_DESCRIPTIONS and bxh_info_dict.get('biac_json') is None:
+            if bxh_info_dict.get('dir') not in PE_DIRECTIONS:
+                problems.append('fmap needs a "dir" of {} in the session info file for {}; found: {}'.format(
+                                PE_DIRECTIONS, bxh_file, bxh_info_dict.get('dir')))
+
+    return problems
+
+
+def validate_batch(biac_dirs, ses_info_dir, source_study_dir, target_study_dir, incremental=False, jobs=8, scan_filter=None,
+                   data_infos=None, events_files_dir=None, manifest_dir=None):
+
+    #Returns {dataid: [problems]} for every session in the batch. With
+    #data_infos ({dataid: data_info}, from a session table) the sessions are
+    #checked as auto sessions, with their events files in events_files_dir.
+    #Sessions with a manifest in manifest_dir are checked from their cached
+    #plan when incremental and unchanged.
+    logging.info('Running pre-flight checks on {} sessions.'.format(len(biac_dirs)))
+
+    def validate(dataid):
+        if data_infos is not None:
+            return validate_auto_session(dataid, data_infos[dataid], source_study_dir, target_study_dir, events_files_dir, incremental,
+                                         scan_filter)
+        return validate_session(dataid, ses_info_dir, source_study_dir, target_study_dir, incremental, scan_filter, manifest_dir)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(validate, biac_dirs))
+
+    problems = {}
+    all_outputs = {}
+    for dataid, (session_problems, outputs) in zip(biac_dirs, results):
+        problems[dataid] = session_problems
+        #Two sessions writing the same files (e.g. a copy-pasted "sub"/"ses")
+        for output, bxh_file in outputs.items():
+            if output in all_outputs:
+                other_dataid = all_outputs[output]
+                problems[dataid].append('Sessions {} and {} would both write {}'.format(other_dataid, dataid, output))
+            else:
+                all_outputs[output] = dataid
+
+    return problems
+
+
+def format_report(problems):
+
+    lines = []
+    for dataid in problems:
+        if problems[dataid]:
+            lines.append('Session {}: {} problem(s)'.format(dataid, len(problems[dataid])))
+            for problem in problems[dataid]:
+                lines.append('    '+str(problem))
+        else:
+            lines.append('Session {}: OK'.format(dataid))
+
+    return '\n'.join(lines)
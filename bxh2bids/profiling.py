@@ -0,0 +1,142 @@
+import io
+import os
+import time
+import pstats
+import logging
+import cProfile
+import contextvars
+from bxh2bids.session_log import current_session
+
+
+#cProfile profiles of a conversion run.
+#
+#With profiling on, each session is run under cProfile and its profile is
+#written next to the run's logs:
+#   LOG_DIR/bxh2bids_profile_<YYYYMMDD_HHMMSS>_<pid>_ses-<dataid>.pstats
+#With a scan given (the name of its .bxh file), only the conversion of that
+#scan is profiled, retries included:
+#   LOG_DIR/bxh2bids_profile_<YYYYMMDD_HHMMSS>_<pid>_ses-<dataid>_<scan>.pstats
+#Sessions converted in worker processes (--jobs) write their own files with
+#the same prefix. The files can be read with pstats, snakeviz, etc.;
+#format_hotspots() prints the functions with the most cumulative time over
+#all the files of a run.
+#
+#cProfile only sees the thread it was started in. With --scan-jobs above 1
+#a session's scans run in other threads and are missing from its profile;
+#profile with --scan-jobs 1, or profile one scan, which is profiled in the
+#thread that converts it.
+
+
+#Number of functions format_hotspots() prints by default
+DEFAULT_TOP = 25
+
+#{'prefix', 'scan'} of the profile of the current thread's session, or None
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+def new_profile_prefix(log_dir):
+
+    #Start of the names of a new run's profile files
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, 'bxh2bids_profile_{}_{}'.format(time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+
+
+def scan_name(bxh_file):
+
+    #'bia5_12345_005' for bia5_12345_005.bxh, with or without its directory
+    name = os.path.split(bxh_file)[-1]
+    if name.endswith('.bxh'):
+        name = name[:-4]
+    return name
+
+
+def open_profile(profile_prefix, scan=None):
+
+    #Profile the sessions the calling thread converts (or only the scan
+    #named scan) into files starting with profile_prefix. Returns a token
+    #for close_profile().
+    if profile_prefix is None:
+        return current_profile.set(None)
+    return current_profile.set({'prefix': profile_prefix, 'scan': None if scan is None else scan_name(scan)})
+
+
+def close_profile(token):
+
+    current_profile.reset(token)
+
+
+def __start(what):
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as ex:
+        #Only one profiler can run at a time (e.g. sessions converted in threads)
+        logging.warning('Not profiling {}: {}'.format(what, ex))
+        return None
+    return profiler
+
+
+def start_session_profile(dataid):
+
+    #Returns a profiler for stop_profile(), or None if the session is not profiled
+    settings = current_profile.get()
+    if settings is None or settings['scan'] is not None:
+        return None
+    profiler = __start('session '+str(dataid))
+    if profiler is not None:
+        profiler.profile_file = '{}_ses-{}'.format(settings['prefix'], dataid)
+    return profiler
+
+
+def start_scan_profile(bxh_file):
+
+    #Returns a profiler for stop_profile(), or None if the scan is not profiled
+    settings = current_profile.get()
+    if settings is None or settings['scan'] != scan_name(bxh_file):
+        return None
+    profiler = __start('scan '+str(bxh_file))
+    if profiler is not None:
+        profiler.profile_file = '{}_ses-{}_{}'.format(settings['prefix'], current_session.get(), scan_name(bxh_file))
+    return profiler
+
+
+def stop_profile(profiler):
+
+    #Write the profile; a session converted twice in a run gets a second file
+    if profiler is None:
+        return None
+    profiler.disable()
+    for attempt in range(1, 100):
+        profile_file = profiler.profile_file+('' if attempt == 1 else '_'+str(attempt))+'.pstats'
+        if not os.path.exists(profile_file):
+            break
+    try:
+        profiler.dump_stats(profile_file)
+    except OSError as ex:
+        #Profiling must never fail a conversion
+        logging.warning('Cannot write profile {}: {}'.format(profile_file, ex))
+        return None
+    logging.info('Wrote profile: '+str(profile_file))
+
+    return profile_file
+
+
+def profile_files(profile_prefix):
+
+    #Profile files written by the run (and its worker processes) with profile_prefix
+    log_dir, base_name = os.path.split(profile_prefix)
+    if not os.path.exists(log_dir):
+        return []
+    return sorted([os.path.join(log_dir, file_name) for file_name in os.listdir(log_dir)
+                   if file_name.startswith(base_name+'_') and file_name.endswith('.pstats')])
+
+
+def format_hotspots(profile_files, top=DEFAULT_TOP):
+
+    #The top functions by cumulative time, over all the profile files
+    stream = io.StringIO()
+    stats = pstats.Stats(*profile_files, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+    return stream.getvalue().rstrip()
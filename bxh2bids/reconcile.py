@@ -0,0 +1,253 @@
+import os
+import logging
+
+import bxh2bids.bxh2bids as b2b
+import bxh2bids.manifest as manifest
+
+
+#Compare what a conversion of a session would produce with what is actually
+#on disk, without copying anything.
+#
+#Each output file is put into one of these groups:
+#   missing - expected, but not on disk
+#   extra   - written by an earlier conversion of this session (according to
+#             its manifest), still on disk, but no longer expected
+#   stale   - on disk, but older than its source, changed since it was written,
+#             or made from a source file that has changed since
+#   renamed - on disk under the name a previous conversion gave it, while the
+#             current session info gives the scan a different name
+#
+#Other files in the session's BIDS directories are listed as "unrecorded":
+#no manifest of this session attributes them to it (e.g. the outputs of
+#another BIAC session with the same sub/ses, or files added by hand), or
+#another session's manifest records them too. They are never deleted.
+#
+#With repair=True only the scans with missing, stale or renamed outputs are
+#converted again. Extra files are only deleted if remove_extra=True.
+
+
+MODALITY_DIRS = ['anat', 'func', 'dwi', 'fmap']
+
+
+def _session_output_dirs(target_study_dir, ses_dict):
+
+    session_info = {'sub': str(ses_dict['sub']), 'ses': str(ses_dict['ses'])}
+    return [b2b.output_dir_func(target_study_dir, session_info, modality) for modality in MODALITY_DIRS]
+
+
+def _files_on_disk(output_dirs):
+
+    on_disk = set()
+    for output_dir in output_dirs:
+        if not os.path.isdir(output_dir):
+            continue
+        for element in os.listdir(output_dir):
+            full_path = os.path.join(output_dir, element)
+            if os.path.isfile(full_path):
+                on_disk.add(full_path)
+
+    return on_disk
+
+
+def _output_kind(output_file):
+
+    #The part of a BIDS file name after the last '_' (e.g. "bold.nii.gz")
+    return os.path.split(output_file)[-1].split('_')[-1]
+
+
+def _is_stale(output_file, source_file, scan_manifest):
+
+    current_output = manifest.fingerprint(output_file)
+
+    if scan_manifest is not None and output_file in scan_manifest['outputs']:
+        #The output was changed after bxh2bids wrote it
+        if not manifest.same_fingerprint(scan_manifest['outputs'][output_file], current_output):
+            return True
+        #One of the files the scan was made from has changed since
+        for recorded_source, recorded_fingerprint in scan_manifest['sources'].items():
+            if not manifest.source_unchanged(recorded_fingerprint, recorded_source):
+                return True
+        return False
+
+    #Without a manifest, fall back on sizes and modification times
+    current_source = manifest.fingerprint(source_file)
+    if current_source is None:
+        return False
+    if current_source['mtime'] > current_output['mtime']:
+        return True
+    #Uncompressed images are copied byte for byte
+    if source_file[-4:] == '.nii' and output_file[-4:] == '.nii':
+        if current_source['size'] != current_output['size']:
+            return True
+
+    return False
+
+
+def other_session_outputs(manifest_dir, dataid):
+
+    #Output files the manifests of every other session record
+    outputs = set()
+    if manifest_dir is None or not os.path.isdir(manifest_dir):
+        return outputs
+    for file_name in os.listdir(manifest_dir):
+        if not file_name.startswith('bxh2bids_manifest_') or not file_name.endswith('.json'):
+            continue
+        other_dataid = file_name[len('bxh2bids_manifest_'):-len('.json')]
+        if other_dataid == dataid:
+            continue
+        other_manifest = manifest.read_session_manifest(manifest_dir, other_dataid)
+        for scan_manifest in other_manifest['scans'].values():
+            outputs.update(scan_manifest['outputs'])
+
+    return outputs
+
+
+def compare_session(bxh_list, multi_bxh_info_dict, ses_dict, target_study_dir, session_manifest=None, other_outputs=()):
+
+    #Build the report described at the top of this file for one planned session.
+    #other_outputs are the files other sessions' manifests record (see
+    #other_session_outputs()); they are never reported as extra.
+
+    if session_manifest is None:
+        session_manifest = {'scans': {}}
+    recorded_scans = session_manifest['scans']
+
+    bxh_files = {os.path.split(item['bxhfile'])[-1]: item['bxhfile'] for item in bxh_list}
+
+    #output file -> [bxh name, source file]
+    expected = {}
+    for bxh_name, bxh_info_dict in multi_bxh_info_dict.items():
+        for output_file, source_file in b2b.expected_outputs(bxh_files[bxh_name], bxh_info_dict, target_study_dir):
+            expected[output_file] = [bxh_name, source_file]
+
+    on_disk = _files_on_disk(_session_output_dirs(target_study_dir, ses_dict))
+
+    report = {'missing': [], 'extra': [], 'stale': [], 'renamed': []}
+    redo = set()
+
+    #Outputs a previous conversion wrote under a name that is no longer expected
+    renamed_from = {}
+    for bxh_name, scan_manifest in recorded_scans.items():
+        if bxh_name not in multi_bxh_info_dict:
+            continue
+        new_outputs = [output for output in expected if expected[output][0] == bxh_name]
+        for old_output in scan_manifest['outputs']:
+            #(a file another session also records is not this session's to replace)
+            if old_output in expected or old_output not in on_disk or old_output in other_outputs:
+                continue
+            for new_output in new_outputs:
+                if _output_kind(new_output) == _output_kind(old_output) and new_output not in renamed_from:
+                    renamed_from[new_output] = old_output
+                    report['renamed'].append([old_output, new_output])
+                    redo.add(bxh_name)
+                    break
+
+    #output file -> the bxh file a previous conversion made it from
+    recorded_owner = {}
+    for bxh_name, scan_manifest in recorded_scans.items():
+        for old_output in scan_manifest['outputs']:
+            recorded_owner[old_output] = bxh_name
+
+    for output_file in sorted(expected):
+        bxh_name, source_file = expected[output_file]
+        if output_file not in on_disk:
+            if output_file not in renamed_from:
+                report['missing'].append(output_file)
+            redo.add(bxh_name)
+        elif recorded_owner.get(output_file, bxh_name) != bxh_name:
+            #Two scans have swapped names; the file holds the other scan's data
+            report['stale'].append(output_file)
+            redo.add(bxh_name)
+        elif _is_stale(output_file, source_file, recorded_scans.get(bxh_name)):
+            report['stale'].append(output_file)
+            redo.add(bxh_name)
+
+    renamed_old = set(renamed_from.values())
+    not_expected = on_disk - set(expected) - renamed_old
+    report['extra'] = sorted([output for output in not_expected if output in recorded_owner and output not in other_outputs])
+    report['unrecorded'] = sorted(not_expected - set(report['extra']))
+    report['redo'] = sorted(redo)
+
+    return report
+
+
+def reconcile_session(dataid, ses_dict, source_study_dir, target_study_dir, manifest_dir, repair=False, remove_extra=False):
+
+    logging.info('-----START: reconcile_session-----')
+
+    bxh_list, multi_bxh_info_dict = b2b.plan_session(dataid, ses_dict, source_study_dir)
+    session_manifest = manifest.read_session_manifest(manifest_dir, dataid)
+
+    report = compare_session(bxh_list, multi_bxh_info_dict, ses_dict, target_study_dir, session_manifest,
+                             other_outputs=other_session_outputs(manifest_dir, dataid))
+    report['dataid'] = dataid
+
+    if repair:
+        repair_session(dataid, bxh_list, multi_bxh_info_dict, target_study_dir, manifest_dir, report, session_manifest, remove_extra)
+
+    logging.info('-----FINISH: reconcile_session-----')
+
+    return report
+
+
+def repair_session(dataid, bxh_list, multi_bxh_info_dict, target_study_dir, manifest_dir, report, session_manifest=None, remove_extra=False):
+
+    #Convert again only the scans the report says need it.
+    if session_manifest is None:
+        session_manifest = {'scans': {}}
+
+    bxh_files = {os.path.split(item['bxhfile'])[-1]: item['bxhfile'] for item in bxh_list}
+    renamed_old = [old_output for old_output, new_output in report['renamed']]
+
+    to_convert = []
+    replace = {}
+    for bxh_name in report['redo']:
+        bxh_file = bxh_files[bxh_name]
+        bxh_info_dict = multi_bxh_info_dict[bxh_name]
+        to_convert.append([bxh_file, bxh_info_dict])
+        #This scan's current outputs are replaced by the new conversion
+        replace[bxh_file] = [output for output, source in b2b.expected_outputs(bxh_file, bxh_info_dict, target_study_dir)]
+        if bxh_name in session_manifest['scans']:
+            replace[bxh_file] = replace[bxh_file] + [output for output in session_manifest['scans'][bxh_name]['outputs'] if output in renamed_old]
+
+    failures = {}
+    if to_convert:
+        failures = b2b.convert_session_scans(dataid, to_convert, target_study_dir, replace=replace)
+
+    if remove_extra:
+        for extra_file in report['extra']:
+            logging.info('Removing extra file: '+str(extra_file))
+            os.remove(extra_file)
+
+    #Record every planned scan, and forget the ones that are no longer planned
+    scan_records = {}
+    for bxh_name, bxh_info_dict in multi_bxh_info_dict.items():
+        if bxh_files[bxh_name] in failures:
+            continue
+        outputs = b2b.expected_outputs(bxh_files[bxh_name], bxh_info_dict, target_study_dir)
+        scan_records[bxh_name] = manifest.scan_record(bxh_files[bxh_name], outputs, bxh_info_dict,
+                                                      previous=session_manifest['scans'].get(bxh_name))
+    no_longer_planned = [bxh_name for bxh_name in session_manifest['scans'] if bxh_name not in multi_bxh_info_dict]
+    failed_records = {os.path.split(bxh_file)[-1]: manifest.failure_record(bxh_file, failure) for bxh_file, failure in failures.items()}
+    manifest.update_session_manifest(manifest_dir, dataid, scan_records, remove=no_longer_planned, failed=failed_records)
+
+    if failures:
+        raise b2b.ScanConversionError(dataid, failures)
+
+
+def format_report(report):
+
+    lines = ['Session: {}'.format(report['dataid'])]
+    for group in ['missing', 'extra', 'stale']:
+        lines.append('  {} ({}):'.format(group, len(report[group])))
+        for file_name in report[group]:
+            lines.append('    '+str(file_name))
+    lines.append('  renamed ({}):'.format(len(report['renamed'])))
+    for old_output, new_output in report['renamed']:
+        lines.append('    {} -> {}'.format(old_output, new_output))
+    if report['unrecorded']:
+        lines.append('  unrecorded, not this session\'s to remove ({}):'.format(len(report['unrecorded'])))
+        for file_name in report['unrecorded']:
+            lines.append('    '+str(file_name))
+
+    return '\n'.join(lines)
@@ -0,0 +1,74 @@
+import time
+import errno
+import logging
+
+
+#Retries of file operations that fail for a moment.
+#
+#On NFS and other shared file systems a read or write can fail with EIO or
+#ESTALE (or time out) and work again a moment later, e.g. while a server
+#fails over. Such errors are retried with exponential backoff: the first
+#retry waits delay seconds, every further one BACKOFF_FACTOR times longer,
+#up to max_delay. Any other error is raised at once.
+#
+#    policy = RetryPolicy(retries=3, delay=1.0)
+#    policy.call(os.replace, staged_file, final_file)
+
+
+#Error numbers that are worth trying again
+TRANSIENT_ERRNOS = set([errno.EIO, errno.ESTALE, errno.ETIMEDOUT, errno.EAGAIN, errno.EBUSY])
+
+DEFAULT_RETRIES = 3
+DEFAULT_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+BACKOFF_FACTOR = 2
+
+
+def is_transient(ex):
+
+    return isinstance(ex, OSError) and ex.errno in TRANSIENT_ERRNOS
+
+
+class RetryPolicy(object):
+
+    def __init__(self, retries=DEFAULT_RETRIES, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        if retries < 0 or delay < 0:
+            raise RuntimeError('Retries and retry delay cannot be negative.')
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+
+        #Seconds to wait after the attempt-th attempt failed
+        return min(self.delay*BACKOFF_FACTOR**(attempt-1), self.max_delay)
+
+    def retry_after(self, ex, attempt, what='Operation'):
+
+        #Called when the attempt-th attempt failed with ex. Waits and returns
+        #True if it should be tried again, returns False otherwise.
+        if not is_transient(ex) or attempt > self.retries:
+            return False
+        seconds = self.backoff(attempt)
+        logging.warning('{} failed ({}); trying again in {:.1f} s ({} of {}).'.format(what, ex, seconds, attempt, self.retries))
+        time.sleep(seconds)
+        return True
+
+    def call(self, function, *args, **kwargs):
+
+        #function(*args, **kwargs), tried again after transient errors
+        attempt = 1
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except OSError as ex:
+                if not self.retry_after(ex, attempt, getattr(function, '__name__', 'Operation')):
+                    raise
+            attempt = attempt+1
+
+
+#Used when no policy is given
+DEFAULT_POLICY = RetryPolicy()
+
+#Raise every error at once
+NO_RETRIES = RetryPolicy(retries=0)
@@ -1,37 +1,535 @@
-
-
-import os, sys
+import os, sys, re
 import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import bxh2bids.bxh2bids as b2b
 
-def bidsify(proj_dir, biac_dirs):
+
+def _study_dirs(proj_dir):
 
     #Set information about your study sessions
-    source_study_dir=os.path.join(proj_dir, 'sourcedata')
-    target_study_dir=os.path.join(proj_dir,'rawdata')
-    log_dir=os.path.join(proj_dir,'derivatives','bxh2bids_logs')
-    ses_info_dir=os.path.join(proj_dir,'code','bxh2bids_ses_info')
+    return {
+            'source_study_dir': os.path.join(proj_dir, 'sourcedata'),
+            'target_study_dir': os.path.join(proj_dir, 'rawdata'),
+            'log_dir': os.path.join(proj_dir, 'derivatives', 'bxh2bids_logs'),
+            'manifest_dir': os.path.join(proj_dir, 'derivatives', 'bxh2bids_manifests'),
+            'ses_info_dir': os.path.join(proj_dir, 'code', 'bxh2bids_ses_info'),
+            #Events .tsv files of sessions converted from a session table
+            'events_files_dir': os.path.join(proj_dir, 'code', 'bxh2bids_ses_info'),
+            }
 
-    bad_data = []
-    good_data = []
+
+def find_study_sessions(proj_dir):
+
+    #Every session with a session info file is part of the study
+    ses_info_dir = _study_dirs(proj_dir)['ses_info_dir']
+    r = re.compile(r'^bxh2bids_(\d{8}_\d{5})\.json$')
+    biac_dirs = []
+    if os.path.exists(ses_info_dir):
+        for element in sorted(os.listdir(ses_info_dir)):
+            match = r.match(element)
+            if match is not None:
+                biac_dirs.append(match.group(1))
+
+    return biac_dirs
+
+
+def read_ses_info(ses_info_dir, unique_id):
+
+    ses_info_file = os.path.join(ses_info_dir, 'bxh2bids_{}.json'.format(unique_id))
+    if not os.path.exists(ses_info_file):
+        print('Session info file cannot be found: {}'.format(ses_info_file))
+        print('NOTE: As of 10/9/19 bxh2bids requires the session info file names to be of the form: "bxh2bids_YYYYMMDD_ZZZZZ.json".')
+        print('Here, YYYYMMDD_ZZZZZ is the scan date and exam number.')
+        raise RuntimeError('Session info file not found')
+    with open(ses_info_file) as fd:
+        ses_dict = json.loads(fd.read())
+
+    return ses_dict
+
+
+def check(proj_dir, biac_dirs, incremental=False, scan_filter=None, data_infos=None):
+
+    #Pre-flight checks for a batch; returns True if every session passed.
+    #data_infos ({dataid: data_info}, see session_table.py) describes sessions
+    #that are converted from their scan descriptions instead of session info files.
+    import bxh2bids.preflight as preflight
+
+    dirs = _study_dirs(proj_dir)
+    problems = preflight.validate_batch(biac_dirs, dirs['ses_info_dir'], dirs['source_study_dir'],
+                                        dirs['target_study_dir'], incremental=incremental, scan_filter=scan_filter,
+                                        data_infos=data_infos, events_files_dir=dirs['events_files_dir'],
+                                        manifest_dir=dirs['manifest_dir'])
+    print(preflight.format_report(problems))
+    failed = [dataid for dataid in problems if problems[dataid]]
+    print('Sessions that failed pre-flight checks: '+str(failed))
+
+    return not failed
+
+
+#Number of images converted by a calibration run
+CALIBRATION_IMAGES = 3
+
+
+def estimate(proj_dir, biac_dirs, jobs=1, incremental=False, calibrate=False, scan_filter=None, scan_jobs=1, strategy='lpt',
+             data_infos=None):
+
+    #Expected output size, free space and run time for a batch
+    import bxh2bids.estimate as est
+
+    dirs = _study_dirs(proj_dir)
+
+    calibration = est.read_calibration(dirs['log_dir'])
+    if calibrate:
+        #Time a few of the batch's own images on the target file system
+        planned_images = []
+        for unique_id in biac_dirs:
+            if len(planned_images) >= CALIBRATION_IMAGES:
+                break
+            if data_infos is not None:
+                _, multi_bxh_info_dict = b2b.plan_auto_session(unique_id, data_infos[unique_id], dirs['source_study_dir'],
+                                                               dirs['events_files_dir'], scan_filter=scan_filter)
+            else:
+                ses_dict = read_ses_info(dirs['ses_info_dir'], unique_id)
+                _, multi_bxh_info_dict = b2b.plan_session(unique_id, ses_dict, dirs['source_study_dir'], scan_filter=scan_filter)
+            planned_images = planned_images + [entry['orig_image'] for entry in multi_bxh_info_dict.values()]
+        if planned_images:
+            print('Calibrating with {} images...'.format(len(planned_images[:CALIBRATION_IMAGES])))
+            os.makedirs(dirs['target_study_dir'], exist_ok=True)
+            calibration = est.calibrate(planned_images[:CALIBRATION_IMAGES], dirs['target_study_dir'], dirs['log_dir'])
+
+    session_sizes = _size_sessions(proj_dir, biac_dirs, calibration, incremental=incremental, scan_filter=scan_filter,
+                                   data_infos=data_infos)
+
+    batch_estimate = est.estimate_batch(session_sizes, dirs['target_study_dir'], jobs=jobs, calibration=calibration,
+                                        scan_jobs=scan_jobs, strategy=strategy)
+    print(est.format_estimate(batch_estimate))
+    batch_estimate['session_sizes'] = session_sizes
+
+    return batch_estimate
+
+
+def _size_sessions(proj_dir, biac_dirs, calibration=None, incremental=False, scan_filter=None, quiet=False, data_infos=None):
+
+    #Returns {dataid: estimate.size_session() result}. With quiet=True a
+    #session that cannot be sized counts as empty; it will fail on its own
+    #when it is converted.
+    import bxh2bids.estimate as est
+
+    dirs = _study_dirs(proj_dir)
+    session_sizes = {}
     for unique_id in biac_dirs:
-        dataid = unique_id
-        ses_info_file = os.path.join(ses_info_dir, 'bxh2bids_{}.json'.format(unique_id))
-        if not os.path.exists(ses_info_file):
-            print('Session info file cannot be found: {}'.format(ses_info_file))
-            print('NOTE: As of 10/9/19 bxh2bids requires the session info file names to be of the form: "bxh2bids_YYYYMMDD_ZZZZZ.json".')
-            print('Here, YYYYMMDD_ZZZZZ is the scan date and exam number.')
-            raise RuntimeError('Session info file not found')
-        with open(ses_info_file) as fd:
-            ses_dict = json.loads(fd.read())
+        try:
+            if data_infos is not None:
+                session_sizes[unique_id] = est.size_auto_session(unique_id, data_infos[unique_id], dirs['source_study_dir'],
+                                                                 dirs['target_study_dir'], dirs['events_files_dir'], calibration=calibration,
+                                                                 manifest_dir=dirs['manifest_dir'], incremental=incremental,
+                                                                 scan_filter=scan_filter)
+                continue
+            ses_dict = read_ses_info(dirs['ses_info_dir'], unique_id)
+            session_sizes[unique_id] = est.size_session(unique_id, ses_dict, dirs['source_study_dir'], dirs['target_study_dir'],
+                                                        calibration=calibration, manifest_dir=dirs['manifest_dir'],
+                                                        incremental=incremental, scan_filter=scan_filter)
+        except Exception:
+            if not quiet:
+                raise
+            session_sizes[unique_id] = {}
+
+    return session_sizes
 
+
+def bidsify(proj_dir, biac_dirs, incremental=False, preflight=True, scan_filter=None, jobs=1, scan_jobs=1, strategy='lpt',
+            memory_budget=None, retry_policy=None, data_infos=None, log_level=logging.INFO, trace=True, metrics_file=None,
+            metrics_interval=None, profile=False, profile_scan=None, profile_top=None):
+
+    #scan_filter (see scan_filter.make_scan_filter) limits the conversion to some of the scans.
+    #With jobs > 1, that many sessions are converted at once, each in its own process;
+    #with jobs='auto' the number is adjusted to the measured throughput (see concurrency.py).
+    #With scan_jobs > 1, the scans of each session are converted that many at a time in threads.
+    #strategy is the order sessions are handed to the workers in (see scheduler.py).
+    #memory_budget is the memory, in bytes, concurrent conversions may use
+    #(see admission.py); by default a fraction of the available memory.
+    #retry_policy (retry.RetryPolicy) says how transient I/O errors are retried.
+    #A scan that fails does not stop the rest of its session, but the session
+    #counts as failed; an incremental run converts the failed scans again.
+    #data_infos ({dataid: data_info}) converts the sessions from their scan
+    #descriptions, as multi_autobxhtobids() does (see bidsify_table()).
+    #log_level is the lowest level written to the session log files.
+    #With trace=True, the time of every conversion stage of every scan is
+    #written to a bxh2bids_trace_*.jsonl file in the log directory (see trace.py).
+    #With a metrics_file, Prometheus metrics of the batch are written to it
+    #every metrics_interval seconds (see metrics.py).
+    #With profile=True, every session is profiled with cProfile (with a
+    #profile_scan, only the scan with that .bxh file name) and the profiles
+    #are written to bxh2bids_profile_*.pstats files in the log directory
+    #(see profiling.py). With profile_top, the profile_top functions with
+    #the most cumulative time are printed at the end.
+    import bxh2bids.estimate as est
+    import bxh2bids.scheduler as scheduler
+    import bxh2bids.admission as admission
+    import bxh2bids.concurrency as concurrency
+    import bxh2bids.session_log as session_log
+
+    #Lines logged outside any session (e.g. while sessions are planned here)
+    #go to the run log
+    run_log = session_log.start_run_log(_study_dirs(proj_dir)['log_dir'], level=log_level)
+    try:
+        controller = None
+        planned_jobs = jobs
+        if jobs == 'auto':
+            controller = concurrency.AimdController(log_dir=_study_dirs(proj_dir)['log_dir'])
+            #The pool can grow to max_jobs workers; plan for the ones it starts with
+            jobs = controller.max_jobs
+            planned_jobs = controller.jobs
+            print('Adjusting the number of workers between {} and {}, starting at {}.'.format(controller.min_jobs, controller.max_jobs,
+                                                                                             controller.jobs))
+
+        #Check the whole batch before any data are copied
+        schedule = None
+        session_sizes = None
+        if preflight:
+            if not check(proj_dir, biac_dirs, incremental=incremental, scan_filter=scan_filter, data_infos=data_infos):
+                raise RuntimeError('Pre-flight checks failed; nothing was converted.')
+            batch_estimate = estimate(proj_dir, biac_dirs, jobs=planned_jobs, incremental=incremental, scan_filter=scan_filter,
+                                      scan_jobs=scan_jobs, strategy=strategy, data_infos=data_infos)
+            if not batch_estimate['fits']:
+                raise RuntimeError('Not enough free space on the target file system; nothing was converted.')
+            schedule = batch_estimate['schedule']
+            session_sizes = batch_estimate['session_sizes']
+        elif jobs > 1 or scan_jobs > 1:
+            calibration = est.read_calibration(_study_dirs(proj_dir)['log_dir'])
+            session_sizes = _size_sessions(proj_dir, biac_dirs, calibration, incremental=incremental, scan_filter=scan_filter, quiet=True,
+                                           data_infos=data_infos)
+            throughput = est.DEFAULT_THROUGHPUT if calibration is None else calibration['throughput']
+            schedule = scheduler.plan_batch(session_sizes, throughput, jobs=planned_jobs, scan_jobs=scan_jobs, strategy=strategy)
+
+        #Memory admission control is only needed when conversions run at once
+        session_memory = None
+        if jobs > 1 or scan_jobs > 1:
+            if memory_budget is None:
+                memory_budget = admission.default_budget()
+            session_memory = {dataid: admission.session_peak_memory(scan_sizes, scan_jobs) for dataid, scan_sizes in session_sizes.items()}
+            print('Memory budget: {:.2f} GiB'.format(memory_budget/2**30))
+
+        trace_file = None
+        if trace:
+            import bxh2bids.trace as tracing
+            trace_file = tracing.new_trace_file(_study_dirs(proj_dir)['log_dir'])
+
+        profile_prefix = None
+        if profile or profile_scan is not None or profile_top:
+            import bxh2bids.profiling as profiling
+            profile_prefix = profiling.new_profile_prefix(_study_dirs(proj_dir)['log_dir'])
+
+        conversion_metrics = None
+        if metrics_file is not None:
+            import bxh2bids.metrics as metrics
+            conversion_metrics = metrics.ConversionMetrics(
+                metrics_file, 'batch', interval=metrics.DEFAULT_INTERVAL if metrics_interval is None else metrics_interval)
+            conversion_metrics.set_queue_depth(len(biac_dirs))
+            conversion_metrics.start()
+
+        start = time.time()
+        session_order = biac_dirs if schedule is None else schedule['order']
         try:
-            b2b.multi_bxhtobids(dataid, ses_dict, source_study_dir, target_study_dir, log_dir)
-            good_data.append(dataid)
+            results = run_sessions(proj_dir, session_order, jobs=jobs, incremental=incremental, scan_filter=scan_filter,
+                                   scan_jobs=scan_jobs, memory_budget=memory_budget, session_memory=session_memory, controller=controller,
+                                   retry_policy=retry_policy, data_infos=data_infos, log_level=log_level,
+                                   trace_file=trace_file, metrics=conversion_metrics, profile_prefix=profile_prefix,
+                                   profile_scan=profile_scan)
+        finally:
+            if conversion_metrics is not None:
+                conversion_metrics.stop()
+        achieved = time.time()-start
+        #(run_sessions() returns them in schedule order)
+        order = {dataid: index for index, dataid in enumerate(biac_dirs)}
+        results = sorted(results, key=lambda result: order[result['dataid']])
+
+        good_data = [result['dataid'] for result in results if result['ok']]
+        bad_data = [result['dataid'] for result in results if not result['ok']]
+        for result in results:
+            if not result['ok']:
+                print('    {}: {}'.format(result['dataid'], result['error']))
+        failed_scans = sum([len(result.get('failed_scans', [])) for result in results])
+        if failed_scans:
+            print('{} scan(s) failed; the rest of their sessions were converted. Run again with --incremental to retry them.'.format(
+                  failed_scans))
+        print('Data that ran: '+str(good_data))
+        print('Data that did NOT run: '+str(bad_data))
+        print('Converted {} of {} sessions in {:.1f} s with {} job(s).'.format(len(good_data), len(results), achieved,
+                                                                              jobs if controller is None else 'auto'))
+        if schedule is not None:
+            measured = {result['dataid']: result['seconds'] for result in results if result['seconds'] is not None}
+            print(scheduler.format_schedule(schedule, achieved_seconds=achieved, measured_seconds=measured))
+        if trace_file is not None and os.path.exists(trace_file):
+            print('Stage timings: {} (see "bxh2bids trace summarize")'.format(trace_file))
+        if profile_prefix is not None:
+            profile_files = profiling.profile_files(profile_prefix)
+            if not profile_files:
+                print('Nothing was profiled{}.'.format('' if profile_scan is None else
+                                                       ' (no scan named {} was converted)'.format(profiling.scan_name(profile_scan))))
+            else:
+                print('Profiles ({}):'.format(len(profile_files)))
+                for profile_file in profile_files:
+                    print('    '+profile_file)
+                if profile_top:
+                    print(profiling.format_hotspots(profile_files, top=profile_top))
+
+        return results
+    finally:
+        session_log.stop_run_log(run_log)
+
+
+def bidsify_table(proj_dir, table_file, **kwargs):
+
+    #Convert every session listed in a session table (see session_table.py)
+    #from its scan descriptions. The table is checked first, and nothing is
+    #converted if any row has a problem. kwargs are those of bidsify().
+    import bxh2bids.session_table as session_table
+
+    data_infos, problems = session_table.read_session_table(table_file)
+    if problems:
+        print('Session table {} has {} problem(s):'.format(table_file, len(problems)))
+        print(session_table.format_problems(problems))
+        raise RuntimeError('Session table has problems; nothing was converted.')
+    print('Session table lists {} sessions.'.format(len(data_infos)))
+
+    return bidsify(proj_dir, list(data_infos), data_infos=data_infos, **kwargs)
+
+
+def study_converter(proj_dir, incremental=False, scan_filter=None, scan_jobs=1, memory_limit=None, retry_policy=None, log_level=logging.INFO,
+                    trace_file=None, profile_prefix=None, profile_scan=None):
+
+    #A bxh2bids.Converter for the sessions of a study. memory_limit is the
+    #memory, in bytes, the scan threads of a session may use together.
+    import bxh2bids.admission as admission
+
+    dirs = _study_dirs(proj_dir)
+    memory_budget = None
+    if memory_limit is not None and scan_jobs > 1:
+        memory_budget = admission.MemoryBudget(memory_limit)
+
+    return b2b.Converter(dirs['source_study_dir'], dirs['target_study_dir'], dirs['log_dir'], manifest_dir=dirs['manifest_dir'],
+                         events_files_dir=dirs['events_files_dir'], incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs, memory_budget=memory_budget,
+                         retry_policy=retry_policy, log_level=log_level, trace_file=trace_file, profile_prefix=profile_prefix,
+                         profile_scan=profile_scan)
+
+
+def _bidsify_session(proj_dir, unique_id, incremental=False, scan_filter=None, scan_jobs=1, memory_limit=None, converter=None,
+                     retry_policy=None, data_info=None, log_level=logging.INFO, trace_file=None, profile_prefix=None,
+                     profile_scan=None):
+
+    #Convert one session and return a summary of how it went. This runs in a
+    #worker process when sessions are converted in parallel, so it must not
+    #raise and everything it returns must be picklable. A converter made by
+    #study_converter() can be passed to be reused; otherwise one is made
+    #from the other arguments. If only some scans failed, they are listed in
+    #'failed_scans' as {'bxh_file', 'error', 'transient', 'attempts'}.
+    #With a data_info (a session table row) the session is converted from
+    #its scan descriptions instead of its session info file.
+    #'scans' lists every scan that was converted or failed, as
+    #bxh2bids.scan_statistics describes (for metrics.py).
+    dirs = _study_dirs(proj_dir)
+    result = {'dataid': unique_id, 'ok': False, 'error': None, 'seconds': None, 'scans': []}
+    start = time.time()
+    statistics_token = b2b.scan_statistics.set(result['scans'])
+    try:
+        if converter is None:
+            converter = study_converter(proj_dir, incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs,
+                                        memory_limit=memory_limit, retry_policy=retry_policy, log_level=log_level,
+                                        trace_file=trace_file, profile_prefix=profile_prefix, profile_scan=profile_scan)
+        if data_info is not None:
+            converter.convert_auto(unique_id, data_info)
+        else:
+            ses_dict = read_ses_info(dirs['ses_info_dir'], unique_id)
+            converter.convert(unique_id, ses_dict)
+        result['ok'] = True
+    except b2b.ScanConversionError as ex:
+        result['error'] = str(ex)
+        result['failed_scans'] = [dict(failure, bxh_file=bxh_file) for bxh_file, failure in sorted(ex.failures.items())]
+    except Exception as ex:
+        result['error'] = str(ex)
+    finally:
+        b2b.scan_statistics.reset(statistics_token)
+    result['seconds'] = time.time()-start
+
+    return result
+
+
+def _print_session_result(result):
+
+    if result['ok']:
+        print('Data set finished: {} ({:.1f} s)'.format(result['dataid'], result['seconds']))
+    else:
+        print('Data set failed to run: '+str(result['dataid']))
+        if 'failed_scans' not in result:
+            print(result['error'])
+            return
+        print('{} scan(s) failed; the other scans were converted:'.format(len(result['failed_scans'])))
+        for failure in result['failed_scans']:
+            print('    {}: {} (after {} attempt(s))'.format(os.path.split(failure['bxh_file'])[-1], failure['error'], failure['attempts']))
+
+
+def run_sessions(proj_dir, biac_dirs, jobs=1, incremental=False, scan_filter=None, scan_jobs=1, memory_budget=None, session_memory=None,
+                 controller=None, retry_policy=None, data_infos=None, log_level=logging.INFO, trace_file=None,
+                 metrics=None, profile_prefix=None, profile_scan=None):
+
+    #Returns one _bidsify_session() result per session, in biac_dirs order.
+    #With a memory_budget (bytes), a session only starts while the estimated
+    #peak memory of the running sessions (session_memory, {dataid: bytes})
+    #fits in it; otherwise it waits for a running session to finish.
+    #With a controller (concurrency.AimdController), the pool has jobs
+    #workers but only controller.jobs sessions run at once; it is told the
+    #source bytes and time of the scans of every finished session.
+    #data_infos ({dataid: data_info}) is passed on to _bidsify_session().
+    #Every session, in any worker, writes its stage timings to trace_file
+    #and, with a profile_prefix, its profile (see profiling.py).
+    #metrics (metrics.ConversionMetrics) is told about every finished session
+    #and kept up to date with the sessions waiting and running.
+    import bxh2bids.admission as admission
+
+    if data_infos is None:
+        data_infos = {}
+    if jobs <= 1:
+        #One converter for every session
+        converter = study_converter(proj_dir, incremental=incremental, scan_filter=scan_filter, scan_jobs=scan_jobs,
+                                    memory_limit=memory_budget, retry_policy=retry_policy, log_level=log_level,
+                                    trace_file=trace_file, profile_prefix=profile_prefix, profile_scan=profile_scan)
+        results = []
+        for index, unique_id in enumerate(biac_dirs):
+            if metrics is not None:
+                metrics.set_queue_depth(len(biac_dirs)-index-1)
+                metrics.set_active_workers(1)
+            results.append(_bidsify_session(proj_dir, unique_id, converter=converter, data_info=data_infos.get(unique_id)))
+            _print_session_result(results[-1])
+            if metrics is not None:
+                metrics.set_active_workers(0)
+                metrics.session_finished(results[-1])
+        return results
+
+    budget = None
+    if memory_budget is not None:
+        budget = admission.MemoryBudget(memory_budget)
+    if session_memory is None:
+        session_memory = {}
+    running_limit = jobs if controller is None else controller.jobs
+
+    results = {}
+    pending = list(biac_dirs)
+    running = {}
+    reserved = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            #Keep every worker busy, but only hand out work as it is needed
+            while pending and len(running) < running_limit:
+                unique_id = pending[0]
+                needed = session_memory.get(unique_id, admission.JOB_OVERHEAD_BYTES)
+                if budget is not None and not budget.try_acquire(needed):
+                    logging.info('Memory budget full; {} waits for a running session to finish.'.format(unique_id))
+                    break
+                pending.pop(0)
+                try:
+                    future = executor.submit(_bidsify_session, proj_dir, unique_id, incremental=incremental, scan_filter=scan_filter,
+                                             scan_jobs=scan_jobs, memory_limit=needed if budget is not None else None,
+                                             retry_policy=retry_policy, data_info=data_infos.get(unique_id), log_level=log_level,
+                                             trace_file=trace_file, profile_prefix=profile_prefix, profile_scan=profile_scan)
+                    running[future] = unique_id
+                    reserved[future] = needed
+                except Exception as ex:
+                    if budget is not None:
+                        budget.release(needed)
+                    results[unique_id] = {'dataid': unique_id, 'ok': False, 'error': str(ex), 'seconds': None}
+                    _print_session_result(results[unique_id])
+                    if metrics is not None:
+                        metrics.session_finished(results[unique_id])
+            if metrics is not None:
+                metrics.set_queue_depth(len(pending))
+                metrics.set_active_workers(len(running))
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                unique_id = running.pop(future)
+                if budget is not None:
+                    budget.release(reserved.pop(future))
+                try:
+                    results[unique_id] = future.result()
+                except Exception as ex:
+                    #The worker process died (e.g. it ran out of memory)
+                    results[unique_id] = {'dataid': unique_id, 'ok': False, 'error': 'Worker failed: '+str(ex), 'seconds': None}
+                _print_session_result(results[unique_id])
+                if metrics is not None:
+                    metrics.session_finished(results[unique_id])
+                if controller is not None:
+                    running_limit = controller.record([[scan['bytes_read'], scan['seconds']] for scan in results[unique_id].get('scans', [])
+                                                       if scan['ok']])
+        if metrics is not None:
+            metrics.set_active_workers(0)
+
+    return [results[unique_id] for unique_id in biac_dirs]
+
+
+def reconcile(proj_dir, biac_dirs=None, repair=False, remove_extra=False):
+
+    import bxh2bids.reconcile as rec
+
+    dirs = _study_dirs(proj_dir)
+    if biac_dirs is None:
+        biac_dirs = find_study_sessions(proj_dir)
+
+    reports = []
+    bad_data = []
+    for unique_id in biac_dirs:
+        try:
+            ses_dict = read_ses_info(dirs['ses_info_dir'], unique_id)
+            report = rec.reconcile_session(unique_id, ses_dict, dirs['source_study_dir'], dirs['target_study_dir'],
+                                           dirs['manifest_dir'], repair=repair, remove_extra=remove_extra)
         except Exception as ex:
-            print('Data set failed to run: '+str(dataid))
+            print('Data set failed to reconcile: '+str(unique_id))
             print(ex)
-            bad_data.append(dataid)
+            bad_data.append(unique_id)
+            continue
+        print(rec.format_report(report))
+        reports.append(report)
+
+    differing = [report['dataid'] for report in reports
+                 if report['missing'] or report['extra'] or report['stale'] or report['renamed']]
+    print('Sessions with differences: '+str(differing))
+    print('Data that could NOT be reconciled: '+str(bad_data))
+
+    return reports
+
+
+def _regenerate_session_sidecars(proj_dir, unique_id, events):
+
+    dirs = _study_dirs(proj_dir)
+    ses_dict = read_ses_info(dirs['ses_info_dir'], unique_id)
+    return b2b.regenerate_sidecars(unique_id, ses_dict, dirs['source_study_dir'], dirs['target_study_dir'],
+                                   events=events, manifest_dir=dirs['manifest_dir'])
+
+
+def regenerate_sidecars(proj_dir, biac_dirs=None, events=False, jobs=1):
+
+    #Rewrite sidecar .json, .bvec/.bval and (optionally) events .tsv files
+    #for sessions that have already been converted, one process per session.
+    if biac_dirs is None:
+        biac_dirs = find_study_sessions(proj_dir)
+
+    bad_data = []
+    good_data = []
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {unique_id: executor.submit(_regenerate_session_sidecars, proj_dir, unique_id, events)
+                   for unique_id in biac_dirs}
+        for unique_id, future in futures.items():
+            try:
+                scans = future.result()
+                print('Sidecars written for {}: {} scans'.format(unique_id, len(scans)))
+                good_data.append(unique_id)
+            except Exception as ex:
+                print('Data set failed to run: '+str(unique_id))
+                print(ex)
+                bad_data.append(unique_id)
 
     print('Data that ran: '+str(good_data))
     print('Data that did NOT run: '+str(bad_data))
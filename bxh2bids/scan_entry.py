@@ -0,0 +1,115 @@
+import sys
+
+
+#Internal model for one bxh file's conversion information.
+#
+#bxh2bids used to keep this information in a plain dictionary per bxh file
+#("this_entry_dict" in create_internal_info()). Every dictionary carries its
+#own hash table of repeated string keys, which adds up quickly when a whole
+#study is planned in one process. ScanEntry stores the same information in
+#fixed slots and interns the BIDS entity values (sub, ses, task, run, ...),
+#which repeat across thousands of scans.
+#
+#ScanEntry still behaves like the old dictionary, so existing code such as
+#
+#   bxh_info_dict['scan_type']
+#   'run' in bxh_info_dict.keys()
+#   bxh_info_dict['run'] = '01'
+#
+#keeps working. A field that has never been set is treated as a missing key.
+
+
+#Every field a bxh entry can hold, in the order they are listed in as_dict()
+ENTRY_FIELDS = ('orig_image', 'biac_json', 'scan_type', 'scan_label', 'sub', 'ses',
+                'bxh_desc', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo',
+                'tsv_file', 'ignore', 'IntendedFor', 'output_name', 'output_prefix',
+                'pe_code')
+
+#Fields whose values repeat across many scans and are worth interning
+INTERNED_FIELDS = frozenset(['scan_type', 'scan_label', 'sub', 'ses', 'bxh_desc',
+                             'task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo',
+                             'ignore', 'pe_code'])
+
+
+class ScanEntry():
+
+    __slots__ = ENTRY_FIELDS
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, entry_dict):
+        return cls(**entry_dict)
+
+    def __setattr__(self, key, value):
+        if key in INTERNED_FIELDS and type(value) is str:
+            value = sys.intern(value)
+        object.__setattr__(self, key, value)
+
+    #--Dictionary-compatible view--#
+
+    def __getitem__(self, key):
+        if key not in ENTRY_FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in ENTRY_FIELDS:
+            raise KeyError('Unknown bxh entry field: '+str(key))
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ENTRY_FIELDS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (ScanEntry, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return 'ScanEntry({})'.format(self.as_dict())
+
+    def keys(self):
+        return [key for key in ENTRY_FIELDS if hasattr(self, key)]
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in ENTRY_FIELDS else default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def copy(self):
+        return ScanEntry(**self.as_dict())
+
+    def as_dict(self):
+        return dict(self.items())
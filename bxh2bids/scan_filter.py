@@ -0,0 +1,124 @@
+import os
+import re
+import logging
+
+
+#Select a subset of the scans in a session.
+#
+#A scan filter is a dictionary with any of these keys (a missing key, or
+#None, means "any"):
+#   scan_types   - BIDS scan types, e.g. ['func']
+#   labels       - BIDS scan labels, e.g. ['T1w', 'bold']
+#   tasks        - BIDS task labels, e.g. ['faces']; scans without a task are excluded
+#   acquisitions - BIAC acquisition numbers, e.g. ['005'] or ['005_01']
+#   desc_regex   - compiled regular expression searched for in the scan description
+#
+#Filters are applied while a session is planned, as early as possible:
+#   - acquisition numbers (and, with a session info file, tasks) are checked on
+#     the bxh file names, so excluded bxh files are never opened
+#   - scan types, labels and descriptions are checked as soon as the scan
+#     description has been looked up, before images are matched and named
+#
+#Run labels that bxh2bids adds to repeated scans with identical names are
+#worked out among the selected scans only. Give such scans run labels in the
+#session info file if they are converted separately.
+
+
+FILTER_KEYS = ['scan_types', 'labels', 'tasks', 'acquisitions', 'desc_regex']
+
+
+def make_scan_filter(scan_types=None, labels=None, tasks=None, acquisitions=None, desc_regex=None):
+
+    #Returns a scan filter, or None if nothing is filtered
+    scan_filter = {
+                   'scan_types': scan_types,
+                   'labels': labels,
+                   'tasks': tasks,
+                   'acquisitions': acquisitions,
+                   'desc_regex': re.compile(desc_regex) if isinstance(desc_regex, str) else desc_regex
+                   }
+    if all([scan_filter[key] is None for key in FILTER_KEYS]):
+        return None
+
+    return scan_filter
+
+
+def acquisition_number(bxh_file):
+
+    #Returns [series number, series number with part] from a BIAC file name,
+    #e.g. ['003', '003'] for bia5_12345_003.bxh and ['005', '005_01'] for
+    #run12345_005_01.bxh, or None if the name has no acquisition number.
+    stem = os.path.split(bxh_file)[-1].split('.')[0]
+    match = re.search(r'_(\d{3})(_\d{2})?$', stem)
+    if match is None:
+        return None
+
+    return [match.group(1), match.group(1)+(match.group(2) or '')]
+
+
+def acquisition_selected(scan_filter, bxh_file):
+
+    if scan_filter is None or scan_filter.get('acquisitions') is None:
+        return True
+
+    numbers = acquisition_number(bxh_file)
+    if numbers is None:
+        return False
+
+    return bool(set(numbers) & set(scan_filter['acquisitions']))
+
+
+def description_selected(scan_filter, scan_type, scan_label, bxh_desc):
+
+    #Checks everything known once the scan description has been looked up
+    if scan_filter is None:
+        return True
+
+    if scan_filter.get('scan_types') is not None and scan_type not in scan_filter['scan_types']:
+        return False
+    if scan_filter.get('labels') is not None and scan_label not in scan_filter['labels']:
+        return False
+    if scan_filter.get('desc_regex') is not None and scan_filter['desc_regex'].search(bxh_desc) is None:
+        return False
+
+    return True
+
+
+def entry_selected(scan_filter, bxh_file, bxh_info_dict):
+
+    #Checks a fully planned conversion entry against every part of the filter
+    if scan_filter is None:
+        return True
+
+    if not acquisition_selected(scan_filter, bxh_file):
+        return False
+    if not description_selected(scan_filter, bxh_info_dict['scan_type'], bxh_info_dict['scan_label'], bxh_info_dict['bxh_desc']):
+        return False
+    if scan_filter.get('tasks') is not None and bxh_info_dict.get('task') not in scan_filter['tasks']:
+        return False
+
+    return True
+
+
+def filter_bxh_list(scan_filter, bxh_list, ses_dict=None):
+
+    #Drops the bxh files that can be excluded by name alone. With a session
+    #info file, a scan only has a task if it is one of the "funcs" entries.
+    if scan_filter is None:
+        return bxh_list
+
+    selected = []
+    for file_item in bxh_list:
+        bxh_file = file_item['bxhfile']
+        if not acquisition_selected(scan_filter, bxh_file):
+            continue
+        if scan_filter.get('tasks') is not None and ses_dict is not None:
+            numbers = acquisition_number(bxh_file)
+            func_info = ses_dict.get('funcs', {}).get(numbers[1] if numbers is not None else None)
+            if func_info is None or func_info.get('task') not in scan_filter['tasks']:
+                continue
+        selected.append(file_item)
+
+    logging.info('Scan filter selected {} of {} bxh files.'.format(len(selected), len(bxh_list)))
+
+    return selected
@@ -0,0 +1,107 @@
+import heapq
+
+
+#Order the work of a batch so parallel workers finish at about the same time.
+#
+#Jobs are scheduled greedily: each job, in order, goes to the worker that
+#becomes free first. With "fifo" the jobs keep the order they were given in;
+#with "lpt" (longest processing time first) the largest jobs go first, so
+#one large multiband run or DWI is not left running alone at the end while
+#every other worker is idle.
+#
+#Sessions are the jobs of the process pool, and the scans of a session are
+#the jobs of its thread pool. A session is never split across processes:
+#its scans are converted into one staging directory and published together
+#under the subject's lock (see bxh2bids.publish_staged_session()), and a
+#session's scans also share its planned names, manifest and log, so scans
+#converted in other processes would have to be handed back to one of them
+#before it could publish. With scan_jobs > 1 a session's scans are instead
+#scheduled the same way inside it, largest first. This means a batch whose
+#largest session takes longer than the rest together still ends with that
+#session running alone; its scans, not its process, are what scan_jobs
+#spreads out.
+#
+#The time a job takes is estimated from its source bytes (uncompressed) and
+#the conversion throughput, so the makespan (time until the last worker
+#finishes) can be estimated before a batch runs and compared afterwards
+#with the makespan actually achieved.
+
+
+STRATEGIES = ['fifo', 'lpt']
+
+
+def order_jobs(job_sizes, strategy='lpt'):
+
+    #job_sizes is a list of [job, size]; returns the jobs in the order to run them
+    if strategy not in STRATEGIES:
+        raise RuntimeError('Unknown scheduling strategy: {} (use one of {})'.format(strategy, STRATEGIES))
+    if strategy == 'fifo':
+        return [job for job, size in job_sizes]
+
+    #sorted() is stable, so equal sizes keep their order
+    return [job for job, size in sorted(job_sizes, key=lambda job_size: -job_size[1])]
+
+
+def makespan(durations, workers):
+
+    #Time until the last of "workers" workers finishes, if the durations are
+    #run in the given order, each on the worker that becomes free first
+    finish_times = [0.0]*max(1, workers)
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times)+duration)
+
+    return max(finish_times)
+
+
+def session_seconds(scan_sizes, throughput, scan_jobs=1):
+
+    #Expected time to convert one session; scan_sizes is a size_session() result.
+    #Scans are always converted largest first (see bxh2bids.convert_session_scans).
+    scan_bytes = [[bxh_name, scan['uncompressed_bytes']] for bxh_name, scan in scan_sizes.items()]
+    order = order_jobs(scan_bytes, 'lpt')
+
+    return makespan([scan_sizes[bxh_name]['uncompressed_bytes']/throughput for bxh_name in order], scan_jobs)
+
+
+def plan_batch(session_sizes, throughput, jobs=1, scan_jobs=1, strategy='lpt'):
+
+    #session_sizes is {dataid: size_session() result}. Returns the order to
+    #convert the sessions in and the expected time of each, and in total.
+    expected = {dataid: session_seconds(scan_sizes, throughput, scan_jobs)
+                for dataid, scan_sizes in session_sizes.items()}
+    order = order_jobs([[dataid, expected[dataid]] for dataid in session_sizes], strategy)
+
+    return {
+            'strategy': strategy,
+            'jobs': jobs,
+            'scan_jobs': scan_jobs,
+            'given_order': list(session_sizes),
+            'order': order,
+            'session_seconds': expected,
+            'expected_makespan': makespan([expected[dataid] for dataid in order], jobs)
+            }
+
+
+def compare_strategies(session_seconds_by_id, session_order, jobs=1):
+
+    #Makespans every strategy would give with the same session times, e.g.
+    #the measured times of a batch that has run
+    job_times = [[dataid, session_seconds_by_id[dataid]] for dataid in session_order]
+    return {strategy: makespan([session_seconds_by_id[dataid] for dataid in order_jobs(job_times, strategy)], jobs)
+            for strategy in STRATEGIES}
+
+
+def format_schedule(schedule, achieved_seconds=None, measured_seconds=None):
+
+    lines = ['Schedule: {} with {} job(s) x {} scan job(s)'.format(schedule['strategy'], schedule['jobs'], schedule['scan_jobs']),
+             'Expected makespan: {:.1f} s'.format(schedule['expected_makespan'])]
+    if achieved_seconds is not None:
+        lines.append('Achieved makespan: {:.1f} s'.format(achieved_seconds))
+    if measured_seconds:
+        #What each strategy would have given with the session times measured in this run
+        by_strategy = compare_strategies(measured_seconds, [dataid for dataid in schedule['given_order'] if dataid in measured_seconds],
+                                         schedule['jobs'])
+        lines.append('With measured session times: '+', '.join(['{} {:.1f} s'.format(strategy, by_strategy[strategy])
+                                                                 for strategy in STRATEGIES]))
+
+    return '\n'.join(lines)
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+
+
+#Resident conversion daemon ("bxh2bids serve") and its client.
+#
+#Starting bxh2bids for one session costs more than converting many small
+#sessions: the interpreter starts, nibabel and xmltodict are imported and the
+#templates are read. The daemon pays that once. It keeps a pool of worker
+#processes that have already imported everything and read psd_types.json,
+#and takes jobs over a Unix socket, so only the owner of the socket (mode
+#0600) can submit.
+#
+#The protocol is one JSON object per line each way. Requests:
+#   {"command": "submit", "proj_dir": ..., "dataid": ..., "incremental": false,
+#    "filter_args": {...}, "scan_jobs": 1, "retries": 3, "retry_delay": 1.0,
+#    "log_level": "INFO"}                         -> {"ok": true, "job": {...}}
+#   {"command": "status", "job_id": N}           -> {"ok": true, "job": {...}}
+#   {"command": "wait", "job_id": N}             -> same, once the job has finished
+#   {"command": "list"}                          -> {"ok": true, "jobs": [...]}
+#   {"command": "ping"}                          -> {"ok": true, "pid": ..., "workers": ...}
+#   {"command": "shutdown"}                      -> {"ok": true}
+#Errors are answered with {"ok": false, "error": "..."}. A job is a
+#dictionary with its id, request, state ("queued", "running", "done" or
+#"failed"), times and, once finished, the session result of
+#run_bxh2bids._bidsify_session().
+#
+#If a worker process dies (e.g. it runs out of memory), the jobs running in
+#the pool fail and a new pool is started for the jobs after them. Jobs still
+#queued when the daemon stops fail without being started.
+#
+#With a metrics_file, the daemon writes Prometheus metrics of its jobs to it
+#(see metrics.py): queued jobs are the queue depth, running jobs the active workers.
+
+
+def default_socket():
+
+    return os.path.join(tempfile.gettempdir(), 'bxh2bids-{}.sock'.format(os.getuid()))
+
+
+def request(socket_path, message, timeout=None):
+
+    #Send one request to the daemon and return its answer
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(message)+'\n').encode())
+        with client.makefile('r') as fd:
+            line = fd.readline()
+    finally:
+        client.close()
+    if not line:
+        raise RuntimeError('The bxh2bids daemon closed the connection.')
+
+    return json.loads(line)
+
+
+def submit_sessions(socket_path, proj_dir, biac_dirs, incremental=False, filter_args=None, scan_jobs=1, retries=None,
+                    retry_delay=None, log_level='INFO'):
+
+    #Client mode: convert sessions with the daemon and wait for them.
+    #Returns one session result per session, like run_bxh2bids.run_sessions().
+    #retries and retry_delay (see retry.RetryPolicy) default to the worker's.
+    job_ids = []
+    for dataid in biac_dirs:
+        answer = request(socket_path, {'command': 'submit', 'proj_dir': os.path.abspath(proj_dir), 'dataid': dataid,
+                                       'incremental': incremental, 'filter_args': filter_args, 'scan_jobs': scan_jobs,
+                                       'retries': retries, 'retry_delay': retry_delay, 'log_level': log_level})
+        if not answer['ok']:
+            raise RuntimeError('The bxh2bids daemon refused {}: {}'.format(dataid, answer['error']))
+        print('Submitted {} as job {}'.format(dataid, answer['job']['job_id']))
+        job_ids.append(answer['job']['job_id'])
+
+    results = []
+    for job_id in job_ids:
+        job = request(socket_path, {'command': 'wait', 'job_id': job_id})['job']
+        results.append(job['result'])
+
+    return results
+
+
+def _warm_worker():
+
+    #Runs once in every worker process: import and read what every job needs
+    import nibabel
+    import bxh2bids.run_bxh2bids
+    import bxh2bids.bxh2bids as b2b
+    b2b.load_template(b2b.PSD_TYPES_FILE)
+
+
+def _run_job(job_request):
+
+    import bxh2bids.run_bxh2bids as rb2b
+    import bxh2bids.scan_filter as scan_filters
+    import bxh2bids.session_log as session_log
+    import bxh2bids.retry as retry
+
+    scan_filter = scan_filters.make_scan_filter(**(job_request.get('filter_args') or {}))
+    retry_policy = None
+    if job_request.get('retries') is not None or job_request.get('retry_delay') is not None:
+        retry_policy = retry.RetryPolicy(
+            retries=retry.DEFAULT_RETRIES if job_request.get('retries') is None else job_request['retries'],
+            delay=retry.DEFAULT_DELAY if job_request.get('retry_delay') is None else job_request['retry_delay'])
+    return rb2b._bidsify_session(job_request['proj_dir'], job_request['dataid'], incremental=job_request.get('incremental', False),
+                                 scan_filter=scan_filter, scan_jobs=job_request.get('scan_jobs', 1), retry_policy=retry_policy,
+                                 log_level=session_log.LOG_LEVELS[job_request.get('log_level') or 'INFO'])
+
+
+class Daemon(object):
+
+    def __init__(self, socket_path=None, jobs=1, metrics_file=None, metrics_interval=None):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.socket_path = default_socket() if socket_path is None else socket_path
+        self.jobs = jobs
+        self.make_executor = lambda: ProcessPoolExecutor(max_workers=jobs, initializer=_warm_worker)
+        self.executor = self.make_executor()
+        self.job_list = {}
+        self.queued = []
+        self.running = 0
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.metrics = None
+        if metrics_file is not None:
+            import bxh2bids.metrics as metrics
+            self.metrics = metrics.ConversionMetrics(metrics_file, 'daemon',
+                                                     interval=metrics.DEFAULT_INTERVAL if metrics_interval is None else metrics_interval)
+
+    def submit(self, message):
+        import bxh2bids.session_log as session_log
+
+        for key in ['proj_dir', 'dataid']:
+            if key not in message:
+                raise RuntimeError('Missing "{}" in submit request.'.format(key))
+        if not os.path.isdir(message['proj_dir']):
+            raise RuntimeError('Project directory not found: {}'.format(message['proj_dir']))
+        if message.get('log_level') not in [None]+list(session_log.LOG_LEVELS):
+            raise RuntimeError('Unknown log level: {}'.format(message['log_level']))
+        with self.condition:
+            if self.stopping.is_set():
+                raise RuntimeError('The bxh2bids daemon is shutting down.')
+            job = {'job_id': self.next_id, 'request': message, 'state': 'queued', 'submitted': time.time(),
+                   'started': None, 'finished': None, 'result': None}
+            self.job_list[job['job_id']] = job
+            self.next_id = self.next_id+1
+            self.queued.append(job['job_id'])
+            logging.info('Job {}: {} queued'.format(job['job_id'], message['dataid']))
+            self.__dispatch()
+            self.__update_gauges()
+            return dict(job)
+
+    def __update_gauges(self):
+        #Called with the lock held
+        if self.metrics is not None:
+            self.metrics.set_queue_depth(len(self.queued))
+            self.metrics.set_active_workers(self.running)
+
+    def __submit(self, job_request):
+        #Called with the lock held
+        from concurrent.futures.process import BrokenProcessPool
+
+        try:
+            return self.executor.submit(_run_job, job_request)
+        except BrokenProcessPool:
+            #A worker died and the pool cannot take new jobs; start a new one
+            logging.warning('A worker process died; starting a new pool of {} worker(s).'.format(self.jobs))
+            self.executor.shutdown(wait=False)
+            self.executor = self.make_executor()
+            return self.executor.submit(_run_job, job_request)
+
+    def __dispatch(self):
+        #Hand queued jobs to the pool only when a worker is free, so a
+        #job's state says whether it is running. Called with the lock held.
+        while self.queued and self.running < self.jobs:
+            job = self.job_list[self.queued.pop(0)]
+            try:
+                future = self.__submit(job['request'])
+            except Exception as ex:
+                self.__finish(job, {'dataid': job['request']['dataid'], 'ok': False, 'error': 'Job could not be started: '+str(ex),
+                                    'seconds': None})
+                continue
+            job['state'] = 'running'
+            job['started'] = time.time()
+            self.running = self.running+1
+            future.add_done_callback(lambda future, job_id=job['job_id']: self.finished(job_id, future))
+
+    def __finish(self, job, result):
+        #Called with the lock held
+        job['result'] = result
+        job['state'] = 'done' if result['ok'] else 'failed'
+        job['finished'] = time.time()
+        logging.info('Job {}: {} {}'.format(job['job_id'], job['request']['dataid'], job['state']))
+        if self.metrics is not None:
+            self.metrics.session_finished(result)
+        self.condition.notify_all()
+
+    def finished(self, job_id, future):
+        with self.condition:
+            job = self.job_list[job_id]
+            try:
+                result = future.result()
+            except Exception as ex:
+                #The worker process died (BrokenProcessPool), with every job running in the pool
+                result = {'dataid': job['request']['dataid'], 'ok': False, 'error': 'Worker failed: '+str(ex), 'seconds': None}
+            self.running = self.running-1
+            self.__finish(job, result)
+            self.__dispatch()
+            self.__update_gauges()
+
+    def fail_queued(self, error):
+        #Fail the jobs that have not started, and wake whoever waits for them
+        with self.condition:
+            while self.queued:
+                job = self.job_list[self.queued.pop(0)]
+                self.__finish(job, {'dataid': job['request']['dataid'], 'ok': False, 'error': error, 'seconds': None})
+            self.__update_gauges()
+
+    def get_job(self, job_id, wait=False):
+        with self.condition:
+            if job_id not in self.job_list:
+                raise RuntimeError('Unknown job: {}'.format(job_id))
+            while wait and self.job_list[job_id]['finished'] is None:
+                self.condition.wait()
+            return dict(self.job_list[job_id])
+
+    def handle(self, message):
+        command = message.get('command')
+        if command == 'submit':
+            return {'ok': True, 'job': self.submit(message)}
+        if command in ['status', 'wait']:
+            return {'ok': True, 'job': self.get_job(message.get('job_id'), wait=command == 'wait')}
+        if command == 'list':
+            with self.condition:
+                return {'ok': True, 'jobs': [dict(job) for job in self.job_list.values()]}
+        if command == 'ping':
+            return {'ok': True, 'pid': os.getpid(), 'workers': self.jobs}
+        if command == 'shutdown':
+            self.stopping.set()
+            return {'ok': True}
+
+        raise RuntimeError('Unknown command: {}'.format(command))
+
+    def serve_connection(self, connection):
+        with connection, connection.makefile('rw') as fd:
+            for line in fd:
+                try:
+                    answer = self.handle(json.loads(line))
+                except Exception as ex:
+                    answer = {'ok': False, 'error': str(ex)}
+                fd.write(json.dumps(answer)+'\n')
+                fd.flush()
+
+    def __bind(self):
+        if os.path.exists(self.socket_path):
+            try:
+                request(self.socket_path, {'command': 'ping'}, timeout=5)
+            except (OSError, RuntimeError, ValueError):
+                #Left behind by a daemon that did not stop cleanly
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError('A bxh2bids daemon is already listening on {}'.format(self.socket_path))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        #Wake up now and then to notice a shutdown request
+        server.settimeout(1.0)
+
+        return server
+
+    def serve_forever(self):
+        server = self.__bind()
+        #Start a worker now rather than with the first job
+        self.executor.submit(time.sleep, 0).result()
+        if self.metrics is not None:
+            self.metrics.start()
+        print('bxh2bids daemon {} listening on {} with {} worker(s).'.format(os.getpid(), self.socket_path, self.jobs))
+        try:
+            while not self.stopping.is_set():
+                try:
+                    connection, address = server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopping.set()
+            server.close()
+            os.remove(self.socket_path)
+            print('bxh2bids daemon stopping; waiting for running jobs.')
+            self.fail_queued('The bxh2bids daemon stopped before the job started.')
+            with self.condition:
+                executor = self.executor
+            executor.shutdown(wait=True)
+            if self.metrics is not None:
+                self.metrics.stop()
+
+
+def serve(socket_path=None, jobs=1, metrics_file=None, metrics_interval=None):
+
+    Daemon(socket_path, jobs, metrics_file=metrics_file, metrics_interval=metrics_interval).serve_forever()
@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import contextvars
+
+
+#Per-session log files, written by a background thread.
+#
+#Every session a Converter converts gets its own log file:
+#   LOG_DIR/bxh2bids_ses-<dataid>_log_<YYYYMMDD_HHMMSS>_<pid>.txt
+#and a batch gets a run log for the lines logged outside any session
+#(planning, scheduling):
+#   LOG_DIR/bxh2bids_run_log_<YYYYMMDD_HHMMSS>_<pid>.txt
+#A file is created with O_EXCL, so logs started in the same second never
+#share a file; "_2", "_3", ... is added to the name if needed.
+#
+#Logging calls do not write to the files themselves. The root logger has a
+#single QueueHandler, which stamps each record with the session and scan
+#of the thread that logged it and puts it on a queue. A QueueListener
+#thread takes records off the queue and writes each one to the log file of
+#its session (a record logged outside any session goes to the run log;
+#warnings that have no open log to go to go to stderr). When a session
+#ends, its remaining records are written and its file is closed.
+#
+#The level of a log (LOG_LEVELS) sets how much is written to it; the root
+#logger is set to the lowest level of the open logs, so lines below it cost
+#almost nothing, and back to its own level once they are all closed.
+
+
+LOG_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+
+LOG_FORMAT = '%(levelname)s:%(asctime)s:%(scan)s%(message)s'
+
+#Seconds to wait for the listener to write a closing session's lines
+FLUSH_TIMEOUT = 30
+
+#Name of the bxh file the current thread is converting, added to log lines
+current_scan = contextvars.ContextVar('current_scan', default=None)
+
+#dataid of the session the current thread is converting; with sessions
+#converted in threads of one process, each log file only takes its own lines
+current_session = contextvars.ContextVar('current_session', default=None)
+
+
+class _ContextFilter(logging.Filter):
+
+    #Runs in the thread that logged the record, where the context is known
+    def filter(self, record):
+        scan_name = current_scan.get()
+        record.scan = '' if scan_name is None else scan_name+': '
+        record.session = current_session.get()
+        return True
+
+
+class _SessionRouter(logging.Handler):
+
+    #Runs in the listener thread: hands each record to its session's file handler
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        #file handler: dataid, or None for the run log
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.root_level = None
+
+    def add(self, file_handler, dataid):
+        with self.sessions_lock:
+            if not self.sessions:
+                self.root_level = logging.getLogger().level
+            self.sessions[file_handler] = dataid
+            self.__set_root_level()
+
+    def remove(self, file_handler):
+        with self.sessions_lock:
+            if file_handler in self.sessions:
+                del self.sessions[file_handler]
+                self.__set_root_level()
+
+    def __set_root_level(self):
+        #Called with sessions_lock held
+        if self.sessions:
+            logging.getLogger().setLevel(min([file_handler.level for file_handler in self.sessions]))
+        elif self.root_level is not None:
+            logging.getLogger().setLevel(self.root_level)
+            self.root_level = None
+
+    def emit(self, record):
+        barrier = getattr(record, 'barrier', None)
+        if barrier is not None:
+            barrier.set()
+            return
+        session = getattr(record, 'session', None)
+        with self.sessions_lock:
+            targets = [file_handler for file_handler, dataid in self.sessions.items() if dataid == session]
+        if not targets and record.levelno >= logging.WARNING:
+            logging.lastResort.handle(record)
+        for file_handler in targets:
+            if record.levelno >= file_handler.level:
+                file_handler.handle(record)
+
+
+#{'queue', 'handler', 'router', 'listener'} of this process, once a session log was opened
+__state = None
+__state_lock = threading.Lock()
+
+
+def install():
+
+    #Route this process's log records through the queue. Called by the first
+    #session log; a batch calls it before it plans any session, or the first
+    #logging.info() made outside a session would add a stderr handler to the
+    #root logger (logging.basicConfig) that every later line is copied to.
+    global __state
+    with __state_lock:
+        if __state is None:
+            log_queue = queue.SimpleQueue()
+            queue_handler = logging.handlers.QueueHandler(log_queue)
+            queue_handler.addFilter(_ContextFilter())
+            router = _SessionRouter()
+            listener = logging.handlers.QueueListener(log_queue, router)
+            listener.start()
+            logging.getLogger().addHandler(queue_handler)
+            __state = {'queue': log_queue, 'handler': queue_handler, 'router': router, 'listener': listener}
+
+    return __state
+
+
+def __after_fork():
+
+    #The listener thread does not survive a fork; a child opens its own
+    global __state, __state_lock
+    __state_lock = threading.Lock()
+    if __state is not None:
+        logging.getLogger().removeHandler(__state['handler'])
+        __state = None
+
+
+def __shutdown():
+
+    #Write whatever is still queued when the interpreter exits
+    if __state is not None:
+        __state['listener'].stop()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=__after_fork)
+atexit.register(__shutdown)
+
+
+def create_log_file(log_dir, dataid=None):
+
+    #Create a new, empty log file that no other session can be using; the
+    #run log without a dataid
+    name = 'run' if dataid is None else 'ses-'+str(dataid)
+    base_name = os.path.join(log_dir, 'bxh2bids_{}_log_{}_{}'.format(name, time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+    for attempt in range(1, 100):
+        log_file = base_name+('' if attempt == 1 else '_'+str(attempt))+'.txt'
+        try:
+            fd = os.open(log_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return log_file
+
+    raise RuntimeError('Cannot create a new log file for {} in {}'.format('the run' if dataid is None else dataid, log_dir))
+
+
+def start_session_log(log_dir, dataid, level=logging.INFO):
+
+    #Open a log file for a session converted by the calling thread (and the
+    #threads it starts with its context). Returns a handle for stop_session_log().
+    file_handler = __open_log(log_dir, dataid, level)
+    file_handler.session_token = current_session.set(dataid)
+
+    return file_handler
+
+
+def start_run_log(log_dir, level=logging.INFO):
+
+    #Open the log of the lines a batch logs outside any session. Returns a
+    #handle for stop_run_log().
+    os.makedirs(log_dir, exist_ok=True)
+
+    return __open_log(log_dir, None, level)
+
+
+def __open_log(log_dir, dataid, level):
+
+    state = install()
+
+    file_handler = logging.FileHandler(create_log_file(log_dir, dataid), mode='a')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.setLevel(level)
+    state['router'].add(file_handler, dataid)
+
+    return file_handler
+
+
+def flush():
+
+    #Wait until the listener has written every record logged so far
+    if __state is None:
+        return
+    record = logging.LogRecord('bxh2bids', logging.DEBUG, __file__, 0, 'flush', None, None)
+    record.barrier = threading.Event()
+    __state['queue'].put_nowait(record)
+    if not record.barrier.wait(FLUSH_TIMEOUT):
+        print('Timed out waiting for log lines to be written.', file=sys.stderr)
+
+
+def stop_session_log(file_handler):
+
+    current_session.reset(file_handler.session_token)
+    stop_run_log(file_handler)
+
+
+def stop_run_log(file_handler):
+
+    flush()
+    if __state is not None:
+        __state['router'].remove(file_handler)
+    file_handler.close()
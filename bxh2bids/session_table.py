@@ -0,0 +1,118 @@
+import os
+import re
+import csv
+
+
+#Session tables for converting many sessions described by their scan
+#descriptions (the "auto" path, multi_autobxhtobids()).
+#
+#A session table is a .csv or .tsv file with one row per session:
+#
+#   dataid          sub     ses     IntendedFor
+#   20200101_12345  01      1
+#   20200102_12346  02      1       ses-1/func/sub-02_ses-1_task-faces_bold.nii.gz
+#
+#dataid, sub and ses are required; IntendedFor is optional, and several
+#targets are separated with ";". Empty lines and lines starting with "#"
+#are skipped. Each row becomes the data_info dictionary of its session:
+#   {'sub': '01', 'ses': '1'[, 'IntendedFor': ...]}
+#
+#The whole table is checked before anything is converted; every problem is
+#reported with its line number.
+
+
+REQUIRED_COLUMNS = ['dataid', 'sub', 'ses']
+OPTIONAL_COLUMNS = ['IntendedFor']
+
+DATAID_PATTERN = re.compile(r'^\d{8}_\d{5}$')
+
+#BIDS labels are alphanumeric
+LABEL_PATTERN = re.compile(r'^[a-zA-Z0-9]+$')
+
+
+def _delimiter(table_file, sample):
+
+    extension = os.path.splitext(table_file)[-1].lower()
+    if extension in ['.tsv', '.txt']:
+        return '\t'
+    if extension == '.csv':
+        return ','
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=',\t').delimiter
+    except csv.Error:
+        return '\t'
+
+
+def _intended_for(value):
+
+    targets = [target.strip() for target in value.split(';') if target.strip()]
+    if len(targets) == 1:
+        return targets[0]
+
+    return targets
+
+
+def read_session_table(table_file):
+
+    #Returns [{dataid: data_info} in table order, [problems]]
+    if not os.path.exists(table_file):
+        raise RuntimeError('Session table cannot be found: '+str(table_file))
+
+    with open(table_file, newline='') as fd:
+        lines = [[line_number, line] for line_number, line in enumerate(fd.read().splitlines(), start=1)
+                 if line.strip() and not line.lstrip().startswith('#')]
+    if not lines:
+        return {}, ['Session table is empty: '+str(table_file)]
+
+    delimiter = _delimiter(table_file, '\n'.join([line for line_number, line in lines[:10]]))
+    rows = list(csv.reader([line for line_number, line in lines], delimiter=delimiter))
+    header = [column.strip() for column in rows[0]]
+
+    problems = []
+    for column in REQUIRED_COLUMNS:
+        if column not in header:
+            problems.append('Session table has no "{}" column (found: {})'.format(column, ', '.join(header)))
+    for column in header:
+        if column not in REQUIRED_COLUMNS+OPTIONAL_COLUMNS:
+            problems.append('Unknown column in session table: "{}"'.format(column))
+    if problems:
+        return {}, problems
+
+    data_infos = {}
+    sub_ses = {}
+    for (line_number, line), row in zip(lines[1:], rows[1:]):
+        if len(row) > len(header):
+            problems.append('Line {}: {} values for {} columns'.format(line_number, len(row), len(header)))
+            continue
+        values = dict(zip(header, [value.strip() for value in row]))
+        dataid = values.get('dataid', '')
+        if not DATAID_PATTERN.match(dataid):
+            problems.append('Line {}: dataid must look like YYYYMMDD_#####, found "{}"'.format(line_number, dataid))
+            continue
+        if dataid in data_infos:
+            problems.append('Line {}: session {} is listed more than once'.format(line_number, dataid))
+            continue
+        data_info = {}
+        for key in ['sub', 'ses']:
+            data_info[key] = values.get(key, '')
+            if not LABEL_PATTERN.match(data_info[key]):
+                problems.append('Line {}: "{}" must be a BIDS label (letters and digits only), found "{}"'.format(
+                                line_number, key, data_info[key]))
+        if values.get('IntendedFor'):
+            data_info['IntendedFor'] = _intended_for(values['IntendedFor'])
+        #Two sessions would write the same files
+        if (data_info['sub'], data_info['ses']) in sub_ses:
+            problems.append('Line {}: sub-{} ses-{} is also given to session {}'.format(
+                            line_number, data_info['sub'], data_info['ses'], sub_ses[(data_info['sub'], data_info['ses'])]))
+        sub_ses[(data_info['sub'], data_info['ses'])] = dataid
+        data_infos[dataid] = data_info
+
+    if not data_infos and not problems:
+        problems.append('Session table lists no sessions: '+str(table_file))
+
+    return data_infos, problems
+
+
+def format_problems(problems):
+
+    return '\n'.join(['    '+str(problem) for problem in problems])
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+import contextvars
+from bxh2bids.session_log import current_scan, current_session
+
+
+#Per-stage timing trace of a conversion run.
+#
+#Spans are put around the stages of a conversion: parsing a .bxh file and
+#matching it to the session info (while the session is planned), reading
+#and writing each image, writing the sidecar files, and flushing and
+#publishing the session. While a trace is open, every span that ends is
+#written as one JSON line to the run's trace file:
+#   LOG_DIR/bxh2bids_trace_<YYYYMMDD_HHMMSS>_<pid>.jsonl
+#
+#   {"stage": "copy_image.read", "session": "20200101_12345", "scan": "bia5_12345_005.bxh",
+#    "modality": "func", "start": 1760000000.0, "wall": 0.52, "cpu": 0.31,
+#    "bytes_in": 10485760, "bytes_out": 31457280, "ok": true, "pid": 4242}
+#
+#wall is the elapsed time and cpu the CPU time of the thread that ran the
+#stage, in seconds; a cpu much lower than wall means the stage waited on a
+#file system. bytes_in and bytes_out are the bytes the stage read and wrote
+#(for copy_image.read, bytes_out is the decompressed image). Stages nest:
+#convert_bxh contains copy_image.* and create_*_json of the same scan.
+#
+#Worker processes of the run append to the same file; each line is written
+#with one write() to a file opened with O_APPEND. With no trace open, a span
+#costs a few microseconds. summarize() reads trace files back
+#("bxh2bids trace summarize").
+
+
+#Percentiles reported by summarize()
+PERCENTILES = [50, 90, 99]
+
+#Trace file spans of the current thread are written to (a _TraceFile)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+#Fields given to an enclosing span that nested spans take on (scan, modality)
+__span_scope = contextvars.ContextVar('span_scope', default={})
+
+
+class _TraceFile(object):
+
+    def __init__(self, trace_file):
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def write(self, record):
+        line = (json.dumps(record, sort_keys=True)+'\n').encode('utf-8')
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self.fd, line)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+#{trace file: _TraceFile} open in this process
+__trace_files = {}
+__trace_files_lock = threading.Lock()
+
+
+def __after_fork():
+
+    #A lock held by another thread at the fork would never be released in
+    #the child; the child opens the files again itself
+    global __trace_files, __trace_files_lock
+    __trace_files = {}
+    __trace_files_lock = threading.Lock()
+
+
+def __close_all():
+
+    for trace_file in list(__trace_files.values()):
+        trace_file.close()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=__after_fork)
+atexit.register(__close_all)
+
+
+def new_trace_file(log_dir):
+
+    #Name of the trace file for a new run; it is created by the first span
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, 'bxh2bids_trace_{}_{}.jsonl'.format(time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+
+
+def open_trace(trace_file):
+
+    #Write the spans of the calling thread (and the threads it starts with
+    #its context) to trace_file. Returns a token for close_trace().
+    if trace_file is None:
+        return current_trace.set(None)
+    with __trace_files_lock:
+        if trace_file not in __trace_files:
+            __trace_files[trace_file] = _TraceFile(trace_file)
+        return current_trace.set(__trace_files[trace_file])
+
+
+def close_trace(token):
+
+    current_trace.reset(token)
+
+
+def __file_size(file_name):
+
+    try:
+        return os.path.getsize(file_name)
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def span(stage, scan=None, modality=None, input_file=None, output_file=None):
+
+    #Time the enclosed block as one stage. Yields the record that will be
+    #written, so the block can add fields (e.g. record['bytes_out'] = n).
+    #scan and modality default to those of the enclosing span; the size of
+    #input_file and output_file, when given, are taken as bytes_in and bytes_out.
+    trace_file = current_trace.get()
+    if trace_file is None:
+        yield {}
+        return
+
+    scope = __span_scope.get()
+    scope_token = None
+    if scan is not None or modality is not None:
+        scope = dict(scope)
+        if scan is not None:
+            scope['scan'] = scan
+        if modality is not None:
+            scope['modality'] = modality
+        scope_token = __span_scope.set(scope)
+
+    record = {'stage': stage, 'session': current_session.get(), 'scan': scope.get('scan', current_scan.get()),
+              'modality': scope.get('modality'), 'start': time.time(), 'pid': os.getpid(), 'ok': False}
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+        record['ok'] = True
+    finally:
+        record['wall'] = time.perf_counter()-wall_start
+        record['cpu'] = time.thread_time()-cpu_start
+        if scope_token is not None:
+            __span_scope.reset(scope_token)
+        if input_file is not None and 'bytes_in' not in record:
+            record['bytes_in'] = __file_size(input_file)
+        if output_file is not None and 'bytes_out' not in record:
+            record['bytes_out'] = __file_size(output_file)
+        trace_file.write(record)
+
+
+def read_trace(trace_files):
+
+    #Span records of one or more trace files. Spans written without a
+    #modality (e.g. parsing a .bxh file before its type is known) take the
+    #modality of another span of the same scan.
+    records = []
+    for trace_file in trace_files:
+        with open(trace_file) as fd:
+            for line in fd:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    #The last line of a run that was killed may be cut short
+                    continue
+
+    modalities = {}
+    for record in records:
+        if record.get('modality') is not None and record.get('scan') is not None:
+            modalities[(record.get('session'), record['scan'])] = record['modality']
+    for record in records:
+        if record.get('modality') is None:
+            record['modality'] = modalities.get((record.get('session'), record.get('scan')))
+
+    return records
+
+
+def percentile(values, percent):
+
+    #Nearest-rank percentile of a list of numbers
+    values = sorted(values)
+    rank = max(1, int(-(-len(values)*percent//100)))
+
+    return values[min(rank, len(values))-1]
+
+
+def summarize(records):
+
+    #Returns [{'stage', 'modality', 'count', 'failed', 'wall': {percentile: s},
+    #'cpu': {percentile: s}, 'wall_total', 'cpu_total', 'bytes_in', 'bytes_out'}],
+    #one per stage over all modalities (modality None) and one per stage and modality
+    groups = {}
+    for record in records:
+        groups.setdefault((record['stage'], None), []).append(record)
+        #Spans of the session as a whole (e.g. publishing) have no modality
+        if record.get('modality') is not None:
+            groups.setdefault((record['stage'], record['modality']), []).append(record)
+
+    summaries = []
+    for (stage, modality), group in groups.items():
+        walls = [record['wall'] for record in group]
+        cpus = [record['cpu'] for record in group]
+        summaries.append({'stage': stage, 'modality': modality, 'count': len(group),
+                          'failed': len([record for record in group if not record.get('ok', True)]),
+                          'wall': {percent: percentile(walls, percent) for percent in PERCENTILES+[100]},
+                          'cpu': {percent: percentile(cpus, percent) for percent in PERCENTILES+[100]},
+                          'wall_total': sum(walls), 'cpu_total': sum(cpus),
+                          'bytes_in': sum([record.get('bytes_in') or 0 for record in group]),
+                          'bytes_out': sum([record.get('bytes_out') or 0 for record in group])})
+
+    return sorted(summaries, key=lambda summary: (summary['modality'] is not None, summary['modality'] or '', -summary['wall_total']))
+
+
+def format_summary(summaries):
+
+    header = '{:32s} {:9s} {:>6s} '+' '.join(['{:>8s}']*(len(PERCENTILES)+1))+' {:>8s} {:>7s} {:>10s} {:>10s} {:>8s}'
+    row = '{:32s} {:9s} {:>6d} '+' '.join(['{:8.3f}']*(len(PERCENTILES)+1))+' {:8.3f} {:6.0f}% {:10.1f} {:10.1f} {:>8s}'
+    lines = [header.format('stage', 'modality', 'count', *(['p{}_s'.format(percent) for percent in PERCENTILES]+['max_s',
+                           'cpu_p50', 'cpu', 'MiB_in', 'MiB_out', 'MiB/s']))]
+    last_modality = False
+    for summary in summaries:
+        if summary['modality'] != last_modality:
+            lines.append('')
+            lines.append('All modalities:' if summary['modality'] is None else 'Modality {}:'.format(summary['modality']))
+            last_modality = summary['modality']
+        rate = '-'
+        if summary['wall_total'] > 0 and summary['bytes_in']:
+            rate = '{:.1f}'.format(summary['bytes_in']/2**20/summary['wall_total'])
+        lines.append(row.format(summary['stage'], summary['modality'] or 'all', summary['count'],
+                                *([summary['wall'][percent] for percent in PERCENTILES+[100]]+[summary['cpu'][50],
+                                  100*summary['cpu_total']/summary['wall_total'] if summary['wall_total'] > 0 else 0,
+                                  summary['bytes_in']/2**20, summary['bytes_out']/2**20, rate])))
+        if summary['failed']:
+            lines[-1] = lines[-1]+'  ({} failed)'.format(summary['failed'])
+
+    return '\n'.join(lines)
+
+
+def latest_trace_file(log_dir):
+
+    #The trace file of the most recent run in log_dir, or None
+    trace_files = [os.path.join(log_dir, file_name) for file_name in os.listdir(log_dir)
+                   if file_name.startswith('bxh2bids_trace_') and file_name.endswith('.jsonl')] if os.path.exists(log_dir) else []
+    if not trace_files:
+        return None
+
+    return max(trace_files, key=os.path.getmtime)
@@ -3,8 +3,6 @@
 import json
 import os, platform
 import sys, logging
-import tkinter
-from tkinter.filedialog import asksaveasfile
 
 
 def add_info(template_file, bxh_file, bxh_desc):
@@ -22,6 +20,8 @@ def add_info(template_file, bxh_file, bxh_desc):
 
 def get_info_gui(bxh_file, bxh_desc):
 
+    #Imported here so the module can be used on nodes without a display or Tk
+    import tkinter as tk
     window = tk.Tk()
     window.title('Get PSD Info.')
 
@@ -0,0 +1,76 @@
+import sys, getopt
+import time
+import tracemalloc
+
+from bxh2bids.scan_entry import ScanEntry
+
+
+#Memory benchmark comparing the ScanEntry internal model against the plain
+#per-bxh dictionaries bxh2bids used before. It builds the same number of
+#entries both ways, with values that repeat across sessions the way a real
+#study's do, and reports the traced memory and build time of each.
+#
+#Usage:
+#   python -m bxh2bids.utils.bench_scan_entry -n <number_of_scans>
+
+
+def _make_values(count):
+    #Build per-scan values the same way create_internal_info() does:
+    #strings read fresh from bxh/session files, so nothing is shared by accident.
+    for num in range(count):
+        sub = '{:03d}'.format(num // 20)
+        acq = '{:03d}'.format(num % 20)
+        yield {
+               'orig_image': '/study/Data/Func/20200101_{:05d}/run{}_01.nii.gz'.format(num // 20, acq),
+               'biac_json': None,
+               'scan_type': ''.join(['fu', 'nc']),
+               'scan_label': ''.join(['bo', 'ld']),
+               'sub': ''.join(sub),
+               'ses': ''.join(['1']),
+               'bxh_desc': ''.join(['fMRI ', '481x5']),
+               'task': ''.join(['fa', 'ces']),
+               'run': '{:02d}'.format(num % 4 + 1),
+               'output_name': 'sub-{}_ses-1_task-faces_run-{:02d}_bold.nii.gz'.format(sub, num % 4 + 1),
+               'output_prefix': 'sub-{}_ses-1_task-faces_run-{:02d}'.format(sub, num % 4 + 1),
+               }
+
+
+def measure(build, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    entries = [build(entry_values) for entry_values in _make_values(count)]
+    elapsed = time.perf_counter() - start
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del entries
+    return current, elapsed
+
+
+def main(argv):
+
+    count = 100000
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ['number='])
+    except getopt.GetoptError:
+        print('bench_scan_entry.py -n <number_of_scans>')
+        raise RuntimeError('Check passed args...')
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('bench_scan_entry.py -n <number_of_scans>')
+            sys.exit()
+        elif opt in ('-n', '--number'):
+            count = int(arg)
+
+    dict_bytes, dict_time = measure(dict, count)
+    entry_bytes, entry_time = measure(ScanEntry.from_dict, count)
+
+    print('Scans: {}'.format(count))
+    print('dict:      {:8.1f} MiB  {:6.3f} s  ({:.0f} bytes/scan)'.format(dict_bytes/2**20, dict_time, dict_bytes/count))
+    print('ScanEntry: {:8.1f} MiB  {:6.3f} s  ({:.0f} bytes/scan)'.format(entry_bytes/2**20, entry_time, entry_bytes/count))
+    print('Memory saved: {:.1f}%'.format(100*(1 - entry_bytes/dict_bytes)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,97 @@
+import sys, getopt
+import subprocess
+import statistics
+
+
+#Start-up benchmark. bxh2bids is started thousands of times from job arrays,
+#so the time to import it and to print "bxh2bids --help" matters. Every
+#measurement runs in a new interpreter and is repeated; the median is shown.
+#
+#It also lists the heavy modules (nibabel, numpy, tkinter) each bxh2bids
+#module pulls in when imported. These are only imported where they are
+#used, so any listed here is a regression, and the exit status is 1.
+#
+#Usage:
+#   python -m bxh2bids.utils.bench_startup [-n <repeats>]
+
+
+MODULES = ['bxh2bids.cli', 'bxh2bids.bxh2bids', 'bxh2bids.run_bxh2bids', 'bxh2bids.preflight', 'bxh2bids.estimate',
+           'bxh2bids.utils.check_bxh_descriptions', 'bxh2bids.utils.add_to_psd_file']
+
+HEAVY_MODULES = ['nibabel', 'numpy', 'tkinter']
+
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join([name for name in {heavy} if name in sys.modules]))
+'''
+
+_HELP_SCRIPT = '''
+import sys, time, subprocess
+start = time.perf_counter()
+subprocess.run([sys.executable, '-m', 'bxh2bids.cli', '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+print(time.perf_counter() - start)
+'''
+
+
+def time_import(module, repeats):
+
+    #Returns [median seconds, [heavy modules imported]]
+    times = []
+    heavy = []
+    for repeat in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True).stdout.splitlines()
+        times.append(float(output[0]))
+        heavy = output[1].split() if len(output) > 1 else []
+
+    return statistics.median(times), heavy
+
+
+def time_help(repeats):
+
+    #Median wall time of "bxh2bids --help", interpreter start-up included
+    times = []
+    for repeat in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _HELP_SCRIPT], capture_output=True, text=True, check=True).stdout
+        times.append(float(output))
+
+    return statistics.median(times)
+
+
+def main(argv):
+
+    repeats = 5
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ['repeats='])
+    except getopt.GetoptError:
+        print('bench_startup.py -n <repeats>')
+        raise RuntimeError('Check passed args...')
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('bench_startup.py -n <repeats>')
+            sys.exit()
+        elif opt in ('-n', '--repeats'):
+            repeats = int(arg)
+
+    regressions = []
+    print('{:40s} {:>10s}  {}'.format('module', 'import ms', 'heavy modules imported'))
+    for module in MODULES:
+        seconds, heavy = time_import(module, repeats)
+        print('{:40s} {:10.1f}  {}'.format(module, seconds*1000, ', '.join(heavy) if heavy else '-'))
+        if heavy:
+            regressions.append(module)
+    print('{:40s} {:10.1f}'.format('bxh2bids --help (wall)', time_help(repeats)*1000))
+
+    if regressions:
+        print('Heavy modules imported at start-up by: '+', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,7 +37,9 @@ import json, xmltodict
 #   2) A python dictionary of the contents of the bxh file.
 
 
-def bxh_pick(json_file, bxh_file=None, bxh_as_dict=None):
+def bxh_pick(json_file, bxh_file=None, bxh_as_dict=None, template=None):
+
+    #template, if passed, is the already-loaded contents of json_file
 
     logging.info('-STARTING: bxh_pick-')
 
@@ -56,13 +58,14 @@ def bxh_pick(json_file, bxh_file=None, bxh_as_dict=None):
 
     out_dict = {}
 
-    #Check to make sure the passed file exists
-    if not os.path.exists(json_file):
-        logging.error('Cannot find passed json file!')
-        raise RuntimeError('Looked for and could not find: '+str(json_file))
+    if template is None:
+        #Check to make sure the passed file exists
+        if not os.path.exists(json_file):
+            logging.error('Cannot find passed json file!')
+            raise RuntimeError('Looked for and could not find: '+str(json_file))
 
-    with open(json_file) as fd:
-        template = json.loads(fd.read())
+        with open(json_file) as fd:
+            template = json.loads(fd.read())
 
     #template will be a dictionary in which the keys are
     #field names to be written to a BIDS sidecar json file
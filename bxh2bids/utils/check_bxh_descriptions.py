@@ -3,7 +3,6 @@
 import json
 import os, getopt, re
 import sys, logging
-import tkinter as tk
 import xmltodict
 
 
@@ -13,6 +12,8 @@ class psd_gui():
         self.bxh_file = bxh_file
         self.bxh_desc = bxh_desc
 
+        #Imported here so the module can be used on nodes without a display or Tk
+        import tkinter as tk
         self.window = tk.Tk()
         self.window.title('Get PSD Info.')
 
@@ -0,0 +1,303 @@
+import os
+import re
+import time
+import logging
+
+#inotify_simple is optional; without it (or off Linux) the directories are polled
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+#Convert sessions as they arrive.
+#
+#New sessions show up as SOURCE/Data/Anat/<dataid> and SOURCE/Data/Func/<dataid>
+#and fill up over a while. A session is converted once
+#   - its session info file exists, and
+#   - nothing in its directories has changed for quiet_seconds.
+#A session is described by a snapshot of its files (names, sizes, times)
+#and of its session info file. A session whose snapshot changes after it was
+#converted (a forgotten scan was copied in, the session info file was fixed)
+#is converted again, incrementally.
+#
+#With inotify_simple installed, the watcher wakes up when files change;
+#otherwise, or if inotify cannot be used, it looks every poll_seconds.
+#
+#Sessions with a manifest that is newer than all their files count as
+#converted when the watcher starts, so restarting it converts what arrived
+#while it was stopped, but nothing else.
+#
+#For every conversion the latency from the arrival of the session (when the
+#watcher first saw it, or the time of its oldest file for sessions that were
+#there when it started) to the end of the conversion is printed, logged and
+#appended to LOG_DIR/bxh2bids_watch_latency.tsv.
+#
+#With a metrics_file, the conversions, the sessions waiting to be converted
+#and whether one is being converted are written to it for Prometheus (see metrics.py).
+
+
+#Seconds a session must stay unchanged before it is converted
+DEFAULT_QUIET_SECONDS = 120
+
+#Seconds between looks at the directories without inotify
+DEFAULT_POLL_SECONDS = 30
+
+LATENCY_FILE = 'bxh2bids_watch_latency.tsv'
+LATENCY_COLUMNS = ['dataid', 'arrived', 'quiescent', 'started', 'finished', 'ok', 'wait_seconds', 'convert_seconds', 'latency_seconds']
+
+DATAID_PATTERN = re.compile(r'^\d{8}_\d{5}$')
+
+
+def _session_dirs(source_study_dir, dataid):
+
+    return [os.path.join(source_study_dir, 'Data', modality, dataid) for modality in ['Anat', 'Func']]
+
+
+def _ses_info_file(ses_info_dir, dataid):
+
+    return os.path.join(ses_info_dir, 'bxh2bids_{}.json'.format(dataid))
+
+
+def find_arrived_sessions(source_study_dir):
+
+    #Session ids with an Anat or Func directory
+    dataids = set()
+    for modality in ['Anat', 'Func']:
+        modality_dir = os.path.join(source_study_dir, 'Data', modality)
+        if os.path.isdir(modality_dir):
+            dataids.update([element for element in os.listdir(modality_dir) if DATAID_PATTERN.match(element)])
+
+    return sorted(dataids)
+
+
+def session_snapshot(source_study_dir, ses_info_dir, dataid):
+
+    #(name, size, mtime) of every file of a session and its session info file
+    snapshot = []
+    for session_dir in _session_dirs(source_study_dir, dataid):
+        if not os.path.isdir(session_dir):
+            continue
+        for element in sorted(os.listdir(session_dir)):
+            try:
+                stat = os.stat(os.path.join(session_dir, element))
+            except FileNotFoundError:
+                continue
+            snapshot.append((os.path.join(session_dir, element), stat.st_size, stat.st_mtime))
+    ses_info_file = _ses_info_file(ses_info_dir, dataid)
+    if os.path.exists(ses_info_file):
+        stat = os.stat(ses_info_file)
+        snapshot.append((ses_info_file, stat.st_size, stat.st_mtime))
+
+    return tuple(snapshot)
+
+
+class _Poller(object):
+
+    #Waits for a change by sleeping
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+
+    def watch(self, directory):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_seconds))
+
+
+class _Inotify(object):
+
+    #Waits for a change of any watched directory, or the timeout
+
+    def __init__(self):
+        self.inotify = inotify_simple.INotify()
+        self.flags = inotify_simple.flags
+        self.mask = (self.flags.CREATE | self.flags.MOVED_TO | self.flags.CLOSE_WRITE | self.flags.MODIFY |
+                     self.flags.DELETE | self.flags.ATTRIB)
+        self.watched = set()
+
+    def watch(self, directory):
+        if directory in self.watched or not os.path.isdir(directory):
+            return
+        self.inotify.add_watch(directory, self.mask)
+        self.watched.add(directory)
+
+    def wait(self, timeout):
+        self.inotify.read(timeout=int(timeout*1000))
+
+
+def _make_waiter(poll_seconds):
+
+    if inotify_simple is not None:
+        try:
+            return _Inotify()
+        except OSError as ex:
+            logging.warning('inotify cannot be used ({}); polling instead.'.format(ex))
+    print('Polling for new sessions every {} s.'.format(poll_seconds))
+
+    return _Poller(poll_seconds)
+
+
+def _record_latency(log_dir, record):
+
+    latency_file = os.path.join(log_dir, LATENCY_FILE)
+    os.makedirs(log_dir, exist_ok=True)
+    new_file = not os.path.exists(latency_file)
+    with open(latency_file, 'a') as fd:
+        if new_file:
+            fd.write('\t'.join(LATENCY_COLUMNS)+'\n')
+        fd.write('\t'.join([str(record[column]) for column in LATENCY_COLUMNS])+'\n')
+
+
+def _already_converted(manifest_dir, dataid, snapshot):
+
+    import bxh2bids.manifest as manifest
+
+    manifest_file = manifest.session_manifest_file(manifest_dir, dataid)
+    if not os.path.exists(manifest_file) or not snapshot:
+        return False
+
+    return os.path.getmtime(manifest_file) >= max([mtime for name, size, mtime in snapshot])
+
+
+def watch(proj_dir, quiet_seconds=DEFAULT_QUIET_SECONDS, poll_seconds=DEFAULT_POLL_SECONDS, scan_jobs=1, use_queue=False,
+          max_conversions=None, metrics_file=None, metrics_interval=None):
+
+    #Watch for sessions and convert them until killed (or, with
+    #max_conversions, until that many conversions have finished). With
+    #use_queue, sessions are put in the work queue (see work_queue.py) for
+    #"bxh2bids worker" processes instead of being converted here.
+    #Returns the latency records of the conversions.
+    import bxh2bids.run_bxh2bids as rb2b
+
+    dirs = rb2b._study_dirs(proj_dir)
+    waiter = _make_waiter(poll_seconds)
+    conversion_metrics = None
+    if metrics_file is not None:
+        import bxh2bids.metrics as metrics
+        conversion_metrics = metrics.ConversionMetrics(metrics_file, 'watch',
+                                                       interval=metrics.DEFAULT_INTERVAL if metrics_interval is None else metrics_interval)
+        conversion_metrics.start()
+    try:
+        return _watch_loop(proj_dir, dirs, waiter, quiet_seconds, poll_seconds, scan_jobs, use_queue, max_conversions, conversion_metrics)
+    finally:
+        if conversion_metrics is not None:
+            conversion_metrics.stop()
+
+
+def _unconverted(sessions):
+
+    #Sessions that arrived or changed and are not converted yet
+    return len([session for session in sessions.values() if session['snapshot'] != session['converted']])
+
+
+def _watch_loop(proj_dir, dirs, waiter, quiet_seconds, poll_seconds, scan_jobs, use_queue, max_conversions, conversion_metrics):
+
+    import bxh2bids.run_bxh2bids as rb2b
+    import bxh2bids.work_queue as work_queue
+
+    top_dirs = [os.path.join(dirs['source_study_dir'], 'Data', modality) for modality in ['Anat', 'Func']]+[dirs['ses_info_dir']]
+
+    #dataid: {'snapshot', 'changed', 'arrived', 'converted'}
+    sessions = {}
+    waiting_for_info = set()
+    records = []
+    first_pass = True
+    print('Watching {} for new sessions.'.format(os.path.join(dirs['source_study_dir'], 'Data')))
+    while max_conversions is None or len(records) < max_conversions:
+        now = time.time()
+        for directory in top_dirs:
+            waiter.watch(directory)
+        for dataid in find_arrived_sessions(dirs['source_study_dir']):
+            for session_dir in _session_dirs(dirs['source_study_dir'], dataid):
+                waiter.watch(session_dir)
+            snapshot = session_snapshot(dirs['source_study_dir'], dirs['ses_info_dir'], dataid)
+            if dataid not in sessions:
+                converted = None
+                arrived = now
+                if first_pass:
+                    #There when the watcher started
+                    if _already_converted(dirs['manifest_dir'], dataid, snapshot):
+                        converted = snapshot
+                    elif snapshot:
+                        arrived = min([mtime for name, size, mtime in snapshot])
+                if converted is None:
+                    print('New session: {}'.format(dataid))
+                    logging.info('New session: {}'.format(dataid))
+                #Files that stopped changing before we looked count towards quiet_seconds
+                changed = now
+                if snapshot:
+                    changed = min(now, max([mtime for name, size, mtime in snapshot]))
+                sessions[dataid] = {'snapshot': snapshot, 'changed': changed, 'arrived': arrived, 'converted': converted}
+                continue
+            session = sessions[dataid]
+            if snapshot != session['snapshot']:
+                if session['snapshot'] == session['converted']:
+                    #Changed after it was converted
+                    session['arrived'] = now
+                session['snapshot'] = snapshot
+                session['changed'] = now
+
+        first_pass = False
+        if conversion_metrics is not None:
+            conversion_metrics.set_queue_depth(_unconverted(sessions))
+
+        #Convert the sessions that have settled
+        for dataid in sorted(sessions):
+            session = sessions[dataid]
+            if session['snapshot'] == session['converted'] or now-session['changed'] < quiet_seconds:
+                continue
+            if not os.path.exists(_ses_info_file(dirs['ses_info_dir'], dataid)):
+                if dataid not in waiting_for_info:
+                    print('Waiting for the session info file of {}'.format(dataid))
+                    waiting_for_info.add(dataid)
+                continue
+            waiting_for_info.discard(dataid)
+
+            record = {'dataid': dataid, 'arrived': session['arrived'], 'quiescent': session['changed']+quiet_seconds,
+                      'started': time.time()}
+            if use_queue:
+                work_queue.add_sessions(proj_dir, [dataid], incremental=True)
+                result = {'ok': True, 'seconds': 0.0}
+            else:
+                if conversion_metrics is not None:
+                    conversion_metrics.set_active_workers(1)
+                result = rb2b._bidsify_session(proj_dir, dataid, incremental=True, scan_jobs=scan_jobs)
+                rb2b._print_session_result(result)
+                if conversion_metrics is not None:
+                    conversion_metrics.set_active_workers(0)
+                    conversion_metrics.session_finished(result)
+            record['finished'] = time.time()
+            record['ok'] = result['ok']
+            record['wait_seconds'] = round(record['started']-record['arrived'], 3)
+            record['convert_seconds'] = round(record['finished']-record['started'], 3)
+            record['latency_seconds'] = round(record['finished']-record['arrived'], 3)
+            message = 'Session {} {} {:.1f} s after it arrived ({:.1f} s waiting, {:.1f} s converting).'.format(
+                      dataid, 'queued' if use_queue else ('converted' if result['ok'] else 'failed'), record['latency_seconds'],
+                      record['wait_seconds'], record['convert_seconds'])
+            print(message)
+            logging.info(message)
+            _record_latency(dirs['log_dir'], record)
+            records.append(record)
+            #A failed session is tried again once it changes
+            session['converted'] = session['snapshot']
+            if conversion_metrics is not None:
+                conversion_metrics.set_queue_depth(_unconverted(sessions))
+            if max_conversions is not None and len(records) >= max_conversions:
+                break
+
+        #Wake up on a change, or when the next session could have settled.
+        #A settled session waiting for its info file waits for that file to
+        #arrive, which is a change (or is seen within poll_seconds).
+        pending = []
+        for dataid, session in sessions.items():
+            seconds = quiet_seconds-(time.time()-session['changed'])
+            if session['snapshot'] == session['converted'] or (dataid in waiting_for_info and seconds <= 0):
+                continue
+            pending.append(seconds)
+        timeout = min([poll_seconds]+[max(0.1, seconds) for seconds in pending])
+        if max_conversions is None or len(records) < max_conversions:
+            waiter.wait(timeout)
+
+    return records
@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+
+#Work queue on a shared file system, for conversions spread over several nodes.
+#
+#The queue is a directory with one subdirectory per state:
+#   QUEUE_DIR/pending/  sessions waiting for a worker
+#   QUEUE_DIR/leased/   sessions a worker is converting
+#   QUEUE_DIR/done/     sessions that converted
+#   QUEUE_DIR/failed/   sessions that failed (with the error)
+#Each session is one <dataid>.json file that moves between them; in leased/
+#it is named <dataid>@<worker id>.json after the worker that holds it.
+#
+#A worker claims a session by renaming its file from pending/ to leased/.
+#rename() is atomic on POSIX file systems, NFS included, so when several
+#workers try at once exactly one succeeds and the others get
+#FileNotFoundError and try the next session. No server or database is needed.
+#
+#While it converts, the worker touches the lease file every HEARTBEAT_SECONDS.
+#A lease file not touched for lease_seconds belongs to a worker that died (or
+#lost the file system), and any worker moves it back to pending/ so another
+#worker converts the session again. That is safe: a session is published as
+#one transaction under the subject lock, and a conversion that did not finish
+#leaves the BIDS directory as it was. Since a worker only ever touches or
+#moves the lease file with its own id in the name, a worker that lost its
+#lease cannot touch, or record a result for, the new lease of the session.
+#
+#Sessions, not scans, are the unit of work, since a session is published as a
+#whole; use --scan-jobs to convert the scans of a session at once.
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, LEASED, DONE, FAILED]
+
+#Seconds without a heartbeat after which a lease has expired
+DEFAULT_LEASE_SECONDS = 600
+
+#Seconds between heartbeats of a working worker
+HEARTBEAT_SECONDS = 30
+
+#Seconds between looks at an empty queue
+DEFAULT_POLL_SECONDS = 10
+
+
+def queue_dir(proj_dir):
+
+    return os.path.join(proj_dir, 'derivatives', 'bxh2bids_queue')
+
+
+def worker_id():
+
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def _job_file(q_dir, state, dataid):
+
+    return os.path.join(q_dir, state, dataid+'.json')
+
+
+def _lease_file(q_dir, dataid, worker):
+
+    return os.path.join(q_dir, LEASED, '{}@{}.json'.format(dataid, worker.replace(':', '.')))
+
+
+def _leased_files(q_dir):
+
+    #Returns [[dataid, lease file], ...] of every leased session
+    leased_dir = os.path.join(q_dir, LEASED)
+    if not os.path.exists(leased_dir):
+        return []
+
+    return sorted([[element[:-len('.json')].split('@')[0], os.path.join(leased_dir, element)]
+                   for element in os.listdir(leased_dir) if element.endswith('.json')])
+
+
+def _make_queue_dirs(q_dir):
+
+    for state in STATES:
+        os.makedirs(os.path.join(q_dir, state), exist_ok=True)
+
+
+def _read_job(job_file):
+
+    with open(job_file) as fd:
+        return json.loads(fd.read())
+
+
+def _write_job(job_file, job):
+
+    #Write next to the file and rename, so readers never see half a file
+    tmp_file = '{}.{}.tmp'.format(job_file, worker_id().replace(':', '.'))
+    with open(tmp_file, 'w') as fd:
+        fd.write(json.dumps(job, indent=4))
+    os.replace(tmp_file, job_file)
+
+
+def _queued_ids(q_dir, state):
+
+    state_dir = os.path.join(q_dir, state)
+    if not os.path.exists(state_dir):
+        return []
+
+    return sorted(set([element[:-len('.json')].split('@')[0] for element in os.listdir(state_dir) if element.endswith('.json')]))
+
+
+def add_sessions(proj_dir, biac_dirs, incremental=False, filter_args=None):
+
+    #Queue sessions for conversion. filter_args are the keyword arguments of
+    #scan_filter.make_scan_filter(), kept as given so they can be stored.
+    #Sessions already pending or leased are left alone; sessions that are
+    #done or failed are queued again.
+    q_dir = queue_dir(proj_dir)
+    _make_queue_dirs(q_dir)
+    added = []
+    leased = _queued_ids(q_dir, LEASED)
+    for dataid in biac_dirs:
+        if os.path.exists(_job_file(q_dir, PENDING, dataid)) or dataid in leased:
+            print('Already queued: {}'.format(dataid))
+            continue
+        job = {
+               'dataid': dataid,
+               'incremental': incremental,
+               'filter_args': filter_args,
+               'added': time.time(),
+               'attempts': 0,
+               }
+        _write_job(_job_file(q_dir, PENDING, dataid), job)
+        for state in [DONE, FAILED]:
+            if os.path.exists(_job_file(q_dir, state, dataid)):
+                os.remove(_job_file(q_dir, state, dataid))
+        added.append(dataid)
+
+    print('Queued {} session(s): {}'.format(len(added), added))
+
+    return added
+
+
+def reclaim_expired(q_dir, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+    #Move sessions whose lease expired back to pending; returns their ids
+    reclaimed = []
+    now = time.time()
+    for dataid, leased_file in _leased_files(q_dir):
+        try:
+            age = now-os.path.getmtime(leased_file)
+        except FileNotFoundError:
+            continue
+        if age < lease_seconds:
+            continue
+        try:
+            os.rename(leased_file, _job_file(q_dir, PENDING, dataid))
+        except FileNotFoundError:
+            #Another worker reclaimed it, or its worker just finished
+            continue
+        try:
+            os.utime(_job_file(q_dir, PENDING, dataid))
+        except FileNotFoundError:
+            pass
+        logging.warning('Lease of {} expired ({:.0f} s without a heartbeat); queued again.'.format(dataid, age))
+        print('Reclaimed expired lease: {}'.format(dataid))
+        reclaimed.append(dataid)
+
+    return reclaimed
+
+
+def claim_session(q_dir):
+
+    #Lease the oldest pending session; returns its job, or None
+    pending = []
+    for dataid in _queued_ids(q_dir, PENDING):
+        try:
+            pending.append([os.path.getmtime(_job_file(q_dir, PENDING, dataid)), dataid])
+        except FileNotFoundError:
+            continue
+    for added, dataid in sorted(pending):
+        pending_file = _job_file(q_dir, PENDING, dataid)
+        leased_file = _lease_file(q_dir, dataid, worker_id())
+        try:
+            #The file keeps its time through rename(); start the lease before
+            #it is in leased/, or it may look expired there
+            os.utime(pending_file)
+            os.rename(pending_file, leased_file)
+            job = _read_job(leased_file)
+        except FileNotFoundError:
+            #Another worker got it first (or the lease was lost already)
+            continue
+        job['worker'] = worker_id()
+        job['leased'] = time.time()
+        job['attempts'] = job.get('attempts', 0)+1
+        _write_job(leased_file, job)
+        return job
+
+    return None
+
+
+class Heartbeat(object):
+
+    #Touches a lease file every HEARTBEAT_SECONDS in a thread until stopped
+
+    def __init__(self, lease_file, interval=HEARTBEAT_SECONDS):
+        self.lease_file = lease_file
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lease_file)
+            except FileNotFoundError:
+                if not self.lost:
+                    logging.warning('Lease file is gone (lease expired?): {}'.format(self.lease_file))
+                self.lost = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def finish_session(q_dir, job, result):
+
+    #Move a leased session to done/ or failed/ with the result of its conversion
+    #Move first: writing to leased/ after losing the lease would take it back
+    state = DONE if result['ok'] else FAILED
+    state_file = _job_file(q_dir, state, job['dataid'])
+    try:
+        os.rename(_lease_file(q_dir, job['dataid'], job['worker']), state_file)
+    except FileNotFoundError:
+        #The lease expired and the session was queued again; the conversion
+        #that holds it now records the result
+        logging.warning('Lease of {} was lost; result not recorded.'.format(job['dataid']))
+        return None
+    job['finished'] = time.time()
+    job['seconds'] = result['seconds']
+    job['error'] = result['error']
+    _write_job(state_file, job)
+
+    return state
+
+
+def run_worker(proj_dir, scan_jobs=1, lease_seconds=DEFAULT_LEASE_SECONDS, poll_seconds=DEFAULT_POLL_SECONDS, forever=False):
+
+    #Convert queued sessions until the queue is empty (or, with forever, until
+    #killed). Returns the number of sessions this worker converted.
+    import bxh2bids.run_bxh2bids as rb2b
+    import bxh2bids.scan_filter as scan_filters
+
+    q_dir = queue_dir(proj_dir)
+    _make_queue_dirs(q_dir)
+    converted = 0
+    print('Worker {} started on {}'.format(worker_id(), q_dir))
+    while True:
+        reclaim_expired(q_dir, lease_seconds)
+        job = claim_session(q_dir)
+        if job is None:
+            #Sessions other workers hold may still come back if they die
+            if not forever and not _queued_ids(q_dir, LEASED):
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        dataid = job['dataid']
+        print('Worker {} converting {} (attempt {})'.format(worker_id(), dataid, job['attempts']))
+        scan_filter = scan_filters.make_scan_filter(**(job.get('filter_args') or {}))
+        with Heartbeat(_lease_file(q_dir, dataid, job['worker']), min(HEARTBEAT_SECONDS, lease_seconds/3.0)):
+            result = rb2b._bidsify_session(proj_dir, dataid, incremental=job.get('incremental', False), scan_filter=scan_filter,
+                                           scan_jobs=scan_jobs)
+        rb2b._print_session_result(result)
+        if finish_session(q_dir, job, result) == DONE:
+            converted = converted+1
+
+    print('Worker {} finished: converted {} session(s).'.format(worker_id(), converted))
+
+    return converted
+
+
+def run_workers(proj_dir, jobs=1, scan_jobs=1, lease_seconds=DEFAULT_LEASE_SECONDS, poll_seconds=DEFAULT_POLL_SECONDS, forever=False):
+
+    #Run jobs workers on this node, each in its own process
+    from concurrent.futures import ProcessPoolExecutor
+
+    if jobs <= 1:
+        return run_worker(proj_dir, scan_jobs, lease_seconds, poll_seconds, forever)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_worker, proj_dir, scan_jobs, lease_seconds, poll_seconds, forever) for i in range(jobs)]
+
+    return sum([future.result() for future in futures])
+
+
+def queue_status(proj_dir, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+    #Returns {state: [job, ...]}; leased jobs get 'heartbeat_age' and 'expired'
+    q_dir = queue_dir(proj_dir)
+    status = {}
+    now = time.time()
+    for state in STATES:
+        status[state] = []
+        if state == LEASED:
+            job_files = _leased_files(q_dir)
+        else:
+            job_files = [[dataid, _job_file(q_dir, state, dataid)] for dataid in _queued_ids(q_dir, state)]
+        for dataid, job_file in job_files:
+            try:
+                job = _read_job(job_file)
+                if state == LEASED:
+                    job['heartbeat_age'] = now-os.path.getmtime(job_file)
+                    job['expired'] = job['heartbeat_age'] >= lease_seconds
+            except (FileNotFoundError, ValueError):
+                #Moved, or being rewritten, while we looked
+                job = {'dataid': dataid}
+            status[state].append(job)
+
+    return status
+
+
+def format_status(status):
+
+    lines = [', '.join(['{}: {}'.format(state, len(status[state])) for state in STATES])]
+    for job in status[LEASED]:
+        lines.append('    leased  {} by {} (attempt {}, last heartbeat {:.0f} s ago{})'.format(
+                     job['dataid'], job.get('worker', '?'), job.get('attempts', '?'), job.get('heartbeat_age', 0),
+                     ', EXPIRED' if job.get('expired') else ''))
+    for job in status[FAILED]:
+        lines.append('    failed  {}: {}'.format(job['dataid'], job.get('error')))
+    done_seconds = [job['seconds'] for job in status[DONE] if job.get('seconds') is not None]
+    if done_seconds:
+        lines.append('Done sessions took {:.1f} s on average.'.format(sum(done_seconds)/len(done_seconds)))
+
+    return '\n'.join(lines)